@@ -2,15 +2,27 @@ import pytorch_lightning as pl
 from torch.optim.lr_scheduler import CosineAnnealingLR
 from transformers import DetrForObjectDetection
 import torch
+from model.query_reduction import get_num_queries_from_checkpoint
 
 
 class Detr(pl.LightningModule):
 
-    def __init__(self, lr, lr_backbone, weight_decay, train_dataloader=None, val_dataloader=None, max_epochs=10):
+    def __init__(self, lr, lr_backbone, weight_decay, train_dataloader=None, val_dataloader=None, max_epochs=10,
+                 num_queries=100, auxiliary_loss=False):
+        """
+        :param num_queries: Number of object queries, the query embeddings are initialized randomly if it is not 100,
+        use model/query_reduction.py to initialize them from the queries of a trained model instead.
+        :param auxiliary_loss: Also train the class and box heads on the output of every decoder layer, which
+        util/early_exit.py needs to read the boxes before the last layer.
+        """
         super().__init__()
+        # The checkpoint keeps auxiliary_loss, so util/early_exit.py can tell how the heads were trained.
+        self.save_hyperparameters('auxiliary_loss')
         # replace COCO classification head with custom head
         self.model = DetrForObjectDetection.from_pretrained("facebook/detr-resnet-50",
                                                             num_labels=1,
+                                                            num_queries=num_queries,
+                                                            auxiliary_loss=auxiliary_loss,
                                                             ignore_mismatched_sizes=True)
         # see https://github.com/PyTorchLightning/pytorch-lightning/pull/1896
         self.lr = lr
@@ -48,9 +60,10 @@ class Detr(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         loss, loss_dict = self.common_step(batch, batch_idx)
-        self.log("validation_loss", loss)
+        # Average over the processes under distributed training.
+        self.log("validation_loss", loss, sync_dist=True)
         for k, v in loss_dict.items():
-            self.log("validation_" + k, v.item())
+            self.log("validation_" + k, v.item(), sync_dist=True)
 
         return loss
 
@@ -76,8 +89,28 @@ class Detr(pl.LightningModule):
         return self.val_dataloader_
 
 
-def load_model_from_ckpt(args):
-    model = Detr.load_from_checkpoint(lr=1e-4, lr_backbone=1e-5, weight_decay=1e-4,
-                                      checkpoint_path=args.checkpoint_path)
+def load_detr_from_checkpoint(checkpoint, **kwargs):
+    """
+    Build the Detr model of a checkpoint that is already loaded, so the file is read once instead of once per check.
+    :param checkpoint: Detr checkpoint loaded with torch.load.
+    :param kwargs: Arguments of Detr that replace the ones of the checkpoint.
+    """
+    # The number of object queries is read from the checkpoint, so the reduced-query checkpoints load as well.
+    arguments = dict(lr=1e-4, lr_backbone=1e-5, weight_decay=1e-4,
+                     num_queries=get_num_queries_from_checkpoint(checkpoint),
+                     auxiliary_loss=checkpoint.get('hyper_parameters', {}).get('auxiliary_loss', False))
+    arguments.update(kwargs)
+    model = Detr(**arguments)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
+
+
+def load_model_from_ckpt(args, checkpoint=None):
+    """
+    :param checkpoint: The checkpoint of args.checkpoint_path if the caller already loaded it, otherwise it is loaded.
+    """
+    if checkpoint is None:
+        checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+    model = load_detr_from_checkpoint(checkpoint)
     model.eval()
     return model
@@ -0,0 +1,131 @@
+"""
+Reduced-precision CPU inference for the Detr model.
+fp32: No change.
+int8_dynamic: Dynamic int8 quantization of the linear layers in the transformer encoder and decoder.
+int8_static: int8_dynamic plus FX static int8 quantization of the ResNet backbone, calibrated on a few images.
+bf16: bfloat16 autocast, only on CPUs with native bf16 support.
+Quantized models only run on CPU.
+"""
+import contextlib
+import warnings
+import torch
+from torch import nn
+
+PRECISION_MODES = ['fp32', 'int8_dynamic', 'int8_static', 'bf16']
+
+
+def is_bf16_supported():
+    """
+    Check if the CPU has native bf16 instructions, otherwise bf16 is emulated and slower than fp32.
+    """
+    try:
+        with open('/proc/cpuinfo') as file:
+            cpu_flags = file.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in cpu_flags or 'amx_bf16' in cpu_flags
+
+
+def get_inference_context(precision):
+    """
+    :return: The context manager that the forward pass should run in for the given precision.
+    """
+    if precision == 'bf16':
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def get_detr_model(model):
+    """
+    :param model: Detr LightningModule or DetrForObjectDetection.
+    :return: The DetrModel inside, which holds the backbone, the encoder and the decoder.
+    """
+    while not hasattr(model, 'query_position_embeddings'):
+        model = model.model
+    return model
+
+
+def quantize_transformer_dynamic(model):
+    """
+    Replace the linear layers of the transformer encoder and decoder by dynamic int8 linear layers.
+    The class and box heads stay in fp32.
+    """
+    detr_model = get_detr_model(model)
+    torch.ao.quantization.quantize_dynamic(detr_model.encoder, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    torch.ao.quantization.quantize_dynamic(detr_model.decoder, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def fold_frozen_batch_norm(conv, frozen_batch_norm):
+    """
+    Fold a DetrFrozenBatchNorm2d into the convolution before it.
+    """
+    scale = frozen_batch_norm.weight * (frozen_batch_norm.running_var + 1e-5).rsqrt()
+    conv_bias = conv.bias if conv.bias is not None else torch.zeros_like(frozen_batch_norm.running_mean)
+    conv.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1), requires_grad=False)
+    conv.bias = nn.Parameter((conv_bias - frozen_batch_norm.running_mean) * scale + frozen_batch_norm.bias,
+                             requires_grad=False)
+
+
+def fold_all_frozen_batch_norms(module):
+    """
+    Fold every (convN, bnN) pair and every Conv2d directly followed by a frozen batch norm in a Sequential,
+    which covers the timm ResNet used by DETR.
+    """
+    for child in module.children():
+        fold_all_frozen_batch_norms(child)
+    children = dict(module.named_children())
+    for name, child in children.items():
+        if isinstance(child, nn.Conv2d) and name.startswith('conv'):
+            batch_norm_name = 'bn' + name[len('conv'):]
+            if batch_norm_name in children and type(children[batch_norm_name]).__name__ == 'DetrFrozenBatchNorm2d':
+                fold_frozen_batch_norm(child, children[batch_norm_name])
+                setattr(module, batch_norm_name, nn.Identity())
+    if isinstance(module, nn.Sequential):
+        for index in range(len(module) - 1):
+            if isinstance(module[index], nn.Conv2d) and \
+                    type(module[index + 1]).__name__ == 'DetrFrozenBatchNorm2d':
+                fold_frozen_batch_norm(module[index], module[index + 1])
+                module[index + 1] = nn.Identity()
+
+
+def quantize_backbone_static(model, list_of_calibration_pixel_values):
+    """
+    Statically quantize the ResNet backbone to int8 with FX graph mode quantization.
+    :param list_of_calibration_pixel_values: List of pixel_values tensors from the feature extractor.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    if len(list_of_calibration_pixel_values) == 0:
+        raise ValueError("Static quantization of the backbone needs at least one calibration image.")
+    conv_encoder = get_detr_model(model).backbone.conv_encoder
+    backbone = conv_encoder.model
+    fold_all_frozen_batch_norms(backbone)
+    prepared_backbone = prepare_fx(backbone, get_default_qconfig_mapping('x86'),
+                                   example_inputs=(list_of_calibration_pixel_values[0],))
+    with torch.no_grad():
+        for pixel_values in list_of_calibration_pixel_values:
+            prepared_backbone(pixel_values)
+    conv_encoder.model = convert_fx(prepared_backbone)
+    return model
+
+
+def apply_precision(model, precision, list_of_calibration_pixel_values=None):
+    """
+    Convert the model for the given precision mode, the model should be in eval mode on CPU.
+    :return: The converted model and the precision that is actually used.
+    """
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision {precision}, choose from {PRECISION_MODES}.")
+    if precision == 'int8_static' and not list_of_calibration_pixel_values:
+        raise ValueError("int8_static needs calibration pixel values, use get_calibration_pixel_values of "
+                         "util/crop_engine.py or choose int8_dynamic.")
+    if precision == 'bf16' and not is_bf16_supported():
+        warnings.warn("This CPU has no native bf16 support, fall back to fp32.")
+        precision = 'fp32'
+    if precision in ['int8_dynamic', 'int8_static']:
+        quantize_transformer_dynamic(model)
+    if precision == 'int8_static':
+        quantize_backbone_static(model, list_of_calibration_pixel_values)
+    return model, precision
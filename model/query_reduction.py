@@ -0,0 +1,64 @@
+"""
+DETR predicts 100 boxes with 100 object queries, but only the box with the highest score is used for cropping. A model
+with fewer queries is initialized from the queries that give the top-1 box most often, then it can be evaluated as is
+or fine-tuned, and the decoder runs on far fewer queries.
+"""
+import torch
+from torch import nn
+from model.precision import get_detr_model
+
+QUERY_EMBEDDINGS_KEY = 'model.model.query_position_embeddings.weight'
+
+
+def get_num_queries_from_checkpoint(checkpoint):
+    """
+    :param checkpoint: Detr checkpoint loaded with torch.load.
+    :return: The number of object queries of the checkpoint.
+    """
+    return checkpoint['state_dict'][QUERY_EMBEDDINGS_KEY].shape[0]
+
+
+def count_query_usage(model, dataloader, number_of_batches=None):
+    """
+    Count how often each query gives the box with the highest score.
+    :param dataloader: Dataloader of batches with pixel_values and pixel_mask, like the one of scripts/train.py.
+    :return: Tensor with the count of each query.
+    """
+    detr_model = get_detr_model(model)
+    query_usage = torch.zeros(detr_model.query_position_embeddings.num_embeddings, dtype=torch.long)
+    device = next(model.parameters()).device
+    was_training = model.training
+    model.eval()
+    with torch.inference_mode():
+        for batch_index, batch in enumerate(dataloader):
+            if number_of_batches is not None and batch_index >= number_of_batches:
+                break
+            outputs = model.model(pixel_values=batch['pixel_values'].to(device),
+                                  pixel_mask=batch['pixel_mask'].to(device))
+            top_query = outputs.logits.softmax(-1)[:, :, :-1].max(-1).values.argmax(-1)
+            query_usage += torch.bincount(top_query.cpu(), minlength=len(query_usage))
+    if was_training:
+        model.train()
+    return query_usage
+
+
+def select_top_queries(query_usage, num_queries):
+    """
+    :return: The indices of the num_queries most used queries, in their original order.
+    """
+    return torch.sort(torch.argsort(query_usage, descending=True, stable=True)[:num_queries]).values
+
+
+def reduce_object_queries(model, query_indices):
+    """
+    Keep only the given object queries of the model, in place.
+    :param model: Detr LightningModule or DetrForObjectDetection.
+    """
+    detr_model = get_detr_model(model)
+    old_embeddings = detr_model.query_position_embeddings
+    new_embeddings = nn.Embedding(len(query_indices), old_embeddings.embedding_dim)
+    with torch.no_grad():
+        new_embeddings.weight.copy_(old_embeddings.weight[query_indices.to(old_embeddings.weight.device)])
+    detr_model.query_position_embeddings = new_embeddings.to(old_embeddings.weight.device)
+    detr_model.config.num_queries = len(query_indices)
+    return model
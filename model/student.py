@@ -0,0 +1,191 @@
+"""
+Small CPU detector distilled from DETR. Every image has one insect, so instead of object queries a light timm backbone
+(MobileNetV3 or ResNet-18) regresses the box directly from the pooled features, and a second head predicts the score of
+the teacher for it. The images are resized to a fixed size without keeping the ratio, the box is normalized so it does
+not depend on it.
+
+The outputs have the layout of DETR with a single query (logits of the class and of no-object, and boxes in normalized
+cx, cy, w, h), so the crop engine and util/fast_evaluation.py use the student like a Detr model. It is trained on the
+boxes of the teacher by scripts/train_student.py.
+"""
+import collections
+import pytorch_lightning as pl
+import timm
+import torch
+import torch.nn.functional as F
+import torchvision.transforms.functional as TF
+from PIL import Image
+from torch import nn
+from torch.optim.lr_scheduler import CosineAnnealingLR
+from transformers import BatchFeature
+from util.evaluation_support import generalized_box_iou_for_pairs
+from util.visualize_and_process_bbox import box_cxcywh_to_xyxy
+
+StudentOutput = collections.namedtuple('StudentOutput', ['logits', 'pred_boxes'])
+
+STUDENT_BACKBONES = ['mobilenetv3_large_100', 'mobilenetv3_small_100', 'resnet18', 'efficientnet_b0']
+
+# Precisions of model/precision.py that do not depend on the layers of DETR.
+STUDENT_PRECISION_MODES = ['fp32', 'bf16']
+
+# Present in the state dict of a Student checkpoint, not in the one of a Detr checkpoint.
+STUDENT_STATE_DICT_KEY = 'model.box_head.0.weight'
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class StudentFeatureExtractor:
+    """
+    Resize and normalize the images for the student, called like DetrFeatureExtractor by the crop engine.
+    """
+
+    def __init__(self, input_height=240, input_width=320):
+        self.input_height = input_height
+        self.input_width = input_width
+
+    def preprocess(self, image):
+        """
+        :param image: PIL image or image tensor in C x H x W in [0, 1].
+        :return: Normalized tensor in 3 x input_height x input_width.
+        """
+        if isinstance(image, Image.Image):
+            image = TF.to_tensor(image.convert("RGB").resize((self.input_width, self.input_height), Image.BILINEAR))
+        else:
+            image = F.interpolate(image[None, :3].float(), size=(self.input_height, self.input_width),
+                                  mode='bilinear', align_corners=False, antialias=True)[0]
+        return TF.normalize(image, IMAGENET_MEAN, IMAGENET_STD)
+
+    def __call__(self, images, return_tensors='pt'):
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        pixel_values = torch.stack([self.preprocess(image) for image in images])
+        # Every image is resized to the input size, nothing is padded.
+        pixel_mask = torch.ones((len(images),) + pixel_values.shape[2:], dtype=torch.long)
+        return BatchFeature({'pixel_values': pixel_values, 'pixel_mask': pixel_mask})
+
+
+class StudentModel(nn.Module):
+    def __init__(self, backbone='mobilenetv3_large_100', pretrained=True, hidden_size=256):
+        super().__init__()
+        # num_classes=0 makes timm return the pooled features.
+        self.backbone = timm.create_model(backbone, pretrained=pretrained, num_classes=0)
+        self.box_head = nn.Sequential(nn.Linear(self.backbone.num_features, hidden_size), nn.ReLU(inplace=True),
+                                      nn.Linear(hidden_size, 4))
+        self.score_head = nn.Linear(self.backbone.num_features, 1)
+
+    def forward(self, pixel_values, pixel_mask=None):
+        """
+        :param pixel_mask: Ignored, the images of a batch all have the input size.
+        :return: StudentOutput with logits in (batch, 1, 2) and boxes in normalized cx, cy, w, h in (batch, 1, 4).
+        """
+        features = self.backbone(pixel_values)
+        boxes = self.box_head(features).sigmoid()
+        score_logits = self.score_head(features)
+        # The softmax over (score_logits, 0) is the sigmoid of score_logits, as the class score of DETR.
+        logits = torch.cat([score_logits, torch.zeros_like(score_logits)], dim=-1)
+        return StudentOutput(logits.unsqueeze(1), boxes.unsqueeze(1))
+
+
+class Student(pl.LightningModule):
+
+    def __init__(self, backbone='mobilenetv3_large_100', input_height=240, input_width=320, lr=1e-3,
+                 lr_backbone=1e-4, weight_decay=1e-4, max_epochs=10, pretrained=True, l1_weight=5.0,
+                 giou_weight=2.0, score_weight=1.0, train_dataloader=None, val_dataloader=None):
+        """
+        :param backbone: Name of a timm model, see STUDENT_BACKBONES.
+        :param pretrained: Start from the ImageNet weights of the backbone.
+        :param l1_weight: Weight of the L1 loss of the box, giou_weight of its generalized IoU loss and score_weight of
+        the binary cross entropy with the score of the teacher, the box weights are the ones of DETR.
+        """
+        super().__init__()
+        # The checkpoint keeps the architecture, so load_from_checkpoint does not need the arguments again.
+        self.save_hyperparameters(ignore=['train_dataloader', 'val_dataloader'])
+        self.model = StudentModel(backbone, pretrained)
+        self.lr = lr
+        self.lr_backbone = lr_backbone
+        self.weight_decay = weight_decay
+        self.train_dataloader_ = train_dataloader
+        self.val_dataloader_ = val_dataloader
+        self.max_epochs = max_epochs
+
+    def forward(self, pixel_values, pixel_mask=None):
+        return self.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+
+    def get_feature_extractor(self):
+        return StudentFeatureExtractor(self.hparams.input_height, self.hparams.input_width)
+
+    def common_step(self, batch, batch_idx):
+        """
+        :param batch: pixel_values and labels with the target box in normalized cx, cy, w, h and the score of the
+        teacher, from util/distillation_dataset.py.
+        """
+        outputs = self.model(pixel_values=batch["pixel_values"])
+        target_boxes = torch.stack([target['boxes'][0] for target in batch["labels"]]).to(self.device)
+        target_scores = torch.stack([target['score'] for target in batch["labels"]]).to(self.device)
+        boxes = outputs.pred_boxes[:, 0]
+        loss_dict = {'loss_bbox': F.l1_loss(boxes, target_boxes),
+                     'loss_giou': (1 - generalized_box_iou_for_pairs(box_cxcywh_to_xyxy(boxes),
+                                                                     box_cxcywh_to_xyxy(target_boxes))).mean(),
+                     'loss_score': F.binary_cross_entropy_with_logits(outputs.logits[:, 0, 0], target_scores)}
+        loss = self.hparams.l1_weight * loss_dict['loss_bbox'] + self.hparams.giou_weight * loss_dict['loss_giou'] + \
+            self.hparams.score_weight * loss_dict['loss_score']
+        return loss, loss_dict
+
+    def training_step(self, batch, batch_idx):
+        loss, loss_dict = self.common_step(batch, batch_idx)
+        self.log("training_loss", loss)
+        for k, v in loss_dict.items():
+            self.log("train_" + k, v.item())
+
+        return loss
+
+    def validation_step(self, batch, batch_idx):
+        loss, loss_dict = self.common_step(batch, batch_idx)
+        self.log("validation_loss", loss, sync_dist=True)
+        for k, v in loss_dict.items():
+            self.log("validation_" + k, v.item(), sync_dist=True)
+
+        return loss
+
+    def configure_optimizers(self):
+        param_dicts = [
+            {"params": [p for n, p in self.named_parameters() if "backbone" not in n and p.requires_grad]},
+            {
+                "params": [p for n, p in self.named_parameters() if "backbone" in n and p.requires_grad],
+                "lr": self.lr_backbone,
+            },
+        ]
+        optimizer = torch.optim.AdamW(param_dicts, lr=self.lr,
+                                      weight_decay=self.weight_decay)
+
+        scheduler = CosineAnnealingLR(optimizer, T_max=self.max_epochs, eta_min=0)
+
+        return {"optimizer": optimizer, "lr_scheduler": scheduler}
+
+    def train_dataloader(self):
+        return self.train_dataloader_
+
+    def val_dataloader(self):
+        return self.val_dataloader_
+
+
+def is_student_checkpoint(checkpoint):
+    """
+    :param checkpoint: Checkpoint loaded with torch.load, pass it on to load_student_from_ckpt or load_model_from_ckpt
+    of model/detr.py so the file is only read once.
+    """
+    return STUDENT_STATE_DICT_KEY in checkpoint['state_dict']
+
+
+def load_student_from_ckpt(args, checkpoint=None):
+    """
+    :param checkpoint: The checkpoint of args.checkpoint_path if the caller already loaded it, otherwise it is loaded.
+    """
+    if checkpoint is None:
+        checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+    # The trained weights replace the ImageNet weights, there is no need to download them.
+    model = Student(**dict(checkpoint['hyper_parameters'], pretrained=False))
+    model.load_state_dict(checkpoint['state_dict'])
+    model.eval()
+    return model
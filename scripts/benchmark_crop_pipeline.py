@@ -0,0 +1,246 @@
+"""
+Offline benchmark of the crop pipeline on synthetic BIOSCAN-like images. Every stage is timed separately and the
+result can be compared against a saved baseline, so an optimization can be checked before it goes to the cluster.
+By default the model is a randomly initialized DETR, so no network and no checkpoint are needed.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from model.precision import PRECISION_MODES, apply_precision
+from util.image_codecs import add_codec_arguments, get_available_codecs, get_codec
+from util.crop_engine import add_crop_arguments, crop_image_with_bbox, get_calibration_pixel_values, \
+    postprocess_outputs, preprocess_images, run_model, set_inference_resolution
+from util.synthetic_data import generate_synthetic_image, init_offline_feature_extractor, init_random_detr_model
+
+STAGES = ['enumerate', 'decode', 'preprocess', 'inference', 'postprocess', 'crop_pad', 'encode', 'write',
+          'archive']
+
+
+def generate_input_images(args, input_dir):
+    rng = np.random.default_rng(args.seed)
+    for index in tqdm(range(args.number_of_images), desc="Generating synthetic images"):
+        image, _ = generate_synthetic_image(rng, args.image_width, args.image_height)
+        image.save(os.path.join(input_dir, f"synthetic_{index:06d}.jpg"), quality=95)
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_benchmark(args, model, feature_extractor, input_dir, output_dir):
+    """
+    Crop every image in input_dir and time each stage.
+    :return: Dictionary from stage to the list of its durations in seconds, and the total seconds.
+    """
+    timings = {stage: [] for stage in STAGES}
+    codec = get_codec(args.codec)
+    start_of_run = time.perf_counter()
+
+    start = time.perf_counter()
+    list_of_file_name = sorted(os.listdir(input_dir))
+    timings['enumerate'].append(time.perf_counter() - start)
+
+    for batch_start in tqdm(range(0, len(list_of_file_name), args.batch_size), desc="Benchmarking"):
+        batch_of_file_name = list_of_file_name[batch_start: batch_start + args.batch_size]
+
+        start = time.perf_counter()
+        list_of_images = [codec.read(os.path.join(input_dir, filename)) for filename in batch_of_file_name]
+        timings['decode'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        pixel_values, pixel_mask = preprocess_images(feature_extractor, list_of_images, torch.device('cpu'))
+        timings['preprocess'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        outputs = run_model(model, pixel_values, pixel_mask, args.precision)
+        timings['inference'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        bboxes, _ = postprocess_outputs(outputs, list_of_images)
+        timings['postprocess'].append(time.perf_counter() - start)
+
+        for filename, image, bbox in zip(batch_of_file_name, list_of_images, bboxes):
+            start = time.perf_counter()
+            cropped_img = crop_image_with_bbox(args, image, bbox)
+            timings['crop_pad'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            data = codec.encode(cropped_img, args.jpeg_quality)
+            timings['encode'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with open(os.path.join(output_dir, filename), 'wb') as file:
+                file.write(data)
+            timings['write'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with zipfile.ZipFile(output_dir + '.zip', 'w') as zipf:
+        for filename in os.listdir(output_dir):
+            zipf.write(os.path.join(output_dir, filename), filename)
+    timings['archive'].append(time.perf_counter() - start)
+
+    return timings, time.perf_counter() - start_of_run
+
+
+def benchmark_codecs(args, input_dir, codecs):
+    """
+    Decode every image of input_dir and encode it again with each codec.
+    :return: Dictionary from codec to its decode and encode milliseconds per image.
+    """
+    list_of_data = []
+    for filename in sorted(os.listdir(input_dir)):
+        with open(os.path.join(input_dir, filename), 'rb') as file:
+            list_of_data.append(file.read())
+    results = {}
+    for name in codecs:
+        codec = get_codec(name)
+        if codec.name != name:
+            print(f"Skipping codec {name}, it is not available.")
+            continue
+        start = time.perf_counter()
+        list_of_images = [codec.decode(data) for data in list_of_data]
+        decode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        for image in list_of_images:
+            codec.encode(image, args.jpeg_quality)
+        encode_seconds = time.perf_counter() - start
+        results[name] = {'decode_ms': decode_seconds / len(list_of_data) * 1000,
+                         'encode_ms': encode_seconds / len(list_of_data) * 1000}
+        print(f"Codec {name}: decode {results[name]['decode_ms']:.2f} ms/image, "
+              f"encode {results[name]['encode_ms']:.2f} ms/image")
+    return results
+
+
+def summarize(args, timings, total_seconds):
+    summary = {'config': {'number_of_images': args.number_of_images, 'image_width': args.image_width,
+                          'image_height': args.image_height, 'batch_size': args.batch_size,
+                          'precision': args.precision, 'threads': torch.get_num_threads(),
+                          'inference_shortest_edge': args.inference_shortest_edge,
+                          'inference_longest_edge': args.inference_longest_edge, 'codec': get_codec(args.codec).name,
+                          'checkpoint_path': args.checkpoint_path},
+               'stages': {},
+               'images_per_second': args.number_of_images / total_seconds,
+               'peak_rss_mb': get_peak_rss_mb()}
+    for stage, durations in timings.items():
+        durations = np.array(durations)
+        summary['stages'][stage] = {'total_seconds': float(durations.sum()),
+                                    'seconds_per_image': float(durations.sum()) / args.number_of_images,
+                                    'p50_ms': float(np.percentile(durations, 50)) * 1000,
+                                    'p95_ms': float(np.percentile(durations, 95)) * 1000}
+    return summary
+
+
+def compare_with_baseline(summary, baseline, tolerance):
+    """
+    Print the change of every metric against the baseline.
+    :return: List of the metrics that are worse than the baseline by more than the tolerance.
+    """
+    regressions = []
+    ratio = summary['images_per_second'] / baseline['images_per_second']
+    print(f"images/s: {baseline['images_per_second']:.2f} -> {summary['images_per_second']:.2f} ({ratio:.2f}x)")
+    if ratio < 1 - tolerance:
+        regressions.append('images_per_second')
+    ratio = summary['peak_rss_mb'] / baseline['peak_rss_mb']
+    print(f"peak RSS: {baseline['peak_rss_mb']:.0f} MB -> {summary['peak_rss_mb']:.0f} MB ({ratio:.2f}x)")
+    if ratio > 1 + tolerance:
+        regressions.append('peak_rss_mb')
+    for stage in STAGES:
+        if stage not in baseline['stages']:
+            continue
+        before = baseline['stages'][stage]['seconds_per_image']
+        after = summary['stages'][stage]['seconds_per_image']
+        ratio = after / before if before > 0 else 1.0
+        print(f"{stage}: {before * 1000:.2f} -> {after * 1000:.2f} ms/image ({ratio:.2f}x)")
+        # Ignore the noise of stages that take almost no time.
+        if ratio > 1 + tolerance and after - before > 1e-4:
+            regressions.append(stage)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number_of_images', type=int, default=64)
+    parser.add_argument('--image_width', type=int, default=1600)
+    parser.add_argument('--image_height', type=int, default=1200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="Number of images in each batch.")
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help="Benchmark a trained checkpoint instead of a randomly initialized model.")
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISION_MODES)
+    parser.add_argument('--inference_shortest_edge', type=int, default=800)
+    parser.add_argument('--inference_longest_edge', type=int, default=1333)
+    parser.add_argument('--threads', type=int, default=None, help="Number of torch threads.")
+    parser.add_argument('--work_dir', type=str, default=None,
+                        help="Folder for the synthetic inputs and the outputs, a temporary folder by default.")
+    parser.add_argument('--output_json', type=str, default=None,
+                        help="Path to save the result, it can be used as a baseline later.")
+    parser.add_argument('--baseline_json', type=str, default=None,
+                        help="Compare the result against this saved result.")
+    parser.add_argument('--regression_tolerance', type=float, default=0.1,
+                        help="Relative slowdown against the baseline that counts as a regression.")
+    parser.add_argument('--compare_codecs', default=False, action='store_true',
+                        help="Also time the decoding and encoding of the images with every available codec.")
+    add_crop_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    if args.checkpoint_path is None:
+        model = init_random_detr_model()
+    else:
+        model = load_model_from_ckpt(args)
+    feature_extractor = set_inference_resolution(init_offline_feature_extractor(), args.inference_shortest_edge,
+                                                 args.inference_longest_edge)
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir if args.work_dir is not None else temporary_dir
+        input_dir = os.path.join(work_dir, 'input')
+        output_dir = os.path.join(work_dir, 'output')
+        os.makedirs(input_dir, exist_ok=True)
+        os.makedirs(output_dir, exist_ok=True)
+        generate_input_images(args, input_dir)
+
+        if args.precision != 'fp32':
+            list_of_calibration_images = [Image.open(os.path.join(input_dir, filename)).convert("RGB")
+                                          for filename in sorted(os.listdir(input_dir))[:8]]
+            model, args.precision = apply_precision(model, args.precision,
+                                                    get_calibration_pixel_values(feature_extractor,
+                                                                                 list_of_calibration_images))
+
+        timings, total_seconds = run_benchmark(args, model, feature_extractor, input_dir, output_dir)
+        codec_results = benchmark_codecs(args, input_dir, get_available_codecs()) if args.compare_codecs else None
+
+    summary = summarize(args, timings, total_seconds)
+    if codec_results is not None:
+        summary['codecs'] = codec_results
+    for stage, stage_summary in summary['stages'].items():
+        print(f"{stage}: {stage_summary['seconds_per_image'] * 1000:.2f} ms/image, "
+              f"p50 {stage_summary['p50_ms']:.2f} ms, p95 {stage_summary['p95_ms']:.2f} ms")
+    print(f"End to end: {summary['images_per_second']:.2f} images/s, peak RSS {summary['peak_rss_mb']:.0f} MB")
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as file:
+            json.dump(summary, file, indent=4)
+
+    if args.baseline_json is not None:
+        with open(args.baseline_json) as file:
+            baseline = json.load(file)
+        regressions = compare_with_baseline(summary, baseline, args.regression_tolerance)
+        if len(regressions) > 0:
+            print("Regressions: " + ", ".join(regressions))
+            exit(1)
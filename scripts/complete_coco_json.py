@@ -1,23 +1,10 @@
 # Adding some missing information that are needed for the model to train to the coco (The area of each semantic mask and a flag call iscrowd)
 # Note: the area is not calculated properly, here we use the area of the bounding box instead of the area of the semantic mask.
 import json
-import shutil
 import os
 import argparse
-
-from sklearn.model_selection import train_test_split
-
-def add_missing_information_to_coco_json(coco_annotation_dict):
-    images = coco_annotation_dict['images']
-    annotations = coco_annotation_dict['annotations']
-
-    # Adding missing information to the annotation data
-    for i in images:
-        i['file_name'] = os.path.basename(os.path.normpath(i['toras_path']))
-    for i in annotations:
-        i['area'] = i['bbox'][2] * i['bbox'][3]
-        i['iscrowd'] = 0
-    return images, annotations
+from project_path import project_dir
+from util.dataset_builder import complete_coco_annotations
 
 
 def complete_coco_json(args):
@@ -36,7 +23,7 @@ def complete_coco_json(args):
         ]
     else:
         categories = coco_annotation_dict['categories']
-    images, annotations = add_missing_information_to_coco_json(coco_annotation_dict)
+    images, annotations = complete_coco_annotations(coco_annotation_dict)
 
     processed_coco_json = {'images': images, 'categories': categories, 'annotations': annotations}
     with open(os.path.join(args.input_dir, "coco_annotations_processed.json"), "w") as f:
@@ -10,6 +10,13 @@ import shutil
 from project_path import project_dir
 from model.detr import load_model_from_ckpt
 from util.visualize_and_process_bbox import get_bbox_from_output, scale_bbox
+from util.bbox_metadata_store import init_metadata_writer
+from util.bbox_store import get_checkpoint_hash, hash_bytes
+from util.content_index import ContentIndex, get_crop_params_hash
+from util.crop_metrics import add_metrics_arguments, init_metrics_from_args
+from util.crop_progress import STATUS_FAILED, add_progress_arguments, init_part_progress_from_args
+from util.image_codecs import add_codec_arguments, get_codec
+from util.output_sinks import SHARD_INDEX_FILE_NAME, MemmapCropSink, TarShardSink, load_shard_index
 import json
 import zipfile
 import re
@@ -112,11 +119,17 @@ def change_size_to_4_3(left, top, right, bottom):
     return left, top, right, bottom
 
 
-def crop_image(args, model, feature_extractor, device, image_folder_path):
+def crop_image(args, model, feature_extractor, device, image_folder_path, metrics, progress=None, content_index=None,
+               params_hash=None):
     """
     Crop and save images based on the predicted bounding boxes from the model.
     :param model: Detr model that loaded from the checkpoint.
     :param feature_extractor: A ResNet50 model as a standard image extractor.
+    :param metrics: CropMetrics that records the time of each stage, the throughput and the failures.
+    :param progress: PartProgress that writes the manifest of the part for scripts/crop_status.py, or None.
+    :param content_index: Optional ContentIndex from util/content_index.py. The local outputs are removed after each
+    part, so only the bbox of an indexed image is reused: it is cropped again without running the model. Images with
+    the same content within the part reuse the bbox too.
     """
 
     list_of_un_cropped_images = []
@@ -128,6 +141,13 @@ def crop_image(args, model, feature_extractor, device, image_folder_path):
     os.makedirs(path_to_cropped_and_resized_folder, exist_ok=True)
     list_of_cropped_images = os.listdir(path_to_cropped_folder)
     list_of_cropped_and_resized_images = os.listdir(path_to_cropped_and_resized_folder)
+    path_to_shard_folder = os.path.join(args.local_output_dir, "shards_" + args.current_image_folder_name)
+    set_of_images_in_shards = None
+    if args.save_shards:
+        # The samples of the last shard are only indexed once the shard is closed, after a crash their cropped files
+        # exist but the shard does not, so an image is only done if it is in the shard index.
+        set_of_images_in_shards = set(load_shard_index(path_to_shard_folder)) \
+            if os.path.exists(os.path.join(path_to_shard_folder, SHARD_INDEX_FILE_NAME)) else set()
 
     pbar_in_crop_image = tqdm(os.listdir(image_folder_path))
     for filename in pbar_in_crop_image:
@@ -136,23 +156,60 @@ def crop_image(args, model, feature_extractor, device, image_folder_path):
         name_of_cropped_and_resized_image = "cropped_resized_" + filename
         if name_of_cropped_image not in list_of_cropped_images or name_of_cropped_and_resized_image not in list_of_cropped_and_resized_images:
             list_of_un_cropped_images.append(filename)
+        elif set_of_images_in_shards is not None and filename not in set_of_images_in_shards:
+            list_of_un_cropped_images.append(filename)
     pbar_in_crop_image = tqdm(list_of_un_cropped_images)
-
-    list_of_original_image_size_and_bbox = []
+    if progress is not None:
+        number_of_images = len(os.listdir(image_folder_path))
+        progress.start(number_of_images, number_of_images - len(list_of_un_cropped_images))
+
+    memmap_sink = None
+    if args.save_memmap:
+        # One row per image of the part, so a resumed part writes into the same rows.
+        memmap_sink = MemmapCropSink(os.path.join(args.local_output_dir, "memmap_" + args.current_image_folder_name),
+                                     sorted(os.listdir(image_folder_path)), args.memmap_height, args.memmap_width,
+                                     (args.background_color_R, args.background_color_G, args.background_color_B))
+    shard_sink = None
+    if args.save_shards:
+        shard_sink = TarShardSink(path_to_shard_folder, args.shard_max_mb * 1024 * 1024,
+                                  jpeg_quality=args.jpeg_quality, codec=get_codec(args.codec))
+
+    codec = get_codec(args.codec)
+    # Both folders get the metadata, as they did with size_of_original_image_and_bbox.json.
+    list_of_metadata_writers = [init_metadata_writer(args, path_to_cropped_folder),
+                                init_metadata_writer(args, path_to_cropped_and_resized_folder)]
     list_of_image_not_found = []
+    bboxes_by_content_hash = {}
     for filename in pbar_in_crop_image:
         pbar_in_crop_image.set_description("Cropping images.")
         f = os.path.join(image_folder_path, filename)
         if os.path.isfile(f):
             try:
-                image = Image.open(f)
-                encoding = feature_extractor(images=image, return_tensors="pt").to(device)
-                pixel_values = encoding["pixel_values"].squeeze().unsqueeze(0)
-                outputs = model(pixel_values=pixel_values, pixel_mask=None)
-                pred_logit = outputs.logits[0]
-                pred_boxes = outputs.pred_boxes[0]
-                bbox = get_bbox_from_output(pred_logit, pred_boxes, image).detach().numpy()
-                bbox = np.round(bbox, 0)
+                with open(f, 'rb') as file:
+                    data = file.read()
+                with metrics.time_stage('decode'):
+                    image = codec.decode(data)
+                metrics.add_bytes_read(len(data))
+                # Hashed from the bytes that are decoded, the image is only read once.
+                content_hash = hash_bytes(data)
+                bbox = bboxes_by_content_hash.get(content_hash)
+                if bbox is None and content_index is not None:
+                    indexed_record = content_index.lookup_record(content_hash, args.checkpoint_hash, params_hash)
+                    if indexed_record is not None:
+                        bbox = np.array(indexed_record['bbox'])
+                if bbox is None:
+                    with metrics.time_stage('preprocess'):
+                        encoding = feature_extractor(images=image, return_tensors="pt").to(device)
+                        pixel_values = encoding["pixel_values"].squeeze().unsqueeze(0)
+                    with metrics.time_stage('inference'), torch.no_grad():
+                        outputs = model(pixel_values=pixel_values, pixel_mask=None)
+                    pred_logit = outputs.logits[0]
+                    pred_boxes = outputs.pred_boxes[0]
+                    bbox = get_bbox_from_output(pred_logit, pred_boxes, image).detach().numpy()
+                    bbox = np.round(bbox, 0)
+                else:
+                    metrics.increment_counter('deduplicated')
+                bboxes_by_content_hash[content_hash] = bbox
                 left, top, right, bottom = bbox[0], bbox[1], bbox[2], bbox[3]
                 if args.show_bbox:
                     draw = ImageDraw.Draw(image)
@@ -161,8 +218,10 @@ def crop_image(args, model, feature_extractor, device, image_folder_path):
 
                 image_size = image.size
 
-                list_of_original_image_size_and_bbox.append(
-                    {'filename': filename, 'original_size': image_size, 'bbox': bbox.tolist()})
+                record = {'filename': filename, 'original_size': image_size, 'bbox': bbox.tolist(),
+                          'content_hash': content_hash, 'checkpoint_hash': args.checkpoint_hash}
+                for metadata_writer in list_of_metadata_writers:
+                    metadata_writer.append(record)
 
                 if args.fix_ratio:
                     width = right - left
@@ -207,23 +266,48 @@ def crop_image(args, model, feature_extractor, device, image_folder_path):
 
                 cropped_img = image.crop((left, top, right, bottom))
 
-                cropped_img.save(os.path.join(path_to_cropped_folder, "cropped_" + filename))
+                with metrics.time_stage('encode_write'):
+                    codec.save(cropped_img, os.path.join(path_to_cropped_folder, "cropped_" + filename),
+                               args.jpeg_quality)
+                metrics.add_bytes_written(os.path.getsize(os.path.join(path_to_cropped_folder, "cropped_" + filename)))
                 if args.save_resized:
-                    new_width, new_height = get_size_with_aspect_ratio(cropped_img.size, 256)
-                    cropped_and_resized_img = cropped_img.resize((new_width, new_height))
-                    cropped_and_resized_img.save(os.path.join(path_to_cropped_and_resized_folder,
-                                                              "cropped_resized_" + filename))
-            except:
+                    with metrics.time_stage('resize_encode_write'):
+                        new_width, new_height = get_size_with_aspect_ratio(cropped_img.size, 256)
+                        cropped_and_resized_img = cropped_img.resize((new_width, new_height))
+                        codec.save(cropped_and_resized_img, os.path.join(path_to_cropped_and_resized_folder,
+                                                                         "cropped_resized_" + filename),
+                                   args.jpeg_quality)
+                if memmap_sink is not None:
+                    with metrics.time_stage('memmap_write'):
+                        memmap_sink.write(filename, cropped_img)
+                if shard_sink is not None:
+                    with metrics.time_stage('shard_write'):
+                        shard_sink.write(filename, cropped_img, record)
+                if content_index is not None:
+                    content_index.add(content_hash, args.checkpoint_hash, params_hash,
+                                      os.path.join(path_to_cropped_folder, "cropped_" + filename), record)
+                metrics.add_images(1)
+                metrics.maybe_write_snapshot()
+                if progress is not None:
+                    progress.add_images(1)
+                    progress.maybe_write()
+            except Exception as e:
                 print("Image not found or failed: " + f)
+                metrics.record_failure(type(e).__name__)
+                if progress is not None:
+                    progress.record_failure(type(e).__name__)
                 list_of_image_not_found.append(filename)
                 continue
 
+    if memmap_sink is not None:
+        memmap_sink.close()
+    if shard_sink is not None:
+        shard_sink.close()
 
-
-    with open(os.path.join(path_to_cropped_folder, 'size_of_original_image_and_bbox.json'), 'w') as file:
-        json.dump(list_of_original_image_size_and_bbox, file)
-    with open(os.path.join(path_to_cropped_and_resized_folder, 'size_of_original_image_and_bbox.json'), 'w') as file:
-        json.dump(list_of_original_image_size_and_bbox, file)
+    for metadata_writer in list_of_metadata_writers:
+        metadata_writer.close()
+    if content_index is not None:
+        content_index.commit()
 
     with open(os.path.join(path_to_cropped_folder, 'images_not_found_or_failed.json'), 'w') as file:
         json.dump(list_of_image_not_found, file)
@@ -257,6 +341,15 @@ if __name__ == '__main__':
                         help="Folder that will contain the cropped images in both un-resized and resized.")
     parser.add_argument('--save_resized', default=True,
                         action='store_true', help="Also save the image with shorter edge resized to 256")
+    parser.add_argument('--save_memmap', default=False,
+                        action='store_true', help="Also write letterboxed fixed-size crops into a memory-mapped array "
+                                                  "for training, see util/output_sinks.py.")
+    parser.add_argument('--memmap_height', type=int, default=256)
+    parser.add_argument('--memmap_width', type=int, default=341)
+    parser.add_argument('--save_shards', default=False,
+                        action='store_true', help="Also write the crops, the resized crops and their metadata into tar "
+                                                  "shards, see util/output_sinks.py.")
+    parser.add_argument('--shard_max_mb', type=int, default=1024)
     parser.add_argument('--crop_ratio', type=float, default=1.4,
                         help="Scale the bbox to crop larger or small area.")
     parser.add_argument('--show_bbox', default=False,
@@ -276,6 +369,16 @@ if __name__ == '__main__':
                         help="Define the background color's G value.")
     parser.add_argument('--background_color_B', type=int, default=243,
                         help="Define the background color's B value.")
+    parser.add_argument('--metadata_format', type=str, default='columnar', choices=['json', 'columnar'],
+                        help="columnar streams the metadata of each part to row groups in bbox_metadata with bounded "
+                             "memory, json keeps size_of_original_image_and_bbox.json.")
+    parser.add_argument('--dedup_index', type=str, default=None,
+                        help="Path to a sqlite index shared by the parts, images whose content was already cropped "
+                             "with the same checkpoint and crop parameters reuse the stored bbox instead of going "
+                             "through the model. It needs a file system with working sqlite locks.")
+    add_metrics_arguments(parser)
+    add_progress_arguments(parser)
+    add_codec_arguments(parser)
 
     args = parser.parse_args()
 
@@ -283,12 +386,20 @@ if __name__ == '__main__':
     feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
 
     model = load_model_from_ckpt(args)
+    args.checkpoint_hash = get_checkpoint_hash(args.checkpoint_path)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     model.to(device)
 
     os.makedirs(args.remote_output_dir, exist_ok=True)
 
+    metrics = init_metrics_from_args(args, job_name='crop_6M')
+    content_index = None
+    params_hash = None
+    if args.dedup_index is not None:
+        content_index = ContentIndex(args.dedup_index)
+        params_hash = get_crop_params_hash(args)
+
 
 
     # if os.path.exists(args.local_input_dir):
@@ -317,17 +428,27 @@ if __name__ == '__main__':
 
             if len(list_of_zip_index) == 0:
                 print("No tar files to process.")
+                metrics.close()
+                if content_index is not None:
+                    content_index.close()
                 exit(0)
 
             curr_zip_index = list_of_zip_index.pop(0)
             with open(args.list_of_zip_index, 'w') as file:
                 json.dump(list_of_zip_index, file)
 
+        # Written before copying the zip, so the part does not disappear from crop_status.py in the meantime.
+        progress = init_part_progress_from_args(args, curr_zip_index)
+        if progress is not None:
+            progress.start_copying()
+
         target_zip_name = f"bioscan_images_original_full_part{curr_zip_index}.zip"
         target_zip_path = os.path.join(args.remote_input_dir, target_zip_name)
 
         if not os.path.exists(target_zip_path):
             print(f"Zip file not found: {target_zip_path}")
+            if progress is not None:
+                progress.finish(STATUS_FAILED, f"Zip file not found: {target_zip_path}")
             continue
         local_zip_path = os.path.join(args.local_input_dir, target_zip_name)
         shutil.copyfile(target_zip_path, local_zip_path)
@@ -339,7 +460,16 @@ if __name__ == '__main__':
 
         image_folder_path = os.path.join(args.local_input_dir, 'bioscan', 'images', 'original_full', f'part{curr_zip_index}')
         args.current_image_folder_name = f'part{curr_zip_index}'
-        crop_image(args, model, feature_extractor, device, image_folder_path)
+        metrics.set_label('part', curr_zip_index)
+        try:
+            crop_image(args, model, feature_extractor, device, image_folder_path, metrics, progress, content_index,
+                       params_hash)
+        except Exception as e:
+            if progress is not None:
+                progress.finish(STATUS_FAILED, f"{type(e).__name__}: {e}")
+            raise
+        if args.metrics_dir is not None:
+            metrics.write_snapshot()
 
         folder_name = f"part{curr_zip_index}"
 
@@ -352,5 +482,9 @@ if __name__ == '__main__':
             shutil.rmtree(args.local_input_dir)
             shutil.rmtree(args.local_output_dir)
             os.remove(zip_file_name)
+            if progress is not None:
+                progress.finish()
         except Exception as e:
             print(f"An error occurred while copying the zip file: {e}")
+            if progress is not None:
+                progress.finish(STATUS_FAILED, f"{type(e).__name__}: {e}")
@@ -1,136 +1,123 @@
 import argparse
+import functools
 import numpy as np
 import torch.cuda
 import os
 import sys
+import time
 from tqdm import tqdm
-from transformers import DetrFeatureExtractor
-from PIL import Image, ImageDraw, ImageOps
 import torchvision.transforms as T
 from project_path import project_dir
-from model.detr import load_model_from_ckpt
-from util.visualize_and_process_bbox import get_bbox_from_output, scale_bbox
+from model.precision import PRECISION_MODES, apply_precision
+from model.student import STUDENT_PRECISION_MODES, Student
+from util.crop_engine import crop_image_with_bbox, get_calibration_pixel_values, load_calibration_images, \
+    load_crop_model, make_crop_record, postprocess_outputs, preprocess_images
+from util.batch_autotuner import add_batch_autotuner_arguments, init_batch_autotuner_from_args, \
+    run_model_with_back_off
+from util.background_detector import add_background_detector_arguments, init_background_detector_from_args
+from util.bbox_metadata_store import STATUS_FAILED, init_metadata_writer
+from util.bbox_store import get_checkpoint_hash
+from util.content_index import ContentIndex, IndexingMetadataWriter, get_crop_params_hash, link_duplicate_outputs, \
+    reuse_indexed_outputs
+from util.crop_metrics import add_metrics_arguments, init_metrics_from_args
+from util.early_exit import add_early_exit_arguments, init_early_exit_from_args
+from util.image_codecs import add_codec_arguments, get_codec
+from util.output_sinks import add_output_sink_arguments, init_output_sink
+from util.parallel_inference import crop_images_in_parallel
+from util.topology import add_topology_arguments, get_available_cores, init_topology_from_args
 from util.loader_for_cropping import init_loader_with_folder_name_and_list_of_images
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 
-def expand_image(args, image, size, direction):
-    border_color = (args.background_color_R, args.background_color_G, args.background_color_B)
-    border_image = None
-    if direction == 'left':
-        border_image = ImageOps.expand(image, border=(size, 0, 0, 0), fill=border_color)
-    elif direction == 'top':
-        border_image = ImageOps.expand(image, border=(0, size, 0, 0), fill=border_color)
-    elif direction == 'right':
-        border_image = ImageOps.expand(image, border=(0, 0, size, 0), fill=border_color)
-    elif direction == 'bottom':
-        border_image = ImageOps.expand(image, border=(0, 0, 0, size), fill=border_color)
-    else:
-        exit("Wrong expand direction.")
-
-    return border_image
-
-
-def rotate_image_and_bbox_if_necesscary(image, left, top, right, bottom):
-    image_size = image.size
-    image = image.rotate(90, expand=True)
-    new_left = top
-    new_right = bottom
-    new_bottom = image_size[0] - left
-    new_top = image_size[0] - right
-
-    return image, new_left, new_top, new_right, new_bottom
-
-
-def change_size_to_4_3(left, top, right, bottom):
-    width = right - left
-    height = bottom - top
-    if width < height / 3 * 4:
-        extend_length = height / 3 * 4 - width
-        left = left - extend_length / 2
-        right = right + extend_length - extend_length / 2
-
-    elif height < width / 4 * 3:
-        extend_length = width / 4 * 3 - height
-        top = top - extend_length / 2
-        bottom = bottom + extend_length - extend_length / 2
-    return left, top, right, bottom
+def crop_and_write(args, sink, metrics, image, bbox, filename, record):
+    """
+    Crop one image and write it to the sink, or only encode it if the sink is written by a single thread.
+    :return: The number of bytes written and the encoded sample, None if the crop is already written.
+    """
+    with metrics.time_stage('crop_pad'):
+        cropped_img = crop_image_with_bbox(args, image, bbox)
+    with metrics.time_stage('encode_write'):
+        if sink.writes_in_workers:
+            return sink.write(filename, cropped_img, record), None
+        return 0, sink.encode(filename, cropped_img, record)
 
 
-def crop_image(args, model, image_loader, feature_extractor, device):
+def crop_image(args, model, image_loader, feature_extractor, device, metrics, metadata_writer, sink,
+               early_exit=None, autotuner=None, encode_executor=None, background_detector=None):
     """
     Crop and save images based on the predicted bounding boxes from the model.
     :param model: Detr model that loaded from the checkpoint.
     :param feature_extractor: A ResNet50 model as a standard image extractor.
+    :param metrics: CropMetrics that records the time of each stage, the throughput and the failures.
+    :param metadata_writer: Writer from util/bbox_metadata_store.py that stores the bbox of each image.
+    :param sink: Sink from util/output_sinks.py that stores the cropped images.
+    :param early_exit: Optional EarlyExitDecoder from util/early_exit.py.
+    :param autotuner: Optional BatchAutotuner from util/batch_autotuner.py that sets the size of the batches of the
+    image loader.
+    :param encode_executor: Optional ThreadPoolExecutor that crops and encodes the images of a batch in parallel.
+    :param background_detector: Optional BackgroundDetector from util/background_detector.py, the model only runs on
+    the images it is not confident about.
     """
     to_pil_image = T.ToPILImage()
-    list_of_original_image_size_and_bbox = []
-    for images, list_of_file_name in tqdm(image_loader):
-        list_of_image_tensor = [image for image in images]
-        encoding = feature_extractor(images=list_of_image_tensor, return_tensors="pt").to(device)
-        pixel_values = encoding["pixel_values"]
-        outputs = model(pixel_values=pixel_values, pixel_mask=None)
+    load_start = time.perf_counter()
+    for images, list_of_file_name, list_of_content_hash in tqdm(image_loader):
+        batch_start = time.perf_counter()
+        metrics.observe_stage('load', batch_start - load_start)
+        metrics.add_bytes_read(sum(os.path.getsize(os.path.join(args.input_dir, filename))
+                                   for filename in list_of_file_name))
+        list_of_image_tensor = list(images)
+        if background_detector is not None:
+            with metrics.time_stage('background_detector'):
+                bboxes, scores, confident = background_detector.detect_batch(list_of_image_tensor)
+            ambiguous = np.flatnonzero(~confident)
+            metrics.increment_counter('background_detector_boxes', len(confident) - len(ambiguous))
+        else:
+            bboxes, scores = None, None
+            ambiguous = np.arange(len(list_of_image_tensor))
+        if len(ambiguous) > 0:
+            list_of_ambiguous_tensor = [list_of_image_tensor[index] for index in ambiguous]
+            with metrics.time_stage('preprocess'):
+                pixel_values, pixel_mask = preprocess_images(feature_extractor, list_of_ambiguous_tensor, device)
+            with metrics.time_stage('inference'):
+                outputs = run_model_with_back_off(model, pixel_values, pixel_mask, args.precision, early_exit,
+                                                  autotuner)
+            if early_exit is not None:
+                for layer in outputs.exit_layers.tolist():
+                    metrics.increment_counter(f'early_exit_layer_{layer}')
+            with metrics.time_stage('postprocess'):
+                model_bboxes, model_scores = postprocess_outputs(outputs, list_of_ambiguous_tensor)
+            if bboxes is None:
+                bboxes, scores = model_bboxes, model_scores
+            else:
+                bboxes[ambiguous], scores[ambiguous] = model_bboxes, model_scores
+        jobs = []
         for index, image_tensor in enumerate(list_of_image_tensor):
-            pred_logit = outputs.logits[index]
-            pred_boxes = outputs.pred_boxes[index]
             image = to_pil_image(image_tensor)
-            bbox = get_bbox_from_output(pred_logit, pred_boxes, image).detach().numpy()
-            left, top, right, bottom = bbox[0], bbox[1], bbox[2], bbox[3]
-            if args.show_bbox:
-                draw = ImageDraw.Draw(image)
-                draw.rectangle((left, top, right, bottom), outline=(255, 0, 0), width=args.width_of_bbox)
-            left, top, right, bottom = scale_bbox(args, left, top, right, bottom)
-
+            bbox = bboxes[index]
             image_size = image.size
 
-            list_of_original_image_size_and_bbox.append({'filename': list_of_file_name[index], 'original_size': image_size, 'bbox': bbox.tolist()})
-            if args.fix_ratio:
-                width = right - left
-                height = bottom - top
-
-                if height > width and args.rotate_image:
-                    image, left, top, right, bottom = rotate_image_and_bbox_if_necesscary(image, left, top, right,
-                                                                                          bottom)
-                    image_size = image.size
-
-                left, top, right, bottom = change_size_to_4_3(left, top, right, bottom)
-                left = round(left)
-                top = round(top)
-                right = round(right)
-                bottom = round(bottom)
-                # if left < 0 or top < 0 or right > image_size[0] or bottom > image_size[1]:
-                #     print("Please crop this image manually: " + f)
-
-            # cropped_img = image.crop((max(left, 0), max(top, 0), min(right, image_size[0]), min(bottom, image_size[1])))
-
-            # Check if width is smaller than the bbox
-
-            if left < 0:
-                border_size = 0 - left
-                right = right - left
-                left = 0
-                image = expand_image(args, image, border_size, 'left')
-
-            if top < 0:
-                border_size = 0 - top
-                bottom = bottom - top
-                top = 0
-                image = expand_image(args, image, border_size, 'top')
-
-            if right > image.size[0]:
-                border_size = right - image.size[0] + 1
-                image = expand_image(args, image, border_size, 'right')
-
-            if bottom > image.size[1]:
-                border_size = bottom - image.size[1] + 1
-                image = expand_image(args, image, border_size, 'bottom')
-
-            cropped_img = image.crop((left, top, right, bottom))
             filename = list_of_file_name[index]
-            cropped_img.save(os.path.join(args.output_dir, filename))
-    with open(os.path.join(args.output_dir, 'size_of_original_image_and_bbox.json'), 'w') as file:
-        json.dump(list_of_original_image_size_and_bbox, file)
-
+            record = make_crop_record(args, filename, image_size, bbox, scores[index], list_of_content_hash[index],
+                                      args.checkpoint_hash)
+            job = functools.partial(crop_and_write, args, sink, metrics, image, bbox, filename, record)
+            jobs.append((record, encode_executor.submit(job) if encode_executor is not None else job))
+        for record, job in jobs:
+            try:
+                bytes_written, members = job.result() if encode_executor is not None else job()
+                if members is not None:
+                    bytes_written = sink.write_encoded(record['filename'], members)
+                metrics.add_bytes_written(bytes_written)
+            except Exception as e:
+                print(f"Failed to crop {record['filename']}: {e}")
+                metrics.record_failure(type(e).__name__)
+                record['status'] = STATUS_FAILED
+            metadata_writer.append(record)
+        metrics.add_images(len(list_of_file_name))
+        metrics.maybe_write_snapshot()
+        if autotuner is not None:
+            autotuner.record_batch(len(list_of_file_name), time.perf_counter() - batch_start)
+        load_start = time.perf_counter()
 
 
 if __name__ == '__main__':
@@ -161,23 +148,130 @@ if __name__ == '__main__':
                         help="Define the background color's G value.")
     parser.add_argument('--background_color_B', type=int, default=245,
                         help="Define the background color's B value.")
-
+    parser.add_argument('--num_inference_workers', type=int, default=1,
+                        help="Number of processes that run the model in parallel, each with its own core set.")
+    parser.add_argument('--threads_per_worker', type=int, default=None,
+                        help="Number of torch threads of each inference worker, default to cores / workers.")
+    parser.add_argument('--start_method', type=str, default='fork', choices=['fork', 'spawn', 'forkserver'],
+                        help="How to start the inference workers, fork shares the model weights copy-on-write.")
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISION_MODES,
+                        help="Precision of the model on CPU, validate it with scripts/validate_precision.py first.")
+    parser.add_argument('--inference_shortest_edge', type=int, default=800,
+                        help="Shortest edge of the image fed to the model, check the accuracy with "
+                             "scripts/sweep_inference_resolution.py before lowering it.")
+    parser.add_argument('--inference_longest_edge', type=int, default=1333,
+                        help="Longest edge of the image fed to the model.")
+    parser.add_argument('--precision_report', type=str, default=None,
+                        help="Report saved by scripts/validate_precision.py, refuse the precision if it is not "
+                             "accepted.")
+    parser.add_argument('--number_of_calibration_images', type=int, default=16,
+                        help="Number of input images used to calibrate the int8_static precision.")
+    parser.add_argument('--metadata_format', type=str, default='json', choices=['json', 'columnar'],
+                        help="json keeps size_of_original_image_and_bbox.json, columnar streams the metadata to "
+                             "row groups in output_dir/bbox_metadata with bounded memory.")
+    parser.add_argument('--dedup_index', type=str, default=None,
+                        help="Path to a sqlite index of the outputs shared by all runs, images whose content was "
+                             "already cropped with the same checkpoint and crop parameters are linked from the "
+                             "existing output instead of going through the model.")
+    add_metrics_arguments(parser)
+    add_early_exit_arguments(parser)
+    add_output_sink_arguments(parser)
+    add_batch_autotuner_arguments(parser)
+    add_topology_arguments(parser)
+    add_codec_arguments(parser)
+    add_background_detector_arguments(parser)
 
     args = parser.parse_args()
+    if args.dedup_index is not None and args.output_format != 'files':
+        parser.error("--dedup_index links existing crop files, it needs --output_format files.")
 
-
-
-
-    image_loader = init_loader_with_folder_name_and_list_of_images(args.input_dir, args.batch_size)
+    if args.precision_report is not None:
+        with open(args.precision_report) as file:
+            precision_report = json.load(file)
+        if not precision_report.get(args.precision, {}).get('accepted', False):
+            exit(f"Precision {args.precision} is not accepted in {args.precision_report}.")
 
     os.makedirs(args.output_dir, exist_ok=True)
 
-    feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
+    # The inference workers apply their topology themselves, the parent process only loads the model.
+    topology = init_topology_from_args(args, args.num_inference_workers, args.threads_per_worker,
+                                       has_loader=args.num_inference_workers == 1)
+    if topology is not None and args.num_inference_workers == 1:
+        topology.apply()
 
-    model = load_model_from_ckpt(args)
+    # A checkpoint of scripts/train_student.py loads the distilled student with its own feature extractor.
+    model, feature_extractor = load_crop_model(args)
+    if isinstance(model, Student) and (args.precision not in STUDENT_PRECISION_MODES or args.early_exit):
+        exit(f"The student model runs in {' or '.join(STUDENT_PRECISION_MODES)}, without --early_exit.")
+    args.checkpoint_hash = get_checkpoint_hash(args.checkpoint_path)
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    device = torch.device('cuda' if torch.cuda.is_available() and args.precision == 'fp32' else 'cpu')
 
     model.to(device)
 
-    crop_image(args, model, image_loader, feature_extractor, device)
+    if args.precision == 'int8_static' and args.num_inference_workers > 1 and args.start_method == 'fork':
+        # The calibration runs the model in this process, forking the workers after it may hang them in OpenMP.
+        print("int8_static calibrates the model before the workers start, use --start_method forkserver.")
+        args.start_method = 'forkserver'
+    if args.precision == 'int8_static':
+        list_of_calibration_images = load_calibration_images(args.input_dir, args.number_of_calibration_images,
+                                                             get_codec(args.codec))
+        model, args.precision = apply_precision(model, args.precision,
+                                                get_calibration_pixel_values(feature_extractor,
+                                                                             list_of_calibration_images))
+    elif args.precision != 'fp32':
+        model, args.precision = apply_precision(model, args.precision)
+
+    metrics = init_metrics_from_args(args)
+    early_exit = init_early_exit_from_args(args)
+    background_detector = init_background_detector_from_args(args)
+    metadata_writer = init_metadata_writer(args, args.output_dir)
+
+    list_of_file_name = sorted(os.listdir(args.input_dir))
+    # The rows of a memmap sink follow the full list of images, before the deduplication.
+    sink = init_output_sink(args, args.output_dir, list_of_file_name)
+    content_hashes = None
+    if args.dedup_index is not None:
+        params_hash = get_crop_params_hash(args)
+        content_index = ContentIndex(args.dedup_index)
+        list_of_file_name, content_hashes, list_of_duplicate_file_name = reuse_indexed_outputs(
+            args, list_of_file_name, content_index, params_hash, metadata_writer, metrics)
+        print(f"Linked {len(content_hashes) - len(list_of_file_name) - len(list_of_duplicate_file_name)} images from "
+              f"the index, {len(list_of_file_name)} images left to crop and {len(list_of_duplicate_file_name)} "
+              f"duplicates of them to link after.")
+        metadata_writer = IndexingMetadataWriter(metadata_writer, content_index, args.output_dir,
+                                                 args.checkpoint_hash, params_hash)
+
+    if args.num_inference_workers > 1:
+        if args.threads_per_worker is None:
+            args.threads_per_worker = max(len(get_available_cores()) // args.num_inference_workers, 1)
+        crop_images_in_parallel(args, model, feature_extractor, device, list_of_file_name, args.num_inference_workers,
+                                args.threads_per_worker, metrics, metadata_writer,
+                                progress_bar=tqdm(total=len(list_of_file_name)), early_exit=early_exit, sink=sink,
+                                topology=topology, background_detector=background_detector)
+    else:
+        autotuner = init_batch_autotuner_from_args(args, metrics=metrics)
+        loader_workers, worker_init_fn, encode_executor = 0, None, None
+        if topology is not None:
+            loader_workers = topology.loader_workers or 0
+            worker_init_fn = topology.get_loader_worker_init_fn()
+            if topology.encode_threads > 1:
+                encode_executor = ThreadPoolExecutor(topology.encode_threads)
+        image_loader = init_loader_with_folder_name_and_list_of_images(args.input_dir, args.batch_size,
+                                                                       list_of_file_name, autotuner, loader_workers,
+                                                                       worker_init_fn, get_codec(args.codec))
+        crop_image(args, model, image_loader, feature_extractor, device, metrics, metadata_writer, sink,
+                   early_exit, autotuner, encode_executor, background_detector)
+        if encode_executor is not None:
+            encode_executor.shutdown()
+
+    if early_exit is not None:
+        early_exit.report()
+    if background_detector is not None:
+        background_detector.report()
+    if args.dedup_index is not None:
+        link_duplicate_outputs(args, list_of_duplicate_file_name, content_hashes, content_index, params_hash,
+                               metadata_writer, metrics)
+    sink.close()
+    metadata_writer.close()
+    metrics.close()
@@ -0,0 +1,216 @@
+"""
+A long-running crop service that loads the model once and shares it between the jobs of a node, over HTTP or a Unix
+socket. Concurrent requests are coalesced into batches by util/inference_batcher.py, decoding, cropping and encoding
+run in the request threads.
+
+POST /detect and POST /crop take the image bytes as the body, or a JSON body {"path": "..."} if --allow_paths is set,
+an optional ?filename= is echoed in the record. /detect returns the record of make_crop_record, /crop also returns the
+crop as base64 JPEG, or as the body with ?format=jpeg (the record is then in the X-Crop-Record header). A full queue
+returns 503 with Retry-After, and a request without a result within --request_timeout returns 504. GET /health and
+GET /metrics (Prometheus text format) report the state of the service.
+"""
+import argparse
+import base64
+import json
+import os
+import socketserver
+import sys
+import time
+import torch
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from project_path import project_dir
+from model.precision import PRECISION_MODES, apply_precision
+from model.student import STUDENT_PRECISION_MODES, Student
+from util.background_detector import add_background_detector_arguments, init_background_detector_from_args
+from util.bbox_store import get_checkpoint_hash, hash_bytes
+from util.crop_engine import add_crop_arguments, crop_image_with_bbox, load_crop_model, make_crop_record, \
+    predict_bboxes_and_scores
+from util.crop_metrics import CropMetrics
+from util.early_exit import add_early_exit_arguments, init_early_exit_from_args
+from util.image_codecs import add_codec_arguments, get_codec
+from util.inference_batcher import InferenceBatcher, QueueFullError
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CropRequestHandler(BaseHTTPRequestHandler):
+    # Set by init_server.
+    args = None
+    batcher = None
+    metrics = None
+    checkpoint_hash = None
+
+    def address_string(self):
+        # The client address of a Unix socket is not a (host, port) pair.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        if self.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_image_bytes(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            if not self.args.allow_paths:
+                raise PermissionError("Reading images from paths is disabled, start the server with --allow_paths.")
+            with open(json.loads(body)['path'], 'rb') as file:
+                return file.read()
+        return body
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/health':
+            self.send_json(200, {'status': 'ok', 'queue_depth': self.batcher.queue_depth(),
+                                 'checkpoint_hash': self.checkpoint_hash})
+        elif path == '/metrics':
+            self.metrics.set_queue_depth('inference_requests', self.batcher.queue_depth())
+            body = self.metrics.to_prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {'error': f"Unknown path {path}."})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ['/detect', '/crop']:
+            self.send_json(404, {'error': f"Unknown path {url.path}."})
+            return
+        start = time.perf_counter()
+        future = None
+        try:
+            image_bytes = self.read_image_bytes()
+            with self.metrics.time_stage('decode'):
+                image = self.codec.decode(image_bytes)
+            future = self.batcher.submit(image)
+            bbox, score = future.result(timeout=self.args.request_timeout)
+        except QueueFullError as e:
+            self.send_json(503, {'error': str(e)}, {'Retry-After': '1'})
+            return
+        except FutureTimeoutError:
+            # Caught before OSError, which TimeoutError is a subclass of. A cancelled request is not run.
+            if future is not None:
+                future.cancel()
+            self.metrics.record_failure('timeout')
+            self.send_json(504, {'error': f"No result within {self.args.request_timeout} seconds."})
+            return
+        except (PermissionError, OSError, ValueError, KeyError) as e:
+            self.metrics.record_failure(type(e).__name__)
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.metrics.record_failure(type(e).__name__)
+            self.send_json(500, {'error': str(e)})
+            return
+
+        record = make_crop_record(self.args, parse_qs(url.query).get('filename', [None])[0], image.size, bbox, score,
+                                  hash_bytes(image_bytes), self.checkpoint_hash)
+        if url.path == '/detect':
+            self.metrics.observe_stage('request', time.perf_counter() - start)
+            self.metrics.add_images(1)
+            self.send_json(200, record)
+            return
+
+        with self.metrics.time_stage('crop_pad'):
+            cropped_img = crop_image_with_bbox(self.args, image, bbox)
+        with self.metrics.time_stage('encode'):
+            data = self.codec.encode(cropped_img, self.args.jpeg_quality)
+        self.metrics.observe_stage('request', time.perf_counter() - start)
+        self.metrics.add_images(1)
+        self.metrics.add_bytes_written(len(data))
+        if parse_qs(url.query).get('format') == ['jpeg']:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('X-Crop-Record', json.dumps(record))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(200, dict(record, crop=base64.b64encode(data).decode()))
+
+
+def init_server(args):
+    model, feature_extractor = load_crop_model(args)
+    if isinstance(model, Student) and (args.precision not in STUDENT_PRECISION_MODES or args.early_exit):
+        raise ValueError(f"The student model runs in {' or '.join(STUDENT_PRECISION_MODES)}, without --early_exit.")
+    device = torch.device('cuda' if torch.cuda.is_available() and args.precision == 'fp32' else 'cpu')
+    model.to(device)
+    if args.precision == 'int8_static':
+        raise ValueError("int8_static needs calibration images, use int8_dynamic for the server.")
+    model, args.precision = apply_precision(model, args.precision)
+    early_exit = init_early_exit_from_args(args)
+    background_detector = init_background_detector_from_args(args)
+    metrics = CropMetrics(job_name='crop_server')
+
+    def predict_batch(list_of_images):
+        bboxes, scores = predict_bboxes_and_scores(model, feature_extractor, list_of_images, device, args.precision,
+                                                   early_exit, background_detector)
+        return list(zip(bboxes, scores))
+
+    CropRequestHandler.args = args
+    CropRequestHandler.batcher = InferenceBatcher(predict_batch, args.max_batch_size, args.max_wait_ms / 1000,
+                                                  args.max_queue_size, metrics).start()
+    CropRequestHandler.metrics = metrics
+    CropRequestHandler.checkpoint_hash = get_checkpoint_hash(args.checkpoint_path)
+    CropRequestHandler.codec = get_codec(args.codec)
+
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        print(f"Serving on unix socket {args.unix_socket}")
+        return ThreadingUnixHTTPServer(args.unix_socket, CropRequestHandler)
+    print(f"Serving on http://{args.host}:{args.port}")
+    return ThreadingHTTPServer((args.host, args.port), CropRequestHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8642)
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help="Serve on this Unix socket instead of TCP.")
+    parser.add_argument('--max_batch_size', type=int, default=8)
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help="Maximum time that a request waits for the batch to fill.")
+    parser.add_argument('--max_queue_size', type=int, default=64,
+                        help="Number of waiting requests above which the server answers 503.")
+    parser.add_argument('--request_timeout', type=float, default=60)
+    parser.add_argument('--allow_paths', default=False, action='store_true',
+                        help="Accept JSON requests with a path to an image on this node.")
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISION_MODES)
+    parser.add_argument('--inference_shortest_edge', type=int, default=800)
+    parser.add_argument('--inference_longest_edge', type=int, default=1333)
+    parser.add_argument('--verbose', default=False, action='store_true',
+                        help="Log every request.")
+    add_crop_arguments(parser)
+    add_early_exit_arguments(parser)
+    add_background_detector_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+
+    server = init_server(args)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        CropRequestHandler.batcher.stop()
@@ -0,0 +1,234 @@
+"""
+Progress of a cluster run of copy_to_local_then_crop_images_6M.py, aggregated from the manifests that the nodes write
+to --progress_dir: parts done, copying their input, in progress, stalled and failed, images per second per node, ETA,
+failure hotspots and stragglers. Only the manifests that changed since the last report are read again, the manifest of
+a finished part is read once, so --watch can follow a multi-day run on slow shared storage.
+"""
+import argparse
+import collections
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from project_path import project_dir
+from util.crop_progress import STATUS_COPYING, STATUS_DONE, STATUS_FAILED, STATUS_RUNNING, load_manifest
+
+MANIFEST_NAME_PATTERN = re.compile(r'^part(\d+)\.json$')
+
+
+class ManifestCache:
+    def __init__(self, progress_dir, cache_path=None):
+        """
+        :param progress_dir: Folder of the manifests written with --progress_dir.
+        :param cache_path: Local file to keep the manifests between two runs of the script, or None.
+        """
+        self.progress_dir = progress_dir
+        self.cache_path = cache_path
+        # Path of the manifest -> [modification time in ns, size, record].
+        self.entries = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as file:
+                self.entries = json.load(file)
+
+    def refresh(self):
+        """
+        :return: The records of all the manifests and the number of manifests that were read from the storage.
+        """
+        records = []
+        number_of_reads = 0
+        seen_paths = set()
+        with os.scandir(self.progress_dir) as directory_entries:
+            for directory_entry in directory_entries:
+                if MANIFEST_NAME_PATTERN.match(directory_entry.name) is None:
+                    continue
+                stat = directory_entry.stat()
+                seen_paths.add(directory_entry.path)
+                entry = self.entries.get(directory_entry.path)
+                if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                    record = load_manifest(directory_entry.path)
+                    number_of_reads += 1
+                    if record is not None:
+                        entry = [stat.st_mtime_ns, stat.st_size, record]
+                        self.entries[directory_entry.path] = entry
+                if entry is not None:
+                    records.append(entry[2])
+        for path in set(self.entries) - seen_paths:
+            del self.entries[path]
+        return records, number_of_reads
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with open(self.cache_path + '.tmp', 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(self.cache_path + '.tmp', self.cache_path)
+
+
+def load_number_of_pending_parts(list_of_zip_index_path):
+    if list_of_zip_index_path is None or not os.path.exists(list_of_zip_index_path):
+        return None
+    with open(list_of_zip_index_path) as file:
+        return len(json.load(file))
+
+
+def summarize(records, now, number_of_pending_parts=None, stale_seconds=900, straggler_fraction=0.5,
+              number_of_hotspots=5):
+    """
+    :param records: Records of the manifests of the parts.
+    :param number_of_pending_parts: Parts left in list_of_zip_index.json, None if unknown.
+    :param stale_seconds: A running part whose manifest was not updated for this long is reported as stalled, a
+    copying part is not since its manifest is only written again once the copy is done.
+    :param straggler_fraction: A running part slower than this fraction of the median running part is a straggler.
+    :return: Dictionary of the status of the run.
+    """
+    parts_by_status = collections.defaultdict(list)
+    for record in records:
+        status = record['status']
+        if status == STATUS_RUNNING and now - record['update_time'] > stale_seconds:
+            status = 'stalled'
+        parts_by_status[status].append(record)
+    running = parts_by_status[STATUS_RUNNING]
+
+    nodes = collections.defaultdict(lambda: {'running_parts': [], 'parts_done': 0, 'images_per_second': 0.0,
+                                             'images_done': 0, 'images_failed': 0, 'images_cropped_in_parts_done': 0,
+                                             'seconds_in_parts_done': 0.0})
+    for record in records:
+        node = nodes[record['hostname']]
+        node['images_done'] += record['images_done']
+        node['images_failed'] += record['images_failed']
+        if record['status'] == STATUS_DONE:
+            node['parts_done'] += 1
+            node['images_cropped_in_parts_done'] += record['images_cropped']
+            node['seconds_in_parts_done'] += record['update_time'] - record['start_time']
+    for record in running:
+        nodes[record['hostname']]['running_parts'].append(record['part'])
+        nodes[record['hostname']]['images_per_second'] += record['recent_images_per_second']
+    images_per_second = sum(node['images_per_second'] for node in nodes.values())
+
+    # The parts that are pending or failed are assumed to have as many images as the parts whose size is known.
+    known_totals = [record['total_images'] for record in records if record['total_images'] is not None]
+    mean_images_per_part = statistics.mean(known_totals) if known_totals else None
+    images_left = 0
+    images_left_is_known = mean_images_per_part is not None
+    for record in records:
+        if record['status'] == STATUS_DONE:
+            continue
+        if record['total_images'] is not None:
+            images_left += max(record['total_images'] - record['images_done'], 0)
+        elif images_left_is_known:
+            images_left += mean_images_per_part
+    if number_of_pending_parts is None:
+        images_left_is_known = False
+    elif images_left_is_known:
+        images_left += number_of_pending_parts * mean_images_per_part
+    eta_seconds = images_left / images_per_second if images_left_is_known and images_per_second > 0 else None
+
+    stragglers = [dict(record, reason='stalled') for record in parts_by_status['stalled']]
+    rates = [record['recent_images_per_second'] for record in running]
+    median_images_per_second = statistics.median(rates) if rates else 0.0
+    for record in running:
+        if record['recent_images_per_second'] < straggler_fraction * median_images_per_second:
+            stragglers.append(dict(record, reason='slow'))
+
+    failure_reasons = collections.Counter()
+    for record in records:
+        failure_reasons.update(record['failures'])
+    hotspots = sorted((record for record in records if record['images_failed'] > 0),
+                      key=lambda record: record['images_failed'] / max(record['images_done']
+                                                                        + record['images_failed'], 1),
+                      reverse=True)[:number_of_hotspots]
+
+    return {'time': now, 'parts': {status: sorted(record['part'] for record in parts)
+                                   for status, parts in parts_by_status.items() if parts},
+            'number_of_pending_parts': number_of_pending_parts,
+            'images_done': sum(record['images_done'] for record in records),
+            'images_failed': sum(record['images_failed'] for record in records),
+            'images_left': images_left if images_left_is_known else None,
+            'images_per_second': images_per_second, 'median_part_images_per_second': median_images_per_second,
+            'eta_seconds': eta_seconds, 'nodes': dict(nodes), 'stragglers': stragglers,
+            'failure_reasons': dict(failure_reasons), 'failure_hotspots': hotspots}
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "unknown"
+    hours, remainder = divmod(int(seconds), 3600)
+    return f"{hours // 24}d {hours % 24}h {remainder // 60}m" if hours >= 24 else f"{hours}h {remainder // 60}m"
+
+
+def print_summary(summary):
+    parts = summary['parts']
+    print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(summary['time'])))
+    print(f"Parts: {len(parts.get(STATUS_DONE, []))} done, {len(parts.get(STATUS_COPYING, []))} copying, "
+          f"{len(parts.get(STATUS_RUNNING, []))} in progress, "
+          f"{len(parts.get('stalled', []))} stalled, {len(parts.get(STATUS_FAILED, []))} failed, "
+          f"{summary['number_of_pending_parts'] if summary['number_of_pending_parts'] is not None else 'unknown'} "
+          f"pending.")
+    if parts.get(STATUS_FAILED):
+        print(f"Failed parts: {parts[STATUS_FAILED]}")
+    print(f"Images: {summary['images_done']} done, {summary['images_failed']} failed, "
+          f"{int(summary['images_left']) if summary['images_left'] is not None else 'unknown'} left.")
+    print(f"Throughput: {summary['images_per_second']:.1f} images/s, ETA {format_seconds(summary['eta_seconds'])}.")
+
+    print("Nodes:")
+    for hostname, node in sorted(summary['nodes'].items()):
+        mean_images_per_second = node['images_cropped_in_parts_done'] / node['seconds_in_parts_done'] \
+            if node['seconds_in_parts_done'] > 0 else 0.0
+        print(f"  {hostname}: {node['images_per_second']:.1f} images/s on parts {node['running_parts']}, "
+              f"{node['parts_done']} parts done at {mean_images_per_second:.1f} images/s, "
+              f"{node['images_failed']} images failed")
+
+    if summary['stragglers']:
+        print(f"Stragglers (median part {summary['median_part_images_per_second']:.1f} images/s):")
+        for record in summary['stragglers']:
+            print(f"  part{record['part']} on {record['hostname']}: {record['reason']}, "
+                  f"{record['recent_images_per_second']:.1f} images/s, {record['images_done']}/"
+                  f"{record['total_images']} images, updated {format_seconds(summary['time'] - record['update_time'])}"
+                  f" ago")
+
+    if summary['failure_hotspots']:
+        print(f"Failure reasons: {summary['failure_reasons']}")
+        print("Failure hotspots:")
+        for record in summary['failure_hotspots']:
+            print(f"  part{record['part']} on {record['hostname']}: {record['images_failed']} failed of "
+                  f"{record['images_done'] + record['images_failed']}, {record['failures']}")
+    for record in summary['stragglers'] + summary['failure_hotspots']:
+        if record.get('error'):
+            print(f"  part{record['part']}: {record['error']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--progress_dir', type=str, required=True,
+                        help="The --progress_dir of copy_to_local_then_crop_images_6M.py.")
+    parser.add_argument('--list_of_zip_index', type=str, default=None,
+                        help="The --list_of_zip_index of the run, to count the parts that are not started yet.")
+    parser.add_argument('--cache_path', type=str, default=None,
+                        help="Local file to keep the manifests between two runs, only the changed ones are read.")
+    parser.add_argument('--stale_minutes', type=float, default=15,
+                        help="Report a running part as stalled if its manifest is older.")
+    parser.add_argument('--straggler_fraction', type=float, default=0.5,
+                        help="Report a running part as a straggler below this fraction of the median images/s.")
+    parser.add_argument('--number_of_hotspots', type=int, default=5)
+    parser.add_argument('--watch', type=float, default=None,
+                        help="Print the status again every this many seconds.")
+    parser.add_argument('--json', default=False, action='store_true',
+                        help="Print the status as JSON instead of text.")
+    args = parser.parse_args()
+
+    manifest_cache = ManifestCache(args.progress_dir, args.cache_path)
+    while True:
+        records, number_of_reads = manifest_cache.refresh()
+        manifest_cache.save()
+        summary = summarize(records, time.time(), load_number_of_pending_parts(args.list_of_zip_index),
+                            args.stale_minutes * 60, args.straggler_fraction, args.number_of_hotspots)
+        if args.json:
+            print(json.dumps(summary))
+        else:
+            print_summary(summary)
+            print(f"Read {number_of_reads} of {len(records)} manifests.\n")
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
@@ -7,9 +7,15 @@ import os
 import sys
 from transformers import DetrFeatureExtractor
 from project_path import project_dir
-from util.evaluation_support import prepare_for_evaluation
+from util.evaluation_support import prepare_for_evaluation, get_top1_iou_with_ground_truth
 from util.coco_dataset import DetectionDataset
+from util.early_exit import add_early_exit_arguments, init_early_exit_from_args
+from util.fast_evaluation import add_crop_geometry_arguments, fast_evaluation
 from model.detr import Detr, load_model_from_ckpt
+from model.precision import get_inference_context
+from model.student import is_student_checkpoint, load_student_from_ckpt
+from util.distillation_dataset import StudentDetectionDataset, student_collate_fn
+from util.topology import add_topology_arguments, init_topology_from_args
 from coco_eval import CocoEvaluator
 
 
@@ -24,7 +30,7 @@ def collate_fn(batch):
     return batch
 
 
-def initialize_dataloader(args):
+def initialize_dataloader(args, worker_init_fn=None):
     args.train_folder = os.path.join(args.data_dir, 'train')
     args.val_folder = os.path.join(args.data_dir, 'val')
     feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
@@ -35,8 +41,10 @@ def initialize_dataloader(args):
     print("Number of training examples:", len(train_dataset))
     print("Number of validation examples:", len(val_dataset))
 
-    train_dataloader = DataLoader(train_dataset, collate_fn=collate_fn, batch_size=args.batch_size, num_workers=args.number_of_workers, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, collate_fn=collate_fn, num_workers=args.number_of_workers, batch_size=args.batch_size)
+    train_dataloader = DataLoader(train_dataset, collate_fn=collate_fn, batch_size=args.batch_size, num_workers=args.number_of_workers, shuffle=True,
+                                  worker_init_fn=worker_init_fn)
+    val_dataloader = DataLoader(val_dataset, collate_fn=collate_fn, num_workers=args.number_of_workers, batch_size=args.batch_size,
+                                worker_init_fn=worker_init_fn)
     categories = train_dataset.coco.cats
     id2label = {k: v['name'] for k, v in categories.items()}
 
@@ -57,12 +65,16 @@ def initialize_trainer(args):
                        default_root_dir=args.output_dir, accelerator="auto")
 
 
-def evaluation(model, val_dataset, val_dataloader, feature_extractor):
+def evaluation(model, val_dataset, val_dataloader, feature_extractor, precision='fp32'):
+    """
+    :return: Dictionary with the COCO AP and the mean IoU of the top-1 box against the ground truth box.
+    """
     iou_types = ['bbox']
     coco_evaluator = CocoEvaluator(val_dataset.coco, iou_types)
     # model
     model.eval()
     print("Running evaluation...")
+    list_of_iou = []
     for idx, batch in enumerate(tqdm(val_dataloader)):
         # get the inputs
         pixel_values = batch["pixel_values"]
@@ -70,11 +82,14 @@ def evaluation(model, val_dataset, val_dataloader, feature_extractor):
         labels = [{k: v for k, v in t.items()} for t in
                   batch["labels"]]
         # forward pass
-        outputs = model.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        with torch.inference_mode(), get_inference_context(precision):
+            outputs = model.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
 
         orig_target_sizes = torch.stack([target["orig_size"] for target in labels], dim=0)
         results = feature_extractor.post_process(outputs, orig_target_sizes)  # convert outputs of model to COCO api
 
+        list_of_iou.append(get_top1_iou_with_ground_truth(results, labels))
+
         res = {target['image_id'].item(): output for target, output in zip(labels, results)}
         res = prepare_for_evaluation(res)
         coco_evaluator.update(res)
@@ -82,20 +97,54 @@ def evaluation(model, val_dataset, val_dataloader, feature_extractor):
     coco_evaluator.synchronize_between_processes()
     coco_evaluator.accumulate()
     coco_evaluator.summarize()
+    mean_iou = torch.cat(list_of_iou).mean().item()
+    print(f"Mean IoU of the top-1 box: {mean_iou:.4f}")
+    return {'AP': coco_evaluator.coco_eval['bbox'].stats[0], 'mean_iou': mean_iou}
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_dir', type=str, required=True,
                         help="path to the directory that contains the split data.")
-    parser.add_argument('--batch_size', type=str, default=4)
+    parser.add_argument('--batch_size', type=int, default=4)
     parser.add_argument('--gpus', type=int, default=1)
     parser.add_argument('--number_of_workers', type=int, default=4)
     parser.add_argument('--checkpoint_path', type=str, required=True,
-                        help="Path to the checkpoint.")
+                        help="Path to the checkpoint, of the Detr model or of the student of scripts/train_student.py.")
+    parser.add_argument('--fast', default=False, action='store_true',
+                        help="Evaluate only the top-1 box of each image in a single pass: mean IoU, the fraction of "
+                             "crops containing the ground truth box and the COCO AP of the top-1 boxes.")
+    add_crop_geometry_arguments(parser)
+    add_early_exit_arguments(parser)
+    add_topology_arguments(parser)
     args = parser.parse_args()
-    _, val_dataset, val_dataloader, feature_extractor, _ = initialize_dataloader(args)
+    if args.early_exit and not args.fast:
+        parser.error("--early_exit only applies to the top-1 evaluation, add --fast.")
+    topology = init_topology_from_args(args)
+    worker_init_fn = None
+    if topology is not None:
+        topology.apply()
+        if topology.loader_workers is not None:
+            args.number_of_workers = topology.loader_workers
+        worker_init_fn = topology.get_loader_worker_init_fn()
+    checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+    if is_student_checkpoint(checkpoint):
+        # The student only predicts one box per image, it always gets the top-1 evaluation of --fast.
+        if args.early_exit:
+            parser.error("--early_exit only applies to the Detr model.")
+        model = load_student_from_ckpt(args, checkpoint)
+        val_dataset = StudentDetectionDataset(img_folder=os.path.join(args.data_dir, 'val'),
+                                              feature_extractor=model.get_feature_extractor())
+        val_dataloader = DataLoader(val_dataset, collate_fn=student_collate_fn, batch_size=args.batch_size,
+                                    num_workers=args.number_of_workers, worker_init_fn=worker_init_fn)
+        fast_evaluation(model, val_dataset, val_dataloader, args)
+    else:
+        _, val_dataset, val_dataloader, feature_extractor, _ = initialize_dataloader(args, worker_init_fn)
 
-    model = load_model_from_ckpt(args)
+        model = load_model_from_ckpt(args, checkpoint)
 
-    evaluation(model, val_dataset, val_dataloader, feature_extractor)
+        if args.fast:
+            fast_evaluation(model, val_dataset, val_dataloader, args,
+                            early_exit=init_early_exit_from_args(args))
+        else:
+            evaluation(model, val_dataset, val_dataloader, feature_extractor)
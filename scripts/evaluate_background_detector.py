@@ -0,0 +1,107 @@
+"""
+Compare the boxes of the background subtraction detector with the boxes of the model and the ground truth on the
+validation split. For each confidence threshold it reports the fraction of images that would skip the model, how well
+their boxes agree with the model and with the ground truth, the IoU of the combined pipeline and its expected speedup.
+"""
+import argparse
+import json
+import sys
+import time
+import numpy as np
+import torch
+from tqdm import tqdm
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from util.background_detector import BackgroundDetector, add_background_detector_arguments
+from util.crop_engine import init_feature_extractor, predict_bboxes_and_scores
+from util.evaluation_support import box_iou_for_pairs
+from sweep_inference_resolution import load_val_images_and_ground_truth
+
+
+def iou(boxes_a, boxes_b):
+    return box_iou_for_pairs(torch.from_numpy(boxes_a), torch.from_numpy(boxes_b)).numpy()
+
+
+def evaluate_threshold(threshold, confidences, iou_with_model, detector_iou, model_iou, detector_seconds,
+                       model_seconds):
+    """
+    :param detector_iou: IoU of the boxes of the detector with the ground truth, model_iou the same for the model.
+    :param detector_seconds: Time of the detector per image, model_seconds the same for the model.
+    """
+    confident = confidences >= threshold
+    coverage = float(confident.mean())
+    pipeline_iou = np.where(confident, detector_iou, model_iou)
+    result = {'min_confidence': threshold, 'coverage': coverage,
+              'pipeline_mean_iou': float(pipeline_iou.mean()),
+              'pipeline_iou_above_0.75': float((pipeline_iou > 0.75).mean()),
+              'model_mean_iou': float(model_iou.mean()),
+              'expected_speedup': model_seconds / (detector_seconds + (1 - coverage) * model_seconds)}
+    if confident.any():
+        result.update({'agreement_mean_iou': float(iou_with_model[confident].mean()),
+                       'agreement_iou_above_0.75': float((iou_with_model[confident] > 0.75).mean()),
+                       'agreement_iou_above_0.9': float((iou_with_model[confident] > 0.9).mean()),
+                       'detector_mean_iou_on_confident': float(detector_iou[confident].mean()),
+                       'model_mean_iou_on_confident': float(model_iou[confident].mean())})
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="path to the directory that contains the split data.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--inference_shortest_edge', type=int, default=800)
+    parser.add_argument('--inference_longest_edge', type=int, default=1333)
+    parser.add_argument('--confidence_thresholds', type=float, nargs='+', default=[0.5, 0.7, 0.8, 0.9, 0.95],
+                        help="Minimum confidences of the detector to evaluate.")
+    parser.add_argument('--output_json', type=str, default=None,
+                        help="Optional path to save the results.")
+    add_background_detector_arguments(parser)
+    args = parser.parse_args()
+
+    list_of_images, ground_truth_boxes = load_val_images_and_ground_truth(args)
+    ground_truth_boxes = ground_truth_boxes.numpy()
+
+    detector = BackgroundDetector(color_threshold=args.background_color_threshold,
+                                  downscale_edge=args.background_downscale_edge)
+    start = time.perf_counter()
+    detector_bboxes, confidences, _ = detector.detect_batch(list_of_images)
+    detector_seconds = (time.perf_counter() - start) / len(list_of_images)
+
+    model = load_model_from_ckpt(args)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device)
+    feature_extractor = init_feature_extractor(args.inference_shortest_edge, args.inference_longest_edge)
+    # Warm up, the first forward pass is slower.
+    predict_bboxes_and_scores(model, feature_extractor, list_of_images[:args.batch_size], device)
+    list_of_bboxes = []
+    start = time.perf_counter()
+    for batch_start in tqdm(range(0, len(list_of_images), args.batch_size), desc="Model"):
+        bboxes, _ = predict_bboxes_and_scores(model, feature_extractor,
+                                              list_of_images[batch_start: batch_start + args.batch_size], device)
+        list_of_bboxes.append(bboxes)
+    model_seconds = (time.perf_counter() - start) / len(list_of_images)
+    model_bboxes = np.concatenate(list_of_bboxes)
+
+    iou_with_model = iou(detector_bboxes, model_bboxes)
+    detector_iou = iou(detector_bboxes, ground_truth_boxes)
+    model_iou = iou(model_bboxes, ground_truth_boxes)
+    print(f"{len(list_of_images)} images, detector {detector_seconds * 1000:.1f} ms/image, "
+          f"model {model_seconds * 1000:.1f} ms/image")
+    results = []
+    for threshold in args.confidence_thresholds:
+        result = evaluate_threshold(threshold, confidences, iou_with_model, detector_iou, model_iou,
+                                    detector_seconds, model_seconds)
+        results.append(result)
+        print(f"min_confidence {threshold}: {result['coverage']:.1%} of the images skip the model, "
+              f"agreement IoU {result.get('agreement_mean_iou', float('nan')):.4f} "
+              f"(IoU>0.75 {result.get('agreement_iou_above_0.75', float('nan')):.3f}), "
+              f"pipeline IoU {result['pipeline_mean_iou']:.4f} vs model {result['model_mean_iou']:.4f}, "
+              f"expected speedup {result['expected_speedup']:.1f}x")
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as file:
+            json.dump({'detector_ms_per_image': detector_seconds * 1000, 'model_ms_per_image': model_seconds * 1000,
+                       'results': results}, file, indent=4)
@@ -0,0 +1,126 @@
+"""
+Add new TORAS annotation exports to a dataset built by scripts/split_data.py without rebuilding it.
+New images get fresh ids and a split from the hash of their file name, and only they are linked, copied or resized.
+Images that are already in the dataset keep their id and split, and are only placed again (which replaces their
+resized copy) if their source file or their annotation changed.
+"""
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from project_path import project_dir
+from util.dataset_builder import SPLIT_FILE_NAMES, complete_coco_annotations, hash_annotations, hash_split, \
+    load_manifest, prepare_image, remove_empty_annotations, save_manifest, write_json_atomically
+
+
+def load_export(input_dir):
+    """
+    Load the processed annotation file of the export, or complete the raw TORAS export.
+    """
+    processed_path = os.path.join(input_dir, "coco_annotations_processed.json")
+    if os.path.exists(processed_path):
+        with open(processed_path) as file:
+            return json.load(file)
+    with open(os.path.join(input_dir, "coco_annotations.json")) as file:
+        coco_annotation_dict = json.load(file)
+    complete_coco_annotations(coco_annotation_dict)
+    return coco_annotation_dict
+
+
+def load_split_files(dataset_name):
+    """
+    :return: Dictionary from split to its annotation dictionary, with the images and annotations keyed by image id.
+    """
+    splits = {}
+    for split, file_name in SPLIT_FILE_NAMES.items():
+        with open(os.path.join(dataset_name, split, file_name)) as file:
+            split_dict = json.load(file)
+        annotations_by_image_id = {}
+        for annotation in split_dict['annotations']:
+            annotations_by_image_id.setdefault(annotation['image_id'], []).append(annotation)
+        splits[split] = {'categories': split_dict['categories'],
+                         'images': {image['id']: image for image in split_dict['images']},
+                         'annotations': annotations_by_image_id}
+    return splits
+
+
+def is_unchanged(entry, src, annotations):
+    stat = os.stat(src)
+    return entry['source_path'] == os.path.abspath(src) and entry['source_size'] == stat.st_size and \
+        entry['source_mtime_ns'] == stat.st_mtime_ns and entry['annotation_hash'] == hash_annotations(annotations)
+
+
+def ingest_export(input_dir, manifest, splits, file_name_to_id, images_to_place):
+    """
+    Merge one export into the splits.
+    :param file_name_to_id: Dictionary from file name to image id of the dataset, updated with the new images.
+    :param images_to_place: Dictionary from file name to (input_dir, split, image, annotations) of the images that have
+    to be placed, updated with the new and changed images of the export. A later export wins if a file name appears
+    in several of them.
+    """
+    build_options = manifest['build_options']
+    coco_annotation_dict = load_export(input_dir)
+    images, annotations = remove_empty_annotations(coco_annotation_dict['images'],
+                                                   coco_annotation_dict['annotations'], manifest['next_id'])
+    for image, annotation in zip(images, annotations):
+        file_name = image['file_name']
+        entry = manifest['images'].get(file_name)
+        if file_name not in file_name_to_id:
+            split = hash_split(file_name, build_options['val_fraction'], build_options['seed'])
+            manifest['next_id'] = image['id'] + 1
+        elif file_name not in images_to_place and is_unchanged(entry, os.path.join(input_dir, file_name),
+                                                               [annotation]):
+            continue
+        else:
+            split = images_to_place[file_name][1] if file_name in images_to_place else entry['split']
+            image['id'] = annotation['id'] = annotation['image_id'] = file_name_to_id[file_name]
+        file_name_to_id[file_name] = image['id']
+        splits[split]['images'][image['id']] = image
+        splits[split]['annotations'][image['id']] = [annotation]
+        images_to_place[file_name] = (input_dir, split, image, [annotation])
+
+
+def ingest_annotations(args):
+    manifest = load_manifest(args.dataset_name)
+    build_options = manifest['build_options']
+    splits = load_split_files(args.dataset_name)
+    file_name_to_id = {image['file_name']: image_id for split_dict in splits.values()
+                       for image_id, image in split_dict['images'].items()}
+
+    images_to_place = {}
+    for input_dir in args.input_dirs:
+        ingest_export(input_dir, manifest, splits, file_name_to_id, images_to_place)
+
+    def place(item):
+        input_dir, split, image, annotations = item
+        entry = prepare_image(input_dir, os.path.join(args.dataset_name, split), image, annotations,
+                              build_options['link_mode'], build_options['resize_shortest_edge'],
+                              build_options['resize_longest_edge'])
+        return image['file_name'], dict(entry, split=split)
+
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        manifest['images'].update(executor.map(place, images_to_place.values()))
+
+    for split, file_name in SPLIT_FILE_NAMES.items():
+        split_dict = splits[split]
+        write_json_atomically(os.path.join(args.dataset_name, split, file_name),
+                              {'images': list(split_dict['images'].values()),
+                               'categories': split_dict['categories'],
+                               'annotations': [annotation for annotations in split_dict['annotations'].values()
+                                               for annotation in annotations]})
+    save_manifest(args.dataset_name, manifest)
+    print(f"Placed {len(images_to_place)} new or changed images, the dataset has "
+          f"{len(splits['train']['images'])} training and {len(splits['val']['images'])} validation images.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_name', type=str, required=True,
+                        help="Dataset built by scripts/split_data.py.")
+    parser.add_argument('--input_dirs', type=str, nargs='+', required=True,
+                        help="Folders of the new exports, each with its images and coco_annotations.json.")
+    parser.add_argument('--num_workers', type=int, default=8,
+                        help="Number of threads that link, copy or resize the images.")
+    args = parser.parse_args()
+
+    ingest_annotations(args)
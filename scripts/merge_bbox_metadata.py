@@ -0,0 +1,42 @@
+"""
+Merge the columnar bbox metadata of several parts into one store. Old size_of_original_image_and_bbox.json files
+can be converted and merged as well.
+"""
+import argparse
+import json
+import os
+import sys
+from tqdm import tqdm
+from project_path import project_dir
+from util.bbox_metadata_store import ColumnarBboxWriter, merge_columnar_stores
+
+
+def convert_json_to_columnar_store(json_path, store_dir):
+    with open(json_path) as file:
+        list_of_original_image_size_and_bbox = json.load(file)
+    checkpoint_hash = list_of_original_image_size_and_bbox[0].get('checkpoint_hash') \
+        if list_of_original_image_size_and_bbox else None
+    writer = ColumnarBboxWriter(store_dir, checkpoint_hash=checkpoint_hash)
+    for record in list_of_original_image_size_and_bbox:
+        writer.append(record)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--store_dirs', type=str, nargs='*', default=[],
+                        help="bbox_metadata folders written with --metadata_format columnar.")
+    parser.add_argument('--json_files', type=str, nargs='*', default=[],
+                        help="size_of_original_image_and_bbox.json files to convert and merge.")
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help="Folder of the merged store.")
+    args = parser.parse_args()
+
+    list_of_store_dirs = list(args.store_dirs)
+    for index, json_path in enumerate(tqdm(args.json_files, desc="Converting json files")):
+        store_dir = os.path.join(args.output_dir + '_converted', f'{index:05d}')
+        convert_json_to_columnar_store(json_path, store_dir)
+        list_of_store_dirs.append(store_dir)
+
+    merge_columnar_stores(list_of_store_dirs, args.output_dir)
+    print(f"Merged {len(list_of_store_dirs)} stores into {args.output_dir}.")
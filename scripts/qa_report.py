@@ -0,0 +1,227 @@
+"""
+Headless QA report of a crop run: sample N images, draw their bounding box (red) and crop box (green) on a thumbnail
+of the original image, and write contact sheets and a static HTML index that can be opened from shared storage.
+
+    python scripts/qa_report.py --input_dir Part_2 --run_dir Part_2_cropped --report_dir Part_2_qa
+
+The boxes come from the metadata of the run (bbox_metadata or size_of_original_image_and_bbox.json). Images without
+a stored box go through the model if --checkpoint_path is given, and are left out otherwise. The sheets are drawn in
+a process pool with PIL, without matplotlib.
+"""
+import argparse
+import functools
+import html
+import multiprocessing
+import os
+import random
+import sys
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from util.bbox_metadata_store import STATUS_FAILED
+from util.bbox_store import load_bbox_store
+from util.crop_engine import add_crop_arguments, init_feature_extractor, make_crop_record, predict_bboxes_and_scores
+from util.image_codecs import add_codec_arguments, get_codec
+
+CAPTION_HEIGHT = 14
+SHEET_BACKGROUND = (48, 48, 48)
+BBOX_COLOR = (255, 0, 0)
+CROP_BOX_COLOR = (0, 200, 0)
+
+
+def find_metadata_path(run_dir):
+    for name in ['bbox_metadata', 'size_of_original_image_and_bbox.json']:
+        if os.path.exists(os.path.join(run_dir, name)):
+            return os.path.join(run_dir, name)
+    return None
+
+
+def sample_filenames(list_of_file_name, records, number_of_images, number_of_lowest_scores, seed):
+    """
+    :return: The filenames with the lowest scores, and a random sample of the other filenames.
+    """
+    scored = [filename for filename in list_of_file_name
+              if filename in records and not np.isnan(records[filename].get('score', np.nan))]
+    lowest = sorted(scored, key=lambda filename: records[filename]['score'])[:number_of_lowest_scores]
+    lowest_set = set(lowest)
+    remaining = [filename for filename in list_of_file_name if filename not in lowest_set]
+    sample = random.Random(seed).sample(remaining, min(number_of_images, len(remaining)))
+    return lowest, sorted(sample)
+
+
+def predict_missing_records(args, list_of_file_name, records):
+    """
+    Run the model on the images of list_of_file_name that have no stored box, and add their records.
+    """
+    model = load_model_from_ckpt(args)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device)
+    feature_extractor = init_feature_extractor()
+    codec = get_codec(args.codec)
+    for start in tqdm(range(0, len(list_of_file_name), args.batch_size), desc="Predicting missing boxes"):
+        batch = list_of_file_name[start: start + args.batch_size]
+        list_of_images = [codec.read(os.path.join(args.input_dir, filename)) for filename in batch]
+        bboxes, scores = predict_bboxes_and_scores(model, feature_extractor, list_of_images, device)
+        for filename, image, bbox, score in zip(batch, list_of_images, bboxes, scores):
+            records[filename] = make_crop_record(args, filename, image.size, bbox, score)
+
+
+def draw_cell(args, codec, filename, record):
+    """
+    :return: Thumbnail of the original image with its boxes drawn, and the error message if it can not be read.
+    """
+    cell = Image.new('RGB', (args.thumbnail_size, args.thumbnail_size + CAPTION_HEIGHT), SHEET_BACKGROUND)
+    draw = ImageDraw.Draw(cell)
+    try:
+        image = codec.read(os.path.join(args.input_dir, filename), args.decode_scale)
+    except Exception as e:
+        draw.text((4, args.thumbnail_size // 2), "unreadable", fill=BBOX_COLOR)
+        draw.text((2, args.thumbnail_size), filename[:40], fill=(255, 255, 255))
+        return cell, f"{type(e).__name__}: {e}"
+    original_width, original_height = record.get('original_size', image.size)
+    image.thumbnail((args.thumbnail_size, args.thumbnail_size))
+    scale_x, scale_y = image.size[0] / original_width, image.size[1] / original_height
+    offset_x, offset_y = (args.thumbnail_size - image.size[0]) // 2, (args.thumbnail_size - image.size[1]) // 2
+    cell.paste(image, (offset_x, offset_y))
+
+    def to_cell(box):
+        return [offset_x + box[0] * scale_x, offset_y + box[1] * scale_y,
+                offset_x + box[2] * scale_x, offset_y + box[3] * scale_y]
+
+    # The crop box of a rotated image is in the rotated coordinates, only the bbox is drawn then.
+    if record.get('crop_box') is not None and not record.get('rotated', False) and any(record['crop_box']):
+        draw.rectangle(to_cell(record['crop_box']), outline=CROP_BOX_COLOR, width=2)
+    draw.rectangle(to_cell(record['bbox']), outline=BBOX_COLOR, width=2)
+    score = record.get('score')
+    caption = filename[:32] if score is None or np.isnan(score) else f"{score:.2f} {filename[:28]}"
+    if record.get('status') == STATUS_FAILED:
+        caption = f"FAILED {caption}"
+    draw.text((2, args.thumbnail_size), caption, fill=(255, 255, 255))
+    return cell, None
+
+
+def render_sheet(args, task):
+    """
+    Draw one contact sheet, in a worker process.
+    :param task: Path of the sheet and the list of (filename, record) on it, in reading order.
+    :return: List of (filename, score, error) of the cells.
+    """
+    sheet_path, list_of_items = task
+    codec = get_codec(args.codec)
+    cell_width, cell_height = args.thumbnail_size, args.thumbnail_size + CAPTION_HEIGHT
+    rows = (len(list_of_items) + args.columns - 1) // args.columns
+    sheet = Image.new('RGB', (cell_width * args.columns, cell_height * rows), SHEET_BACKGROUND)
+    list_of_cells = []
+    for index, (filename, record) in enumerate(list_of_items):
+        cell, error = draw_cell(args, codec, filename, record)
+        sheet.paste(cell, ((index % args.columns) * cell_width, (index // args.columns) * cell_height))
+        list_of_cells.append((filename, record.get('score'), error))
+    sheet.save(sheet_path + '.tmp', format='JPEG', quality=85)
+    os.replace(sheet_path + '.tmp', sheet_path)
+    return list_of_cells
+
+
+def make_sheet_tasks(args, prefix, list_of_file_name, records):
+    per_sheet = args.columns * args.rows
+    return [(os.path.join(args.report_dir, f"{prefix}_{start // per_sheet:04d}.jpg"),
+             [(filename, records[filename]) for filename in list_of_file_name[start: start + per_sheet]])
+            for start in range(0, len(list_of_file_name), per_sheet)]
+
+
+def write_html_index(args, sections, summary):
+    """
+    :param sections: List of (title, list of (sheet_path, list of cells)).
+    """
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>Crop QA report</title>',
+             '<style>body{font-family:sans-serif;background:#202020;color:#e0e0e0} img{max-width:100%} '
+             'td{padding:0 8px} .error{color:#ff6060}</style></head><body>',
+             '<h1>Crop QA report</h1>',
+             '<p>' + ', '.join(f"{html.escape(key)}: {html.escape(str(value))}" for key, value in summary.items()) +
+             '</p>', '<p>Red: predicted bounding box, green: crop box.</p>']
+    for title, list_of_sheets in sections:
+        if len(list_of_sheets) == 0:
+            continue
+        lines.append(f'<h2>{html.escape(title)}</h2>')
+        for sheet_path, list_of_cells in list_of_sheets:
+            sheet_name = os.path.basename(sheet_path)
+            lines.append(f'<h3>{html.escape(sheet_name)}</h3><img src="{html.escape(sheet_name)}" loading="lazy">')
+            lines.append('<details><summary>Images</summary><table>')
+            for position, (filename, score, error) in enumerate(list_of_cells):
+                score_text = '' if score is None or np.isnan(score) else f'{score:.3f}'
+                error_text = f'<span class="error">{html.escape(error)}</span>' if error is not None else ''
+                lines.append(f'<tr><td>{position}</td><td>{html.escape(filename)}</td><td>{score_text}</td>'
+                             f'<td>{error_text}</td></tr>')
+            lines.append('</table></details>')
+    lines.append('</body></html>')
+    index_path = os.path.join(args.report_dir, 'index.html')
+    with open(index_path + '.tmp', 'w') as file:
+        file.write('\n'.join(lines))
+    os.replace(index_path + '.tmp', index_path)
+    return index_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True,
+                        help="Folder that contains the original images of the run or part.")
+    parser.add_argument('--run_dir', type=str, default=None,
+                        help="Output folder of the run, the metadata is read from it.")
+    parser.add_argument('--metadata', type=str, default=None,
+                        help="Columnar store folder or size_of_original_image_and_bbox.json, instead of --run_dir.")
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help="Predict the boxes of the sampled images without a stored box with this checkpoint.")
+    parser.add_argument('--report_dir', type=str, required=True,
+                        help="Folder of the contact sheets and index.html.")
+    parser.add_argument('--number_of_images', type=int, default=512,
+                        help="Number of images sampled at random.")
+    parser.add_argument('--lowest_scores', type=int, default=64,
+                        help="Number of images with the lowest scores shown first, in addition to the sample.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--columns', type=int, default=8)
+    parser.add_argument('--rows', type=int, default=8)
+    parser.add_argument('--thumbnail_size', type=int, default=256)
+    parser.add_argument('--decode_scale', type=int, default=4, choices=[1, 2, 4, 8],
+                        help="Decode the originals at 1/decode_scale of their size, enough for the thumbnails.")
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help="Batch size of the model for the images without a stored box.")
+    # The crop options of the run, for the crop boxes of the images predicted for the report.
+    add_crop_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+
+    metadata_path = args.metadata
+    if metadata_path is None and args.run_dir is not None:
+        metadata_path = find_metadata_path(args.run_dir)
+    records = load_bbox_store(metadata_path) if metadata_path is not None else {}
+    print(f"{len(records)} stored boxes in {metadata_path}.")
+
+    list_of_file_name = sorted(os.listdir(args.input_dir))
+    if args.checkpoint_path is None:
+        list_of_file_name = [filename for filename in list_of_file_name if filename in records]
+    lowest, sample = sample_filenames(list_of_file_name, records, args.number_of_images, args.lowest_scores,
+                                      args.seed)
+    missing = [filename for filename in lowest + sample if filename not in records]
+    if len(missing) > 0:
+        predict_missing_records(args, missing, records)
+
+    os.makedirs(args.report_dir, exist_ok=True)
+    lowest_tasks = make_sheet_tasks(args, 'lowest', lowest, records)
+    list_of_tasks = lowest_tasks + make_sheet_tasks(args, 'sample', sample, records)
+    with multiprocessing.Pool(args.num_workers) as pool:
+        list_of_results = list(tqdm(pool.imap(functools.partial(render_sheet, args), list_of_tasks, chunksize=1),
+                                    total=len(list_of_tasks), desc="Drawing contact sheets"))
+    list_of_sheets = [(sheet_path, cells) for (sheet_path, _), cells in zip(list_of_tasks, list_of_results)]
+
+    scores = np.array([records[filename].get('score', np.nan) for filename in sample], dtype=np.float64)
+    summary = {'input_dir': args.input_dir, 'metadata': metadata_path, 'images': len(list_of_file_name),
+               'sampled': len(sample), 'seed': args.seed, 'predicted for the report': len(missing),
+               'mean score of the sample': f"{np.nanmean(scores):.3f}" if np.any(~np.isnan(scores)) else 'n/a',
+               'failed': sum(records[filename].get('status') == STATUS_FAILED for filename in lowest + sample)}
+    index_path = write_html_index(args, [(f"{len(lowest)} lowest scores", list_of_sheets[:len(lowest_tasks)]),
+                                         (f"Random sample of {len(sample)}",
+                                          list_of_sheets[len(lowest_tasks):])], summary)
+    print(f"Report written to {index_path}.")
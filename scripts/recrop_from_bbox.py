@@ -0,0 +1,92 @@
+"""
+Crop the images again from the bounding boxes stored by a previous run, for example with a different crop_ratio,
+fix_ratio, rotate_image, equal_extend or background color. Only the images without a valid stored box (no record,
+changed content or a different checkpoint) go through the model.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from util.bbox_store import find_stored_bbox, get_checkpoint_hash, hash_bytes, load_bbox_store
+from util.crop_engine import add_crop_arguments, crop_image_with_bbox, init_feature_extractor, \
+    predict_bboxes_and_scores
+
+
+def crop_and_save(args, image, filename, bbox):
+    cropped_img = crop_image_with_bbox(args, image, np.array(bbox, dtype=np.float32))
+    cropped_img.save(os.path.join(args.output_dir, filename))
+
+
+def recrop_images(args):
+    bbox_store = load_bbox_store(args.bbox_json)
+    checkpoint_hash = get_checkpoint_hash(args.checkpoint_path)
+    list_of_original_image_size_and_bbox = []
+    list_of_images_to_infer = []
+    number_of_reused_bboxes = 0
+
+    for filename in tqdm(sorted(os.listdir(args.input_dir)), desc="Cropping from stored bboxes"):
+        with open(os.path.join(args.input_dir, filename), 'rb') as file:
+            image_bytes = file.read()
+        content_hash = hash_bytes(image_bytes)
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        bbox = find_stored_bbox(bbox_store, filename, image.size, content_hash, checkpoint_hash,
+                                args.accept_records_without_hash)
+        if bbox is None:
+            list_of_images_to_infer.append((filename, content_hash))
+            continue
+        crop_and_save(args, image, filename, bbox)
+        number_of_reused_bboxes += 1
+        list_of_original_image_size_and_bbox.append({'filename': filename, 'original_size': image.size,
+                                                     'bbox': list(bbox), 'content_hash': content_hash,
+                                                     'checkpoint_hash': checkpoint_hash})
+
+    if len(list_of_images_to_infer) > 0:
+        feature_extractor = init_feature_extractor(args.inference_shortest_edge, args.inference_longest_edge)
+        model = load_model_from_ckpt(args)
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        model.to(device)
+        for start in tqdm(range(0, len(list_of_images_to_infer), args.batch_size), desc="Cropping with the model"):
+            batch = list_of_images_to_infer[start: start + args.batch_size]
+            list_of_images = [Image.open(os.path.join(args.input_dir, filename)).convert("RGB")
+                              for filename, _ in batch]
+            bboxes, _ = predict_bboxes_and_scores(model, feature_extractor, list_of_images, device)
+            for (filename, content_hash), image, bbox in zip(batch, list_of_images, bboxes):
+                list_of_original_image_size_and_bbox.append({'filename': filename, 'original_size': image.size,
+                                                             'bbox': bbox.tolist(), 'content_hash': content_hash,
+                                                             'checkpoint_hash': checkpoint_hash})
+                crop_and_save(args, image, filename, bbox)
+
+    print(f"Reused {number_of_reused_bboxes} stored bboxes, ran the model on {len(list_of_images_to_infer)} images.")
+    return list_of_original_image_size_and_bbox
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True,
+                        help="Folder that contains the original images.")
+    parser.add_argument('--bbox_json', type=str, required=True,
+                        help="size_of_original_image_and_bbox.json or bbox_metadata folder saved by a previous run.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint, stored boxes from other checkpoints are predicted again.")
+    parser.add_argument('--output_dir', type=str, default="cropped_image",
+                        help="Folder that will contain the cropped images.")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="Number of images in each batch for the images that need the model.")
+    parser.add_argument('--accept_records_without_hash', default=False, action='store_true',
+                        help="Reuse records saved before the content and checkpoint hashes were stored.")
+    parser.add_argument('--inference_shortest_edge', type=int, default=800)
+    parser.add_argument('--inference_longest_edge', type=int, default=1333)
+    add_crop_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    list_of_original_image_size_and_bbox = recrop_images(args)
+    with open(os.path.join(args.output_dir, 'size_of_original_image_and_bbox.json'), 'w') as file:
+        json.dump(list_of_original_image_size_and_bbox, file)
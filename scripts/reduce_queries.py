@@ -0,0 +1,70 @@
+"""
+Make a checkpoint with fewer object queries from a trained checkpoint, keeping the queries that give the top-1 box
+most often on the training set, and compare both checkpoints on the validation set. The reduced checkpoint can be used
+by every crop script as it is, or fine-tuned with scripts/train.py --checkpoint_path.
+"""
+import argparse
+import json
+import os
+import sys
+import pytorch_lightning as pl
+import torch
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from model.query_reduction import count_query_usage, reduce_object_queries, select_top_queries
+from util.fast_evaluation import add_crop_geometry_arguments, fast_evaluation
+from evaluate import initialize_dataloader
+
+
+def save_reduced_checkpoint(model, checkpoint, output_path):
+    """
+    :param checkpoint: The checkpoint the model was reduced from, loaded with torch.load.
+    """
+    reduced_checkpoint = {'state_dict': model.state_dict(), 'pytorch-lightning_version': pl.__version__,
+                          'epoch': checkpoint.get('epoch', 0), 'global_step': checkpoint.get('global_step', 0)}
+    # auxiliary_loss tells util/early_exit.py how the heads were trained.
+    if 'hyper_parameters' in checkpoint:
+        reduced_checkpoint['hyper_parameters'] = checkpoint['hyper_parameters']
+    torch.save(reduced_checkpoint, output_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="path to the directory that contains the split data.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--num_queries', type=int, nargs='+', default=[10],
+                        help="Numbers of object queries to try.")
+    parser.add_argument('--output_dir', type=str, default='reduced_query_ckpt',
+                        help="Folder for the reduced checkpoints and the report.")
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--number_of_workers', type=int, default=4)
+    parser.add_argument('--number_of_batches_for_query_usage', type=int, default=None,
+                        help="Number of training batches used to count the usage of the queries, all by default.")
+    add_crop_geometry_arguments(parser)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    train_dataloader, val_dataset, val_dataloader, _, _ = initialize_dataloader(args)
+
+    # Loaded once, every reduced model starts from it.
+    checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+    model = load_model_from_ckpt(args, checkpoint)
+    print(f"Evaluating the checkpoint with {model.model.config.num_queries} queries...")
+    report = {str(model.model.config.num_queries): fast_evaluation(model, val_dataset, val_dataloader, args)}
+    query_usage = count_query_usage(model, train_dataloader, args.number_of_batches_for_query_usage)
+    report['query_usage'] = query_usage.tolist()
+
+    for num_queries in args.num_queries:
+        model = load_model_from_ckpt(args, checkpoint)
+        query_indices = select_top_queries(query_usage, num_queries)
+        reduce_object_queries(model, query_indices)
+        print(f"Evaluating {num_queries} queries, which give the top-1 box of "
+              f"{query_usage[query_indices].sum().item() / max(query_usage.sum().item(), 1):.2%} training images...")
+        report[str(num_queries)] = dict(fast_evaluation(model, val_dataset, val_dataloader, args),
+                                        query_indices=query_indices.tolist())
+        save_reduced_checkpoint(model, checkpoint, os.path.join(args.output_dir, f'num_queries={num_queries}.ckpt'))
+
+    with open(os.path.join(args.output_dir, 'report.json'), 'w') as file:
+        json.dump(report, file, indent=4)
@@ -0,0 +1,99 @@
+"""
+Run the model over the validation split at several inference resolutions and report the throughput, the latency and
+the IoU against the ground truth boxes for each of them.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from util.crop_engine import init_feature_extractor, predict_bboxes_and_scores, set_inference_resolution
+from util.evaluation_support import box_iou_for_pairs
+
+
+def load_val_images_and_ground_truth(args):
+    """
+    :return: List of decoded PIL images and a tensor of their ground truth boxes in x_min, y_min, x_max, y_max.
+    """
+    val_folder = os.path.join(args.data_dir, 'val')
+    with open(os.path.join(val_folder, "custom_val.json")) as file:
+        coco_annotation_dict = json.load(file)
+    image_id_to_bbox = {}
+    for annotation in coco_annotation_dict['annotations']:
+        image_id_to_bbox.setdefault(annotation['image_id'], annotation['bbox'])
+
+    list_of_images = []
+    ground_truth_boxes = []
+    for image_info in tqdm(coco_annotation_dict['images'], desc="Loading images"):
+        if image_info['id'] not in image_id_to_bbox:
+            continue
+        x, y, w, h = image_id_to_bbox[image_info['id']]
+        list_of_images.append(Image.open(os.path.join(val_folder, image_info['file_name'])).convert("RGB"))
+        ground_truth_boxes.append([x, y, x + w, y + h])
+    return list_of_images, torch.tensor(ground_truth_boxes, dtype=torch.float32)
+
+
+def evaluate_resolution(args, model, feature_extractor, device, list_of_images, ground_truth_boxes):
+    batches = [list_of_images[i: i + args.batch_size] for i in range(0, len(list_of_images), args.batch_size)]
+    # Warm up, the first forward pass at a new input size is slower.
+    predict_bboxes_and_scores(model, feature_extractor, batches[0], device)
+
+    list_of_bboxes = []
+    list_of_latency = []
+    start = time.perf_counter()
+    for batch in batches:
+        batch_start = time.perf_counter()
+        bboxes, _ = predict_bboxes_and_scores(model, feature_extractor, batch, device)
+        list_of_latency.append((time.perf_counter() - batch_start) / len(batch))
+        list_of_bboxes.append(bboxes)
+    elapsed = time.perf_counter() - start
+
+    iou = box_iou_for_pairs(torch.from_numpy(np.concatenate(list_of_bboxes)), ground_truth_boxes)
+    return {'images_per_second': len(list_of_images) / elapsed,
+            'mean_latency_ms': float(np.mean(list_of_latency)) * 1000,
+            'p95_latency_ms': float(np.percentile(list_of_latency, 95)) * 1000,
+            'mean_iou': iou.mean().item(),
+            'iou_above_0.5': (iou > 0.5).float().mean().item(),
+            'iou_above_0.75': (iou > 0.75).float().mean().item()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="path to the directory that contains the split data.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--shortest_edges', type=int, nargs='+', default=[800, 640, 512, 400, 320, 256],
+                        help="Shortest edges to evaluate, the longest edge keeps the default 800:1333 ratio.")
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--output_json', type=str, default=None,
+                        help="Optional path to save the results.")
+    args = parser.parse_args()
+
+    model = load_model_from_ckpt(args)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model.to(device)
+    feature_extractor = init_feature_extractor()
+    list_of_images, ground_truth_boxes = load_val_images_and_ground_truth(args)
+
+    results = []
+    for shortest_edge in args.shortest_edges:
+        longest_edge = round(shortest_edge * 1333 / 800)
+        set_inference_resolution(feature_extractor, shortest_edge, longest_edge)
+        result = evaluate_resolution(args, model, feature_extractor, device, list_of_images, ground_truth_boxes)
+        result.update({'shortest_edge': shortest_edge, 'longest_edge': longest_edge})
+        results.append(result)
+        print(f"{shortest_edge}x{longest_edge}: {result['images_per_second']:.2f} images/s, "
+              f"latency {result['mean_latency_ms']:.1f} ms (p95 {result['p95_latency_ms']:.1f} ms), "
+              f"mean IoU {result['mean_iou']:.4f}, IoU>0.5 {result['iou_above_0.5']:.3f}, "
+              f"IoU>0.75 {result['iou_above_0.75']:.3f}")
+
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as file:
+            json.dump(results, file, indent=4)
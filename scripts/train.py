@@ -1,6 +1,7 @@
 import argparse
 import torch
-from pytorch_lightning import Trainer
+from pytorch_lightning import Callback, Trainer
+from pytorch_lightning.strategies import DDPStrategy
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 import os
@@ -9,7 +10,10 @@ from transformers import DetrFeatureExtractor
 from project_path import project_dir
 from util.evaluation_support import prepare_for_evaluation
 from util.coco_dataset import DetectionDataset
-from model.detr import Detr
+from util.fast_evaluation import FastEvaluationCallback, add_crop_geometry_arguments, fast_evaluation
+from model.detr import Detr, load_detr_from_checkpoint
+from model.query_reduction import count_query_usage, reduce_object_queries, select_top_queries
+from util.topology import add_topology_arguments, init_topology_from_args, plan_topology
 from coco_eval import CocoEvaluator
 import warnings
 
@@ -26,7 +30,7 @@ def collate_fn(batch):
     return batch
 
 
-def initialize_dataloader(args):
+def initialize_dataloader(args, worker_init_fn=None):
     args.train_folder = os.path.join(args.data_dir, 'train')
     args.val_folder = os.path.join(args.data_dir, 'val')
     feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
@@ -37,8 +41,10 @@ def initialize_dataloader(args):
     print("Number of training examples:", len(train_dataset))
     print("Number of validation examples:", len(val_dataset))
 
-    train_dataloader = DataLoader(train_dataset, collate_fn=collate_fn, batch_size=args.batch_size, num_workers=args.number_of_workers, shuffle=True)
-    val_dataloader = DataLoader(val_dataset, collate_fn=collate_fn, num_workers=args.number_of_workers, batch_size=args.batch_size)
+    train_dataloader = DataLoader(train_dataset, collate_fn=collate_fn, batch_size=args.batch_size, num_workers=args.number_of_workers, shuffle=True,
+                                  worker_init_fn=worker_init_fn)
+    val_dataloader = DataLoader(val_dataset, collate_fn=collate_fn, num_workers=args.number_of_workers, batch_size=args.batch_size,
+                                worker_init_fn=worker_init_fn)
     categories = train_dataset.coco.cats
     id2label = {k: v['name'] for k, v in categories.items()}
 
@@ -48,21 +54,64 @@ def initialize_dataloader(args):
 def initialize_model(args, train_dataloader, val_dataloader):
 
     if args.checkpoint_path is not None:
-        model = Detr.load_from_checkpoint(lr=1e-4, lr_backbone=1e-5, weight_decay=1e-4,
-                                          checkpoint_path=args.checkpoint_path)
+        model = load_detr_from_checkpoint(torch.load(args.checkpoint_path, map_location='cpu'),
+                                          auxiliary_loss=args.auxiliary_loss,
+                                          train_dataloader=train_dataloader, val_dataloader=val_dataloader)
+        if args.num_queries is not None and args.num_queries >= model.model.config.num_queries:
+            raise ValueError(f"--num_queries {args.num_queries} is not less than the {model.model.config.num_queries} "
+                             f"queries of {args.checkpoint_path}, the queries of a checkpoint can only be reduced.")
+        if args.num_queries is not None:
+            # Start from the queries of the checkpoint that give the top-1 box most often on the training set.
+            query_usage = count_query_usage(model, train_dataloader, args.number_of_batches_for_query_usage)
+            reduce_object_queries(model, select_top_queries(query_usage, args.num_queries))
     else:
         model = Detr(lr=args.learning_rate, lr_backbone=args.lr_backbone, weight_decay=args.weight_decay,
-                     train_dataloader=train_dataloader, val_dataloader=val_dataloader)
+                     train_dataloader=train_dataloader, val_dataloader=val_dataloader,
+                     num_queries=args.num_queries if args.num_queries is not None else 100,
+                     auxiliary_loss=args.auxiliary_loss)
 
     return model
 
-def initialize_trainer(args, logger=None):
+def init_training_topology(args):
+    """
+    Plan a set of cores and as many torch threads as cores for each local training process, or the threads of
+    --topology. It is applied by TopologyCallback once the processes are started.
+    :return: The Topology of the local processes, None if the torch defaults are kept.
+    """
+    topology = init_topology_from_args(args, args.num_processes, args.threads_per_process)
+    if topology is None and (args.num_processes > 1 or args.num_nodes > 1):
+        topology = plan_topology('manual', args.num_processes, args.threads_per_process, pin=True, has_loader=False)
+    return topology
+
+
+class TopologyCallback(Callback):
+    """
+    Apply the topology in every local process at setup. Lightning starts the other local processes from the first one
+    by running this script again, so the first one is only pinned after it started them, and they do not inherit its
+    cores.
+    """
+
+    def __init__(self, topology):
+        self.topology = topology
+
+    def setup(self, trainer, pl_module, stage):
+        self.topology.apply(trainer.local_rank)
+
+
+def initialize_trainer(args, logger=None, callbacks=None):
+    if args.num_processes > 1 or args.num_nodes > 1:
+        # Data parallel training on CPU, the gradients are averaged over the processes with gloo. Lightning shards the
+        # training data with a DistributedSampler and only the global rank 0 saves the checkpoints.
+        return Trainer(accelerator='cpu', devices=args.num_processes, num_nodes=args.num_nodes,
+                       strategy=DDPStrategy(process_group_backend='gloo', find_unused_parameters=False),
+                       max_steps=args.max_steps, gradient_clip_val=args.gradient_clip_val,
+                       default_root_dir=args.output_dir, logger=logger, callbacks=callbacks)
     if not torch.cuda.is_available():
         return Trainer(gpus=0, max_steps=args.max_steps, gradient_clip_val=args.gradient_clip_val,
-                       default_root_dir=args.output_dir, logger=logger)
+                       default_root_dir=args.output_dir, logger=logger, callbacks=callbacks)
     else:
         return Trainer(gpus=args.gpus, max_steps=args.max_steps, gradient_clip_val=args.gradient_clip_val,
-                       default_root_dir=args.output_dir, accelerator="auto", logger=logger)
+                       default_root_dir=args.output_dir, accelerator="auto", logger=logger, callbacks=callbacks)
 
 
 def evaluation(model, val_dataset, val_dataloader, feature_extractor):
@@ -78,7 +127,8 @@ def evaluation(model, val_dataset, val_dataloader, feature_extractor):
         labels = [{k: v for k, v in t.items()} for t in
                   batch["labels"]]
         # forward pass
-        outputs = model.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+        with torch.inference_mode():
+            outputs = model.model(pixel_values=pixel_values, pixel_mask=pixel_mask)
 
         orig_target_sizes = torch.stack([target["orig_size"] for target in labels], dim=0)
         results = feature_extractor.post_process(outputs, orig_target_sizes)  # convert outputs of model to COCO api
@@ -108,13 +158,52 @@ if __name__ == '__main__':
     parser.add_argument('--number_of_workers', type=int, default=4)
     parser.add_argument('--checkpoint_path', type=str, default=None,
                         help="Path to the checkpoint.")
+    parser.add_argument('--evaluate_every_epoch', default=False, action='store_true',
+                        help="Run the fast top-1 evaluation at the end of every epoch and log val_top1_*.")
+    add_crop_geometry_arguments(parser)
+    parser.add_argument('--fast_evaluation', default=False, action='store_true',
+                        help="Evaluate only the top-1 box of each image after training, like evaluate.py --fast, "
+                             "instead of all boxes with CocoEvaluator.")
+    parser.add_argument('--num_queries', type=int, default=None,
+                        help="Fine-tune with fewer object queries, initialized from the most used queries of "
+                             "--checkpoint_path.")
+    parser.add_argument('--auxiliary_loss', default=False, action='store_true',
+                        help="Also train the heads on the output of every decoder layer, needed by --early_exit of "
+                             "the crop scripts.")
+    parser.add_argument('--number_of_batches_for_query_usage', type=int, default=None,
+                        help="Number of training batches used to count the usage of the queries, all by default.")
+    parser.add_argument('--num_processes', type=int, default=1,
+                        help="Number of data parallel training processes on CPU on each node.")
+    parser.add_argument('--num_nodes', type=int, default=1,
+                        help="Number of nodes, set MASTER_ADDR, MASTER_PORT and NODE_RANK on every node.")
+    parser.add_argument('--threads_per_process', type=int, default=None,
+                        help="Number of torch threads of each training process, "
+                             "the available cores divided by --num_processes by default.")
+    add_topology_arguments(parser)
     args = parser.parse_args()
-    train_dataloader, val_dataset, val_dataloader, feature_extractor, id2label = initialize_dataloader(args)
+
+    topology = init_training_topology(args)
+    worker_init_fn = None
+    if topology is not None:
+        if topology.loader_workers is not None:
+            args.number_of_workers = topology.loader_workers
+        worker_init_fn = topology.get_loader_worker_init_fn(int(os.environ.get('LOCAL_RANK', 0)))
+    train_dataloader, val_dataset, val_dataloader, feature_extractor, id2label = initialize_dataloader(args,
+                                                                                                       worker_init_fn)
 
     model = initialize_model(args, train_dataloader, val_dataloader)
 
-    trainer = initialize_trainer(args)
+    callbacks = []
+    if topology is not None:
+        callbacks.append(TopologyCallback(topology))
+    if args.evaluate_every_epoch:
+        callbacks.append(FastEvaluationCallback(val_dataset, val_dataloader, args))
+
+    trainer = initialize_trainer(args, callbacks=callbacks)
 
     trainer.fit(model)
 
-    evaluation(model, val_dataset, val_dataloader, feature_extractor)
+    if args.fast_evaluation:
+        fast_evaluation(model, val_dataset, val_dataloader, args)
+    elif trainer.is_global_zero:
+        evaluation(model, val_dataset, val_dataloader, feature_extractor)
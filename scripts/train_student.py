@@ -0,0 +1,112 @@
+"""
+Distill the Detr model into the small student of model/student.py. The student is trained on the boxes that the
+teacher stored for the images of crop runs (--image_dirs with their --metadata), validated on the annotated val split of
+--data_dir, and evaluated at the end with the top-1 evaluation of scripts/evaluate.py --fast, so the numbers compare
+directly with the ones of the teacher.
+"""
+import argparse
+import os
+import sys
+import torch
+from pytorch_lightning import Trainer
+from torch.utils.data import DataLoader
+from project_path import project_dir
+from model.student import STUDENT_BACKBONES, Student
+from util.distillation_dataset import DistillationDataset, StudentDetectionDataset, student_collate_fn
+from util.fast_evaluation import FastEvaluationCallback, add_crop_geometry_arguments, fast_evaluation
+from util.image_codecs import add_codec_arguments, get_codec
+from util.topology import add_topology_arguments, init_topology_from_args
+
+
+def initialize_dataloader(args, student, worker_init_fn=None):
+    feature_extractor = student.get_feature_extractor()
+    train_dataset = DistillationDataset(args.image_dirs, args.metadata, feature_extractor, args.min_teacher_score,
+                                        codec=get_codec(args.codec), decode_scale=args.decode_scale)
+    val_dataset = StudentDetectionDataset(img_folder=os.path.join(args.data_dir, 'val'),
+                                          feature_extractor=feature_extractor)
+    print("Number of training examples:", len(train_dataset))
+    print("Number of validation examples:", len(val_dataset))
+
+    train_dataloader = DataLoader(train_dataset, collate_fn=student_collate_fn, batch_size=args.batch_size,
+                                  num_workers=args.number_of_workers, shuffle=True, worker_init_fn=worker_init_fn)
+    val_dataloader = DataLoader(val_dataset, collate_fn=student_collate_fn, batch_size=args.batch_size,
+                                num_workers=args.number_of_workers, worker_init_fn=worker_init_fn)
+    return train_dataloader, val_dataset, val_dataloader
+
+
+def initialize_student(args):
+    if args.checkpoint_path is not None:
+        return Student.load_from_checkpoint(checkpoint_path=args.checkpoint_path, pretrained=False,
+                                            lr=args.learning_rate, lr_backbone=args.lr_backbone,
+                                            weight_decay=args.weight_decay, max_epochs=args.max_epochs)
+    return Student(args.backbone, args.input_height, args.input_width, lr=args.learning_rate,
+                   lr_backbone=args.lr_backbone, weight_decay=args.weight_decay, max_epochs=args.max_epochs)
+
+
+def initialize_trainer(args, callbacks=None):
+    if not torch.cuda.is_available():
+        return Trainer(gpus=0, max_steps=args.max_steps, gradient_clip_val=args.gradient_clip_val,
+                       default_root_dir=args.output_dir, callbacks=callbacks)
+    else:
+        return Trainer(gpus=args.gpus, max_steps=args.max_steps, gradient_clip_val=args.gradient_clip_val,
+                       default_root_dir=args.output_dir, accelerator="auto", callbacks=callbacks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--image_dirs', type=str, nargs='+', required=True,
+                        help="Folders of the original images of the crop runs.")
+    parser.add_argument('--metadata', type=str, nargs='+', required=True,
+                        help="size_of_original_image_and_bbox.json or bbox_metadata folder of each image folder.")
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="path to the directory that contains the split data, the val split is used.")
+    parser.add_argument('--output_dir', type=str, required=True, help="The path used to store the checkpoint.")
+    parser.add_argument('--checkpoint_path', type=str, default=None,
+                        help="Student checkpoint to continue from.")
+    parser.add_argument('--backbone', type=str, default='mobilenetv3_large_100', choices=STUDENT_BACKBONES)
+    parser.add_argument('--input_height', type=int, default=240)
+    parser.add_argument('--input_width', type=int, default=320)
+    parser.add_argument('--min_teacher_score', type=float, default=0.9,
+                        help="Leave out the images whose teacher box has a lower score.")
+    parser.add_argument('--decode_scale', type=int, default=2, choices=[1, 2, 4, 8],
+                        help="Decode the training images at 1/decode_scale of their size.")
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--learning_rate', type=float, default=1e-3)
+    parser.add_argument('--lr_backbone', type=float, default=1e-4)
+    parser.add_argument('--weight_decay', type=float, default=1e-4)
+    parser.add_argument('--gpus', type=int, default=1)
+    parser.add_argument('--max_steps', type=int, default=20000)
+    parser.add_argument('--max_epochs', type=int, default=10)
+    parser.add_argument('--gradient_clip_val', type=float, default=0.1)
+    parser.add_argument('--number_of_workers', type=int, default=8)
+    parser.add_argument('--evaluate_every_epoch', default=False, action='store_true',
+                        help="Run the fast top-1 evaluation at the end of every epoch and log val_top1_*.")
+    add_crop_geometry_arguments(parser)
+    add_codec_arguments(parser)
+    add_topology_arguments(parser)
+    args = parser.parse_args()
+    if len(args.image_dirs) != len(args.metadata):
+        parser.error("--image_dirs and --metadata need one entry per crop run.")
+
+    topology = init_topology_from_args(args)
+    worker_init_fn = None
+    if topology is not None:
+        topology.apply()
+        if topology.loader_workers is not None:
+            args.number_of_workers = topology.loader_workers
+        worker_init_fn = topology.get_loader_worker_init_fn()
+
+    student = initialize_student(args)
+    train_dataloader, val_dataset, val_dataloader = initialize_dataloader(args, student, worker_init_fn)
+    student.train_dataloader_ = train_dataloader
+    student.val_dataloader_ = val_dataloader
+
+    callbacks = []
+    if args.evaluate_every_epoch:
+        callbacks.append(FastEvaluationCallback(val_dataset, val_dataloader, args))
+
+    trainer = initialize_trainer(args, callbacks=callbacks)
+
+    trainer.fit(student)
+
+    fast_evaluation(student, val_dataset, val_dataloader, args)
@@ -0,0 +1,51 @@
+"""
+Find the fastest number of inference workers x torch threads per worker for this machine.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import torch
+from transformers import DetrFeatureExtractor
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from util.crop_engine import add_crop_arguments
+from util.parallel_inference import benchmark_configurations, get_candidate_configurations
+from util.topology import get_available_cores
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', type=str, required=True,
+                        help="Folder that contains the original images used for the benchmark.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--number_of_images', type=int, default=64,
+                        help="Number of images cropped with each configuration.")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="Number of images in each batch.")
+    parser.add_argument('--start_method', type=str, default='fork', choices=['fork', 'spawn', 'forkserver'])
+    parser.add_argument('--output_json', type=str, default=None,
+                        help="Optional path to save the results of all configurations.")
+    add_crop_arguments(parser)
+    args = parser.parse_args()
+    args.output_dir = None
+
+    list_of_file_name = sorted(os.listdir(args.input_dir))
+    random.Random(0).shuffle(list_of_file_name)
+    list_of_file_name = list_of_file_name[:args.number_of_images]
+
+    feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
+    model = load_model_from_ckpt(args)
+    device = torch.device('cpu')
+    model.to(device)
+
+    configurations = get_candidate_configurations(len(get_available_cores()))
+    results = benchmark_configurations(args, model, feature_extractor, device, list_of_file_name, configurations)
+
+    best = results[0]
+    print(f"Best: --num_inference_workers {best['num_workers']} --threads_per_worker {best['threads_per_worker']} "
+          f"({best['images_per_second']:.2f} images/s)")
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as file:
+            json.dump(results, file, indent=4)
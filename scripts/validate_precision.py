@@ -0,0 +1,85 @@
+"""
+Evaluate reduced-precision modes against fp32 on the validation split and refuse the modes whose AP or mean IoU
+drops more than the tolerance.
+"""
+import argparse
+import json
+import os
+import sys
+from project_path import project_dir
+from model.detr import load_model_from_ckpt
+from model.precision import PRECISION_MODES, apply_precision
+from evaluate import initialize_dataloader, evaluation
+
+
+def get_calibration_batches(train_dataloader, number_of_batches):
+    list_of_calibration_pixel_values = []
+    for batch in train_dataloader:
+        if len(list_of_calibration_pixel_values) >= number_of_batches:
+            break
+        list_of_calibration_pixel_values.append(batch["pixel_values"])
+    return list_of_calibration_pixel_values
+
+
+def validate_precision_modes(args):
+    """
+    :return: Dictionary from precision mode to its metrics, the drops against fp32 and whether it is accepted.
+    """
+    train_dataloader, val_dataset, val_dataloader, feature_extractor, _ = initialize_dataloader(args)
+
+    print("Evaluating fp32...")
+    fp32_metrics = evaluation(load_model_from_ckpt(args), val_dataset, val_dataloader, feature_extractor)
+    report = {'fp32': dict(fp32_metrics, ap_drop=0.0, iou_drop=0.0, accepted=True)}
+
+    list_of_calibration_pixel_values = get_calibration_batches(train_dataloader, args.number_of_calibration_batches)
+    for precision in args.precision:
+        if precision == 'fp32':
+            continue
+        print(f"Evaluating {precision}...")
+        model, used_precision = apply_precision(load_model_from_ckpt(args), precision,
+                                                list_of_calibration_pixel_values)
+        if used_precision != precision:
+            report[precision] = {'accepted': False, 'reason': "Not supported on this machine."}
+            continue
+        metrics = evaluation(model, val_dataset, val_dataloader, feature_extractor, precision=precision)
+        ap_drop = fp32_metrics['AP'] - metrics['AP']
+        iou_drop = fp32_metrics['mean_iou'] - metrics['mean_iou']
+        accepted = ap_drop <= args.max_ap_drop and iou_drop <= args.max_iou_drop
+        report[precision] = dict(metrics, ap_drop=ap_drop, iou_drop=iou_drop, accepted=accepted)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help="path to the directory that contains the split data.")
+    parser.add_argument('--checkpoint_path', type=str, required=True,
+                        help="Path to the checkpoint.")
+    parser.add_argument('--precision', type=str, nargs='+', default=['int8_dynamic', 'int8_static', 'bf16'],
+                        choices=PRECISION_MODES, help="Precision modes to validate against fp32.")
+    parser.add_argument('--max_ap_drop', type=float, default=0.01,
+                        help="Refuse a mode whose COCO AP is lower than fp32 by more than this.")
+    parser.add_argument('--max_iou_drop', type=float, default=0.01,
+                        help="Refuse a mode whose mean IoU is lower than fp32 by more than this.")
+    parser.add_argument('--number_of_calibration_batches', type=int, default=8,
+                        help="Number of training batches used to calibrate the static quantization.")
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--number_of_workers', type=int, default=4)
+    parser.add_argument('--output_json', type=str, default=None,
+                        help="Optional path to save the report.")
+    args = parser.parse_args()
+
+    report = validate_precision_modes(args)
+
+    for precision, result in report.items():
+        if 'AP' in result:
+            print(f"{precision}: AP {result['AP']:.4f} (drop {result['ap_drop']:.4f}), "
+                  f"mean IoU {result['mean_iou']:.4f} (drop {result['iou_drop']:.4f}), "
+                  f"{'accepted' if result['accepted'] else 'REFUSED'}")
+        else:
+            print(f"{precision}: REFUSED, {result['reason']}")
+    if args.output_json is not None:
+        with open(args.output_json, 'w') as file:
+            json.dump(report, file, indent=4)
+    if not all(result['accepted'] for result in report.values()):
+        exit(1)
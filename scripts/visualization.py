@@ -2,9 +2,10 @@ import argparse
 from PIL import Image
 import os
 import sys
+import torch
 from transformers import DetrFeatureExtractor
-from crop_images import load_model_from_ckpt
 from project_path import project_dir
+from model.detr import load_model_from_ckpt
 from util.coco_dataset import DetectionDataset
 from util.visualize_and_process_bbox import visualize_predictions
 
@@ -13,7 +14,8 @@ def visualize(args, val_dataset, model, id2label):
     for i in range(args.visualize_number):
         pixel_values, target = val_dataset[i]
         pixel_values = pixel_values.unsqueeze(0)
-        outputs = model(pixel_values=pixel_values, pixel_mask=None)
+        with torch.no_grad():
+            outputs = model(pixel_values=pixel_values, pixel_mask=None)
 
         image_id = target['image_id'].item()
         image = val_dataset.coco.loadImgs(image_id)[0]
@@ -0,0 +1,189 @@
+"""
+Classical detector for images shot on a near-uniform background, run before DETR so that the easy images skip the
+model. The background color is estimated from the border of a downscaled image, the pixels that are further than a
+threshold from it are the foreground, and the box is the extent of the foreground.
+
+The confidence is the weakest of a few checks: the border is uniform, the foreground is neither tiny nor most of the
+image, it does not run along the border of the image, it is one compact object rather than several, and it stands out
+clearly from the background. The images below min_confidence go to DETR. scripts/evaluate_background_detector.py
+reports how well the boxes agree with DETR on the val split at several confidence thresholds, check it before
+picking one.
+"""
+import collections
+import numpy as np
+import torch
+from PIL import Image
+from util.content_index import register_crop_parameters
+
+
+def to_array(image, step):
+    """
+    :param image: PIL image, HxWx3 uint8 numpy array or CxHxW float image tensor in [0, 1].
+    :param step: Average the pixels in blocks of step x step, the last partial blocks are dropped for arrays.
+    :return: The downscaled image as a HxWx3 float32 array in [0, 255].
+    """
+    if isinstance(image, Image.Image):
+        if step > 1:
+            image = image.reduce(step)
+        return np.asarray(image.convert("RGB"), dtype=np.float32)
+    if isinstance(image, torch.Tensor):
+        image = image[:3].permute(1, 2, 0).float().mul(255).cpu().numpy()
+    array = image[..., :3].astype(np.float32)
+    if step == 1:
+        return array
+    height, width = array.shape[0] // step, array.shape[1] // step
+    return array[:height * step, :width * step].reshape(height, step, width, step, 3).mean(axis=(1, 3))
+
+
+def get_border(array, width):
+    """
+    :return: The pixels of the band of the given width along the border of the array, flattened.
+    """
+    return np.concatenate([array[:width].reshape(-1, *array.shape[2:]), array[-width:].reshape(-1, *array.shape[2:]),
+                           array[width:-width, :width].reshape(-1, *array.shape[2:]),
+                           array[width:-width, -width:].reshape(-1, *array.shape[2:])])
+
+
+def remove_isolated_pixels(mask, min_neighbours=3):
+    """
+    Keep the foreground pixels that have at least min_neighbours foreground pixels in their 3x3 neighbourhood,
+    counting themselves, which drops dust and sensor noise.
+    """
+    height, width = mask.shape
+    padded = np.pad(mask, 1).astype(np.uint8)
+    neighbours = sum(padded[dy: dy + height, dx: dx + width] for dy in range(3) for dx in range(3))
+    return mask & (neighbours >= min_neighbours)
+
+
+def get_largest_gap_fraction(line_has_foreground):
+    """
+    :return: The longest run of lines without foreground between the first and last foreground lines, as a fraction
+    of the lines in between.
+    """
+    indices = np.flatnonzero(line_has_foreground)
+    if len(indices) < 2:
+        return 0.0
+    return float((np.diff(indices) - 1).max()) / (indices[-1] - indices[0] + 1)
+
+
+class BackgroundDetector:
+    def __init__(self, min_confidence=0.9, color_threshold=30.0, downscale_edge=256, border_fraction=0.05,
+                 noise_multiplier=2.0, min_area_fraction=0.001, max_area_fraction=0.6, max_border_touch=0.05,
+                 max_gap_fraction=0.15):
+        """
+        :param min_confidence: Images below this confidence go to DETR.
+        :param color_threshold: Minimum distance in RGB from the background color to be foreground, raised on noisy
+        backgrounds.
+        :param downscale_edge: The longest edge of the image is downscaled to about this many pixels.
+        :param border_fraction: Width of the border band the background color is estimated from, as a fraction of the
+        shortest edge.
+        :param noise_multiplier: The threshold is at least this times the 95th percentile of the distance of the border
+        pixels from the background color.
+        :param min_area_fraction: Smallest fraction of foreground pixels for a confident box.
+        :param max_area_fraction: Largest fraction of foreground pixels for a confident box.
+        :param max_border_touch: Largest fraction of the outermost pixels of the image that are foreground.
+        :param max_gap_fraction: Largest empty gap inside the box, as a fraction of its width or height, larger gaps
+        mean several objects.
+        """
+        self.min_confidence = min_confidence
+        self.color_threshold = color_threshold
+        self.downscale_edge = downscale_edge
+        self.border_fraction = border_fraction
+        self.noise_multiplier = noise_multiplier
+        self.min_area_fraction = min_area_fraction
+        self.max_area_fraction = max_area_fraction
+        self.max_border_touch = max_border_touch
+        self.max_gap_fraction = max_gap_fraction
+        # Number of images whose box came from the detector and from DETR.
+        self.counts = collections.Counter()
+
+    def detect(self, image):
+        """
+        :param image: PIL image, HxWx3 uint8 numpy array or CxHxW float image tensor in [0, 1].
+        :return: Numpy array of the bounding box in (left, top, right, bottom) in the full image, the whole image if
+        there is no foreground, and the confidence in [0, 1].
+        """
+        if isinstance(image, Image.Image):
+            width, height = image.size
+        elif isinstance(image, torch.Tensor):
+            width, height = image.shape[-1], image.shape[-2]
+        else:
+            width, height = image.shape[1], image.shape[0]
+        step = max(max(width, height) // self.downscale_edge, 1)
+        array = to_array(image, step)
+        full_box = np.array([0, 0, width, height], dtype=np.float32)
+        small_height, small_width = array.shape[:2]
+        band = max(round(min(small_height, small_width) * self.border_fraction), 1)
+        if min(small_height, small_width) <= 2 * band:
+            return full_box, 0.0
+
+        background = np.median(get_border(array, band), axis=0)
+        distance = np.sqrt(((array - background) ** 2).sum(axis=2))
+        noise = float(np.percentile(get_border(distance, band), 95))
+        threshold = max(self.color_threshold, noise * self.noise_multiplier)
+        mask = remove_isolated_pixels(distance > threshold)
+
+        rows, columns = mask.any(axis=1), mask.any(axis=0)
+        if not rows.any():
+            return full_box, 0.0
+        top, bottom = np.flatnonzero(rows)[[0, -1]]
+        left, right = np.flatnonzero(columns)[[0, -1]]
+        bbox = np.array([left * step, top * step, min((right + 1) * step, width), min((bottom + 1) * step, height)],
+                        dtype=np.float32)
+
+        area_fraction = mask.mean()
+        if area_fraction < self.min_area_fraction or area_fraction > self.max_area_fraction:
+            return bbox, 0.0
+        uniformity = 1 - noise / self.color_threshold
+        border_touch = 1 - get_border(mask, 1).mean() / self.max_border_touch
+        gap = 1 - max(get_largest_gap_fraction(rows), get_largest_gap_fraction(columns)) / self.max_gap_fraction
+        # Twice the threshold on average is a clear foreground.
+        contrast = distance[mask].mean() / threshold - 1
+        confidence = float(np.clip(min(uniformity, border_touch, gap, contrast), 0, 1))
+        return bbox, confidence
+
+    def detect_batch(self, list_of_images):
+        """
+        :return: Numpy array of bounding boxes in (left, top, right, bottom), a numpy array of their confidences and a
+        boolean numpy array of the images that are confident enough to skip DETR.
+        """
+        bboxes = np.zeros((len(list_of_images), 4), dtype=np.float32)
+        confidences = np.zeros(len(list_of_images), dtype=np.float32)
+        for index, image in enumerate(list_of_images):
+            bboxes[index], confidences[index] = self.detect(image)
+        confident = confidences >= self.min_confidence
+        self.counts['background'] += int(confident.sum())
+        self.counts['detr'] += int((~confident).sum())
+        return bboxes, confidences, confident
+
+    def report(self):
+        number_of_images = sum(self.counts.values())
+        if number_of_images == 0:
+            return
+        print(f"Background detector: {self.counts['background'] / number_of_images:.1%} of {number_of_images} "
+              f"images skipped DETR.")
+
+
+def add_background_detector_arguments(parser):
+    parser.add_argument('--background_detector', default=False, action='store_true',
+                        help="Take the box of the background subtraction detector when it is confident and run the "
+                             "model only on the other images.")
+    parser.add_argument('--background_min_confidence', type=float, default=0.9,
+                        help="Minimum confidence of the background detector to skip the model, check it with "
+                             "scripts/evaluate_background_detector.py.")
+    parser.add_argument('--background_color_threshold', type=float, default=30.0,
+                        help="Minimum RGB distance from the background color to be foreground.")
+    parser.add_argument('--background_downscale_edge', type=int, default=256,
+                        help="Longest edge of the downscaled image the background detector runs on.")
+    register_crop_parameters(parser, ['background_detector', 'background_min_confidence',
+                                      'background_color_threshold', 'background_downscale_edge'])
+
+
+def init_background_detector_from_args(args):
+    """
+    :return: A BackgroundDetector, or None if --background_detector is not set.
+    """
+    if not getattr(args, 'background_detector', False):
+        return None
+    return BackgroundDetector(args.background_min_confidence, args.background_color_threshold,
+                              args.background_downscale_edge)
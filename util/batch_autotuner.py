@@ -0,0 +1,220 @@
+"""
+Pick the batch size of crop inference on the node it runs on. The autotuner starts small and doubles the batch size
+while the images per second improve, never above the size that the memory used per image predicts to stay under the
+RSS ceiling. During the run it halves the batch size when the process goes over the ceiling, the node runs low on
+available memory or inference runs out of memory, and it probes larger sizes again after a while without pressure.
+"""
+import math
+import os
+import resource
+import torch
+from torch.utils.data import Sampler
+from util.crop_engine import run_model
+from util.early_exit import EarlyExitOutput
+
+
+def get_rss_bytes():
+    """
+    :return: Resident set size of the current process.
+    """
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Peak RSS, in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_available_memory_bytes():
+    """
+    :return: Memory available on the node, or in the cgroup of the job if that is lower, None if it is unknown.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        with open('/sys/fs/cgroup/memory.max') as file:
+            limit = file.read().strip()
+        with open('/sys/fs/cgroup/memory.current') as file:
+            current = int(file.read())
+        if limit != 'max':
+            cgroup_available = int(limit) - current
+            available = cgroup_available if available is None else min(available, cgroup_available)
+    except (OSError, ValueError):
+        pass
+    return available
+
+
+def is_out_of_memory_error(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error) or "can't allocate memory" in str(error)
+
+
+class BatchAutotuner:
+    def __init__(self, initial_batch_size=1, max_batch_size=32, max_rss_bytes=None, min_available_bytes=1 << 30,
+                 batches_per_probe=3, min_speedup=1.05, reprobe_interval=200, metrics=None):
+        """
+        :param max_rss_bytes: RSS ceiling of the process, None for no ceiling.
+        :param min_available_bytes: Back off when the available memory of the node gets below this.
+        :param batches_per_probe: Number of batches timed at each batch size, the fastest one counts.
+        :param min_speedup: Minimum ratio of images per second for a larger batch size to be kept.
+        :param reprobe_interval: Number of batches without memory pressure after a back-off before probing again.
+        :param metrics: Optional CropMetrics that counts the back-offs.
+        """
+        self.batch_size = initial_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_rss_bytes = max_rss_bytes
+        self.min_available_bytes = min_available_bytes
+        self.batches_per_probe = batches_per_probe
+        self.min_speedup = min_speedup
+        self.reprobe_interval = reprobe_interval
+        self.metrics = metrics
+        # Memory of the process before the first batch, with the model loaded.
+        self.baseline_rss_bytes = get_rss_bytes()
+        self.bytes_per_image = 0
+        self.probing = True
+        self.throughputs = {}
+        self.best_batch_size = None
+        # Largest batch size allowed since the last back-off.
+        self.batch_size_cap = max_batch_size
+        self.batches_since_back_off = 0
+
+    def fits_in_memory(self, batch_size):
+        if self.max_rss_bytes is not None and \
+                self.baseline_rss_bytes + self.bytes_per_image * batch_size > self.max_rss_bytes:
+            return False
+        available = get_available_memory_bytes()
+        if available is not None and \
+                self.bytes_per_image * (batch_size - self.batch_size) > available - self.min_available_bytes:
+            return False
+        return True
+
+    def is_under_memory_pressure(self):
+        if self.max_rss_bytes is not None and get_rss_bytes() > self.max_rss_bytes:
+            return True
+        available = get_available_memory_bytes()
+        return available is not None and available < self.min_available_bytes
+
+    def back_off(self, reason):
+        new_batch_size = max(self.batch_size // 2, 1)
+        print(f"Batch size {self.batch_size} -> {new_batch_size}: {reason}.")
+        self.batch_size = new_batch_size
+        self.batch_size_cap = new_batch_size
+        self.best_batch_size = new_batch_size
+        self.probing = False
+        self.batches_since_back_off = 0
+        if self.metrics is not None:
+            self.metrics.increment_counter('batch_size_back_offs')
+
+    def settle(self, batch_size):
+        if self.probing:
+            print(f"Batch size tuned to {batch_size}.")
+        self.batch_size = batch_size
+        self.probing = False
+
+    def record_batch(self, number_of_images, seconds):
+        """
+        Update the batch size after a batch of number_of_images images took seconds to process.
+        """
+        if self.batch_size > 1 and self.is_under_memory_pressure():
+            self.back_off('memory pressure')
+            return
+        self.bytes_per_image = max(self.bytes_per_image,
+                                   (get_rss_bytes() - self.baseline_rss_bytes) / max(number_of_images, 1))
+        if not self.probing:
+            self.batches_since_back_off += 1
+            if self.batch_size_cap < self.max_batch_size and self.batches_since_back_off >= self.reprobe_interval:
+                self.batch_size_cap = min(self.batch_size_cap * 2, self.max_batch_size)
+                self.throughputs = {}
+                self.probing = True
+            else:
+                return
+        # The last batch of a folder can be smaller, it says nothing about the current batch size.
+        if number_of_images == self.batch_size and seconds > 0:
+            self.throughputs.setdefault(self.batch_size, []).append(number_of_images / seconds)
+        if len(self.throughputs.get(self.batch_size, [])) < self.batches_per_probe:
+            return
+
+        throughput = max(self.throughputs[self.batch_size])
+        if self.best_batch_size in self.throughputs and self.best_batch_size != self.batch_size and \
+                throughput < max(self.throughputs[self.best_batch_size]) * self.min_speedup:
+            self.settle(self.best_batch_size)
+            return
+        self.best_batch_size = self.batch_size
+        next_batch_size = min(self.batch_size * 2, self.batch_size_cap)
+        if next_batch_size == self.batch_size or not self.fits_in_memory(next_batch_size):
+            self.settle(self.batch_size)
+        else:
+            self.batch_size = next_batch_size
+
+
+def run_model_with_back_off(model, pixel_values, pixel_mask=None, precision='fp32', early_exit=None, autotuner=None):
+    """
+    run_model that halves the batch size of the autotuner and runs the batch in smaller chunks if it runs out of
+    memory.
+    """
+    try:
+        return run_model(model, pixel_values, pixel_mask, precision, early_exit)
+    except (RuntimeError, MemoryError) as e:
+        if autotuner is None or not is_out_of_memory_error(e) or len(pixel_values) == 1:
+            raise
+    autotuner.back_off('out of memory')
+    list_of_mask_chunks = pixel_mask.split(autotuner.batch_size) if pixel_mask is not None \
+        else [None] * len(pixel_values.split(autotuner.batch_size))
+    list_of_outputs = [run_model_with_back_off(model, chunk, mask_chunk, precision, early_exit, autotuner)
+                       for chunk, mask_chunk in zip(pixel_values.split(autotuner.batch_size), list_of_mask_chunks)]
+    return EarlyExitOutput(torch.cat([outputs.logits for outputs in list_of_outputs]),
+                           torch.cat([outputs.pred_boxes for outputs in list_of_outputs]),
+                           torch.cat([outputs.exit_layers for outputs in list_of_outputs])
+                           if early_exit is not None else None)
+
+
+class AutotunedBatchSampler(Sampler):
+    """
+    Batch sampler that asks the autotuner for the size of every batch, use it with a DataLoader without workers so
+    that the batches are drawn one at a time.
+    """
+
+    def __init__(self, number_of_items, autotuner):
+        self.number_of_items = number_of_items
+        self.autotuner = autotuner
+
+    def __iter__(self):
+        start = 0
+        while start < self.number_of_items:
+            end = min(start + self.autotuner.batch_size, self.number_of_items)
+            yield list(range(start, end))
+            start = end
+
+    def __len__(self):
+        # Only an estimate, the batch size changes during the run.
+        return math.ceil(self.number_of_items / self.autotuner.batch_size)
+
+
+def add_batch_autotuner_arguments(parser):
+    parser.add_argument('--auto_batch_size', default=False, action='store_true',
+                        help="Tune the batch size at startup and during the run, starting from --batch_size.")
+    parser.add_argument('--max_batch_size', type=int, default=32,
+                        help="Largest batch size tried by --auto_batch_size.")
+    parser.add_argument('--max_rss_gb', type=float, default=None,
+                        help="Memory ceiling of the job, shared by the inference workers, for --auto_batch_size.")
+    parser.add_argument('--min_available_memory_gb', type=float, default=1,
+                        help="Reduce the batch size when the available memory of the node gets below this.")
+
+
+def init_batch_autotuner_from_args(args, number_of_processes=1, metrics=None):
+    """
+    :param number_of_processes: Number of processes that share the memory ceiling, each with its own autotuner.
+    :return: A BatchAutotuner, or None if --auto_batch_size is not set.
+    """
+    if not getattr(args, 'auto_batch_size', False):
+        return None
+    max_rss_bytes = None
+    if args.max_rss_gb is not None:
+        max_rss_bytes = int(args.max_rss_gb * (1 << 30) / number_of_processes)
+    return BatchAutotuner(args.batch_size, args.max_batch_size, max_rss_bytes,
+                          int(args.min_available_memory_gb * (1 << 30)), metrics=metrics)
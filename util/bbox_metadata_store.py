@@ -0,0 +1,183 @@
+"""
+Writers for the per-image metadata of a crop run (original size, predicted bbox, score, crop box, ...).
+
+JsonBboxWriter keeps the original size_of_original_image_and_bbox.json format, which is held in memory until the end.
+ColumnarBboxWriter writes fixed-width columns in row groups of chunked NPZ files as the images are cropped, so the
+memory is bounded, and the columns of millions of records can be loaded and analysed with numpy. The filenames are
+stored once in filenames.txt and referred to by their line number.
+"""
+import json
+import os
+import numpy as np
+
+STATUS_OK = 0
+STATUS_FAILED = 1
+STATUS_REUSED = 2
+STATUS_DEDUPLICATED = 3
+
+COLUMNS = {'filename_id': (np.int64, ()), 'original_width': (np.int32, ()), 'original_height': (np.int32, ()),
+           'bbox': (np.float32, (4,)), 'score': (np.float32, ()), 'crop_box': (np.int32, (4,)),
+           'rotated': (np.bool_, ()), 'status': (np.uint8, ()), 'content_hash': ('S32', ())}
+
+
+class JsonBboxWriter:
+    def __init__(self, output_dir, file_name='size_of_original_image_and_bbox.json'):
+        self.path = os.path.join(output_dir, file_name)
+        self.list_of_original_image_size_and_bbox = []
+
+    def append(self, record):
+        self.list_of_original_image_size_and_bbox.append(
+            {key: record[key] for key in ['filename', 'original_size', 'bbox', 'score', 'content_hash',
+                                          'checkpoint_hash'] if key in record})
+
+    def close(self):
+        with open(self.path, 'w') as file:
+            json.dump(self.list_of_original_image_size_and_bbox, file)
+
+
+class ColumnarBboxWriter:
+    def __init__(self, output_dir, rows_per_group=65536, checkpoint_hash=None):
+        """
+        :param output_dir: Folder of the store, a previous store in it is appended to.
+        """
+        self.output_dir = output_dir
+        self.rows_per_group = rows_per_group
+        os.makedirs(output_dir, exist_ok=True)
+        filenames_path = os.path.join(output_dir, 'filenames.txt')
+        self.next_filename_id = 0
+        if os.path.exists(filenames_path):
+            with open(filenames_path) as file:
+                self.next_filename_id = sum(1 for _ in file)
+        self.filenames_file = open(filenames_path, 'a')
+        self.group_index = len(list_row_groups(output_dir))
+        self.columns = {name: np.zeros((rows_per_group,) + shape, dtype=dtype)
+                        for name, (dtype, shape) in COLUMNS.items()}
+        self.number_of_rows = 0
+        with open(os.path.join(output_dir, 'store_info.json'), 'w') as file:
+            json.dump({'checkpoint_hash': checkpoint_hash, 'columns': list(COLUMNS.keys())}, file)
+
+    def append(self, record):
+        """
+        :param record: Dictionary with filename, original_size, bbox and optionally score, crop_box, rotated, status
+        and content_hash.
+        """
+        row = self.number_of_rows
+        self.filenames_file.write(record['filename'] + '\n')
+        self.columns['filename_id'][row] = self.next_filename_id
+        self.next_filename_id += 1
+        self.columns['original_width'][row], self.columns['original_height'][row] = record['original_size']
+        self.columns['bbox'][row] = record['bbox']
+        self.columns['score'][row] = record.get('score', np.nan)
+        self.columns['crop_box'][row] = record.get('crop_box', (0, 0, 0, 0))
+        self.columns['rotated'][row] = record.get('rotated', False)
+        self.columns['status'][row] = record.get('status', STATUS_OK)
+        self.columns['content_hash'][row] = (record.get('content_hash') or '').encode()
+        self.number_of_rows += 1
+        if self.number_of_rows == self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        if self.number_of_rows == 0:
+            return
+        self.filenames_file.flush()
+        path = os.path.join(self.output_dir, f'row_group_{self.group_index:06d}.npz')
+        # Write to a temporary file first, so a crash never leaves a half written row group.
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, **{name: column[:self.number_of_rows] for name, column in self.columns.items()})
+        os.replace(path + '.tmp', path)
+        self.group_index += 1
+        self.number_of_rows = 0
+
+    def close(self):
+        self.flush()
+        self.filenames_file.close()
+
+
+def list_row_groups(store_dir):
+    return sorted(file_name for file_name in os.listdir(store_dir)
+                  if file_name.startswith('row_group_') and file_name.endswith('.npz'))
+
+
+def load_filenames(store_dir):
+    with open(os.path.join(store_dir, 'filenames.txt')) as file:
+        return np.array(file.read().splitlines())
+
+
+def load_columnar_store(store_dir, columns=None):
+    """
+    :param columns: Names of the columns to load, all of them by default.
+    :return: Dictionary from column name to the concatenated numpy array of all row groups.
+    """
+    if columns is None:
+        columns = list(COLUMNS.keys())
+    list_of_row_groups = [np.load(os.path.join(store_dir, file_name)) for file_name in list_row_groups(store_dir)]
+    return {name: np.concatenate([row_group[name] for row_group in list_of_row_groups])
+            if list_of_row_groups else np.zeros((0,) + COLUMNS[name][1], dtype=COLUMNS[name][0])
+            for name in columns}
+
+
+def load_columnar_records(store_dir):
+    """
+    :return: The records of a columnar store as dictionaries like the records of size_of_original_image_and_bbox.json,
+    with the content hash of the image and the checkpoint hash of store_info.json, or of sources.json for a merged
+    store.
+    """
+    with open(os.path.join(store_dir, 'store_info.json')) as file:
+        store_info = json.load(file)
+    filenames = load_filenames(store_dir)
+    has_sources = 'source_id' in store_info['columns']
+    if len(list_row_groups(store_dir)) == 0:
+        return []
+    columns = load_columnar_store(store_dir, list(COLUMNS.keys()) + (['source_id'] if has_sources else []))
+    if has_sources:
+        with open(os.path.join(store_dir, 'sources.json')) as file:
+            list_of_source_checkpoint_hash = [source['checkpoint_hash'] for source in json.load(file)]
+        list_of_checkpoint_hash = [list_of_source_checkpoint_hash[source_id]
+                                   for source_id in columns['source_id'].tolist()]
+    else:
+        list_of_checkpoint_hash = [store_info['checkpoint_hash']] * len(columns['filename_id'])
+    return [{'filename': str(filenames[filename_id]), 'original_size': (width, height), 'bbox': bbox,
+             'score': score, 'crop_box': crop_box, 'rotated': rotated, 'status': status,
+             'content_hash': content_hash.decode() or None, 'checkpoint_hash': checkpoint_hash}
+            for filename_id, width, height, bbox, score, crop_box, rotated, status, content_hash, checkpoint_hash
+            in zip(columns['filename_id'].tolist(), columns['original_width'].tolist(),
+                   columns['original_height'].tolist(), columns['bbox'].tolist(), columns['score'].tolist(),
+                   columns['crop_box'].tolist(), columns['rotated'].tolist(), columns['status'].tolist(),
+                   columns['content_hash'].tolist(), list_of_checkpoint_hash)]
+
+
+def merge_columnar_stores(list_of_store_dirs, output_dir, rows_per_group=1 << 20):
+    """
+    Merge the stores of several parts into one store, the filename ids are renumbered and a source_id column tells
+    which store each row comes from (the order of list_of_store_dirs, saved in sources.json).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sources = []
+    filename_id_offset = 0
+    group_index = 0
+    with open(os.path.join(output_dir, 'filenames.txt'), 'w') as filenames_file:
+        for source_id, store_dir in enumerate(list_of_store_dirs):
+            with open(os.path.join(store_dir, 'store_info.json')) as file:
+                sources.append(dict(json.load(file), store_dir=store_dir))
+            filenames = load_filenames(store_dir)
+            filenames_file.write(''.join(filename + '\n' for filename in filenames))
+            for file_name in list_row_groups(store_dir):
+                row_group = dict(np.load(os.path.join(store_dir, file_name)))
+                row_group['filename_id'] = row_group['filename_id'] + filename_id_offset
+                row_group['source_id'] = np.full(len(row_group['filename_id']), source_id, dtype=np.int32)
+                for start in range(0, len(row_group['filename_id']), rows_per_group):
+                    np.savez(os.path.join(output_dir, f'row_group_{group_index:06d}.npz'),
+                             **{name: column[start: start + rows_per_group] for name, column in row_group.items()})
+                    group_index += 1
+            filename_id_offset += len(filenames)
+    with open(os.path.join(output_dir, 'store_info.json'), 'w') as file:
+        json.dump({'checkpoint_hash': None, 'columns': list(COLUMNS.keys()) + ['source_id']}, file)
+    with open(os.path.join(output_dir, 'sources.json'), 'w') as file:
+        json.dump(sources, file, indent=4)
+
+
+def init_metadata_writer(args, output_dir):
+    if args.metadata_format == 'columnar':
+        return ColumnarBboxWriter(os.path.join(output_dir, 'bbox_metadata'),
+                                  checkpoint_hash=getattr(args, 'checkpoint_hash', None))
+    return JsonBboxWriter(output_dir)
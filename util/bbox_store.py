@@ -0,0 +1,66 @@
+"""
+The predicted bounding boxes saved in size_of_original_image_and_bbox.json, keyed by filename. Each record can carry
+the hash of the image content and the hash of the checkpoint that predicted the box, so a stored box is only reused
+for the same image and the same model.
+"""
+import hashlib
+import json
+import os
+from util.bbox_metadata_store import STATUS_FAILED, load_columnar_records
+
+_checkpoint_hash_cache = {}
+
+
+def hash_bytes(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def hash_file(path, chunk_size=1 << 22):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_checkpoint_hash(checkpoint_path):
+    """
+    Hash of the checkpoint file, cached by path, size and modification time since the checkpoints are large.
+    """
+    stat = os.stat(checkpoint_path)
+    key = (os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime)
+    if key not in _checkpoint_hash_cache:
+        _checkpoint_hash_cache[key] = hash_file(checkpoint_path)
+    return _checkpoint_hash_cache[key]
+
+
+def load_bbox_store(path):
+    """
+    :param path: A size_of_original_image_and_bbox.json file, or the folder of a columnar store of
+    util/bbox_metadata_store.py.
+    :return: Dictionary from filename to its record, the last record wins if a filename appears twice.
+    """
+    if os.path.isdir(path):
+        list_of_original_image_size_and_bbox = load_columnar_records(path)
+    else:
+        with open(path) as file:
+            list_of_original_image_size_and_bbox = json.load(file)
+    return {record['filename']: record for record in list_of_original_image_size_and_bbox}
+
+
+def find_stored_bbox(bbox_store, filename, image_size, content_hash, checkpoint_hash,
+                     accept_records_without_hash=False):
+    """
+    :return: The stored bbox of the image, or None if there is no record, the image failed, or the record is for
+    different image content, a different image size or a different checkpoint.
+    """
+    record = bbox_store.get(filename)
+    if record is None or record.get('status') == STATUS_FAILED:
+        return None
+    if list(record['original_size']) != list(image_size):
+        return None
+    if 'content_hash' not in record or 'checkpoint_hash' not in record:
+        return record['bbox'] if accept_records_without_hash else None
+    if record['content_hash'] != content_hash or record['checkpoint_hash'] != checkpoint_hash:
+        return None
+    return record['bbox']
@@ -0,0 +1,172 @@
+"""
+A persistent content-addressed index of the crop outputs. An output is keyed by the hash of the input bytes, the hash
+of the checkpoint and the hash of the crop parameters, so identical images in other folders, parts or reruns are
+linked to the existing output instead of being decoded and inferred again. Identical images within one run are cropped
+once and linked after the run.
+
+The outputs are hard linked when possible, so the sinks remove a file before writing it: writing through the link
+would change the output it is linked to, which stays in the index under its old key.
+"""
+import json
+import os
+import sqlite3
+from util.bbox_metadata_store import STATUS_DEDUPLICATED, STATUS_OK
+from util.bbox_store import hash_file, hash_bytes
+from util.file_utils import link_or_copy
+
+# Arguments that change the cropped image, their values are part of the key of an output.
+CROP_PARAMETER_NAMES = ['crop_ratio', 'fix_ratio', 'equal_extend', 'rotate_image', 'show_bbox', 'width_of_bbox',
+                        'background_color_R', 'background_color_G', 'background_color_B',
+                        'inference_shortest_edge', 'inference_longest_edge', 'precision']
+
+# Name -> default of the arguments registered by the add_*_arguments helpers with register_crop_parameters.
+_registered_crop_parameters = {}
+
+
+def register_crop_parameters(parser, list_of_names):
+    """
+    Called by the add_*_arguments helpers for their arguments that change the box or the bytes of an output, so they
+    are part of the key of the outputs in every script that adds them.
+    """
+    for name in list_of_names:
+        _registered_crop_parameters[name] = parser.get_default(name)
+
+
+def get_crop_params_hash(args):
+    crop_parameters = {name: getattr(args, name, None) for name in CROP_PARAMETER_NAMES}
+    # The registered arguments are only part of the key when they differ from their default, so the keys do not
+    # depend on which helpers a script uses, and the outputs indexed before an argument existed are still found.
+    for name, default in _registered_crop_parameters.items():
+        if name not in CROP_PARAMETER_NAMES and getattr(args, name, default) != default:
+            crop_parameters[name] = getattr(args, name)
+    return hash_bytes(json.dumps(crop_parameters, sort_keys=True).encode())
+
+
+class ContentIndex:
+    def __init__(self, path, commit_every=256):
+        """
+        :param path: Path to the sqlite database, created if it does not exist.
+        :param commit_every: Number of added outputs between two commits.
+        """
+        self.connection = sqlite3.connect(path, timeout=60)
+        # Write-ahead logging lets several crop processes read while one writes.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS outputs (content_hash TEXT, checkpoint_hash TEXT, '
+                                'params_hash TEXT, output_path TEXT, record TEXT, '
+                                'PRIMARY KEY (content_hash, checkpoint_hash, params_hash))')
+        self.connection.commit()
+        self.commit_every = commit_every
+        self.number_of_uncommitted = 0
+
+    def lookup(self, content_hash, checkpoint_hash, params_hash):
+        """
+        :return: The output path and the record of the output, or None if there is none or its file is gone.
+        """
+        row = self.connection.execute('SELECT output_path, record FROM outputs WHERE content_hash = ? AND '
+                                      'checkpoint_hash = ? AND params_hash = ?',
+                                      (content_hash, checkpoint_hash, params_hash)).fetchone()
+        if row is None or not os.path.exists(row[0]):
+            return None
+        return row[0], json.loads(row[1])
+
+    def lookup_record(self, content_hash, checkpoint_hash, params_hash):
+        """
+        :return: The record of the output, or None if there is none, even if its file is gone. Its bbox can be reused
+        to crop the image again without running the model.
+        """
+        row = self.connection.execute('SELECT record FROM outputs WHERE content_hash = ? AND checkpoint_hash = ? AND '
+                                      'params_hash = ?', (content_hash, checkpoint_hash, params_hash)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def add(self, content_hash, checkpoint_hash, params_hash, output_path, record):
+        self.connection.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                                (content_hash, checkpoint_hash, params_hash, os.path.abspath(output_path),
+                                 json.dumps(record)))
+        self.number_of_uncommitted += 1
+        if self.number_of_uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.number_of_uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+class IndexingMetadataWriter:
+    """
+    Wrap a metadata writer from util/bbox_metadata_store.py and add every successfully cropped image to the index.
+    """
+
+    def __init__(self, metadata_writer, content_index, output_dir, checkpoint_hash, params_hash):
+        self.metadata_writer = metadata_writer
+        self.content_index = content_index
+        self.output_dir = output_dir
+        self.checkpoint_hash = checkpoint_hash
+        self.params_hash = params_hash
+
+    def append(self, record):
+        self.metadata_writer.append(record)
+        if record.get('status', STATUS_OK) == STATUS_OK and record.get('content_hash') is not None:
+            self.content_index.add(record['content_hash'], self.checkpoint_hash, self.params_hash,
+                                   os.path.join(self.output_dir, record['filename']), record)
+
+    def close(self):
+        self.metadata_writer.close()
+        self.content_index.close()
+
+
+def reuse_indexed_outputs(args, list_of_file_name, content_index, params_hash, metadata_writer, metrics=None):
+    """
+    Link the existing output of every image that is already in the index into args.output_dir.
+    :return: The filenames that still have to be cropped, a dictionary from filename to its content hash, and the
+    filenames whose content is the same as the one of an image to crop, for link_duplicate_outputs after the run.
+    """
+    list_of_file_name_to_crop = []
+    list_of_duplicate_file_name = []
+    content_hashes = {}
+    content_hashes_to_crop = set()
+    for filename in list_of_file_name:
+        content_hash = hash_file(os.path.join(args.input_dir, filename))
+        content_hashes[filename] = content_hash
+        indexed_output = content_index.lookup(content_hash, args.checkpoint_hash, params_hash)
+        if indexed_output is None:
+            if content_hash in content_hashes_to_crop:
+                list_of_duplicate_file_name.append(filename)
+            else:
+                content_hashes_to_crop.add(content_hash)
+                list_of_file_name_to_crop.append(filename)
+            continue
+        output_path, record = indexed_output
+        destination = os.path.join(args.output_dir, filename)
+        if os.path.abspath(output_path) != os.path.abspath(destination):
+            link_or_copy(output_path, destination)
+        metadata_writer.append(dict(record, filename=filename, status=STATUS_DEDUPLICATED))
+        if metrics is not None:
+            metrics.add_images(1)
+            metrics.increment_counter('deduplicated')
+    return list_of_file_name_to_crop, content_hashes, list_of_duplicate_file_name
+
+
+def link_duplicate_outputs(args, list_of_duplicate_file_name, content_hashes, content_index, params_hash,
+                           metadata_writer, metrics=None):
+    """
+    Link the outputs that the run cropped to the images with the same content, call it before closing the writer.
+    The duplicates of an image that failed are counted as failed and have no record, like the images not found.
+    """
+    content_index.commit()
+    for filename in list_of_duplicate_file_name:
+        indexed_output = content_index.lookup(content_hashes[filename], args.checkpoint_hash, params_hash)
+        if indexed_output is None:
+            print(f"Failed to crop {filename}: its duplicate failed.")
+            if metrics is not None:
+                metrics.record_failure('DuplicateOfFailedImage')
+            continue
+        output_path, record = indexed_output
+        link_or_copy(output_path, os.path.join(args.output_dir, filename))
+        metadata_writer.append(dict(record, filename=filename, status=STATUS_DEDUPLICATED))
+        if metrics is not None:
+            metrics.add_images(1)
+            metrics.increment_counter('deduplicated')
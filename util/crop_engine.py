@@ -0,0 +1,281 @@
+import os
+import numpy as np
+import torch
+from PIL import ImageDraw, ImageOps
+from transformers import DetrFeatureExtractor
+from model.detr import load_model_from_ckpt
+from model.precision import get_inference_context
+from model.student import is_student_checkpoint, load_student_from_ckpt
+from util.content_index import register_crop_parameters
+from util.visualize_and_process_bbox import get_top_bbox_and_score_for_batch, scale_bbox
+
+
+def expand_image(args, image, size, direction):
+    border_color = (args.background_color_R, args.background_color_G, args.background_color_B)
+    border_image = None
+    if direction == 'left':
+        border_image = ImageOps.expand(image, border=(size, 0, 0, 0), fill=border_color)
+    elif direction == 'top':
+        border_image = ImageOps.expand(image, border=(0, size, 0, 0), fill=border_color)
+    elif direction == 'right':
+        border_image = ImageOps.expand(image, border=(0, 0, size, 0), fill=border_color)
+    elif direction == 'bottom':
+        border_image = ImageOps.expand(image, border=(0, 0, 0, size), fill=border_color)
+    else:
+        exit("Wrong expand direction.")
+
+    return border_image
+
+
+def rotate_image_and_bbox_if_necesscary(image, left, top, right, bottom):
+    image_size = image.size
+    image = image.rotate(90, expand=True)
+    new_left = top
+    new_right = bottom
+    new_bottom = image_size[0] - left
+    new_top = image_size[0] - right
+
+    return image, new_left, new_top, new_right, new_bottom
+
+
+def change_size_to_4_3(left, top, right, bottom):
+    width = right - left
+    height = bottom - top
+    if width < height / 3 * 4:
+        extend_length = height / 3 * 4 - width
+        left = left - extend_length / 2
+        right = right + extend_length - extend_length / 2
+
+    elif height < width / 4 * 3:
+        extend_length = width / 4 * 3 - height
+        top = top - extend_length / 2
+        bottom = bottom + extend_length - extend_length / 2
+    return left, top, right, bottom
+
+
+def set_inference_resolution(feature_extractor, shortest_edge, longest_edge):
+    """
+    Change the size the feature extractor resizes the images to before the model, by default shortest edge 800 and
+    longest edge 1333. The inference cost scales roughly with the number of pixels.
+    """
+    if isinstance(feature_extractor.size, dict):
+        feature_extractor.size = {"shortest_edge": shortest_edge, "longest_edge": longest_edge}
+    else:
+        feature_extractor.size = shortest_edge
+        feature_extractor.max_size = longest_edge
+    return feature_extractor
+
+
+def init_feature_extractor(shortest_edge=800, longest_edge=1333):
+    feature_extractor = DetrFeatureExtractor.from_pretrained("facebook/detr-resnet-50")
+    return set_inference_resolution(feature_extractor, shortest_edge, longest_edge)
+
+
+def load_crop_model(args):
+    """
+    Load the Detr model or the distilled Student model of args.checkpoint_path, whichever it is.
+    :return: The model and the feature extractor that prepares its inputs, at the inference resolution of args for
+    Detr.
+    """
+    checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
+    if is_student_checkpoint(checkpoint):
+        model = load_student_from_ckpt(args, checkpoint)
+        return model, model.get_feature_extractor()
+    return load_model_from_ckpt(args, checkpoint), init_feature_extractor(getattr(args, 'inference_shortest_edge', 800),
+                                                              getattr(args, 'inference_longest_edge', 1333))
+
+
+def get_image_size(image):
+    """
+    :param image: PIL image or image tensor in C x H x W.
+    :return: (width, height) of the image.
+    """
+    if isinstance(image, torch.Tensor):
+        return image.shape[-1], image.shape[-2]
+    return image.size
+
+
+def preprocess_images(feature_extractor, list_of_images, device):
+    """
+    :param list_of_images: PIL images or image tensors, anything that the feature extractor accepts.
+    :return: pixel_values and pixel_mask ready for the model. Images of different sizes are padded to the largest one,
+    the pixel mask tells the model which pixels are padding.
+    """
+    encoding = feature_extractor(images=list_of_images, return_tensors="pt").to(device)
+    return encoding["pixel_values"], encoding["pixel_mask"]
+
+
+def run_model(model, pixel_values, pixel_mask=None, precision='fp32', early_exit=None):
+    """
+    :param pixel_mask: Pixel mask from preprocess_images, None if no image of the batch is padded.
+    :param precision: One of model.precision.PRECISION_MODES, the model should be converted by apply_precision.
+    :param early_exit: Optional EarlyExitDecoder from util/early_exit.py, the outputs then also have exit_layers.
+    """
+    with torch.no_grad(), get_inference_context(precision):
+        if early_exit is not None:
+            return early_exit(model, pixel_values, pixel_mask)
+        return model(pixel_values=pixel_values, pixel_mask=pixel_mask)
+
+
+def postprocess_outputs(outputs, list_of_images):
+    """
+    Keep the bounding box with the highest confidence for each image and scale it to the image size.
+    :return: Numpy array of bounding boxes in (left, top, right, bottom) and a numpy array of their scores.
+    """
+    image_sizes = [get_image_size(image) for image in list_of_images]
+    bboxes, scores = get_top_bbox_and_score_for_batch(outputs.logits, outputs.pred_boxes, image_sizes)
+    return bboxes.numpy(), scores.numpy()
+
+
+def predict_bboxes_and_scores(model, feature_extractor, list_of_images, device, precision='fp32', early_exit=None,
+                              background_detector=None):
+    """
+    Run the model on a batch of images and keep the bounding box with the highest confidence for each image.
+    :param list_of_images: PIL images or image tensors, anything that the feature extractor accepts.
+    :param precision: One of model.precision.PRECISION_MODES, the model should be converted by apply_precision.
+    :param early_exit: Optional EarlyExitDecoder from util/early_exit.py.
+    :param background_detector: Optional BackgroundDetector from util/background_detector.py, the images it is
+    confident about keep its box and its confidence as the score, and only the others go through the model.
+    :return: Numpy array of bounding boxes in (left, top, right, bottom) and a numpy array of their scores.
+    """
+    if background_detector is not None:
+        bboxes, scores, confident = background_detector.detect_batch(list_of_images)
+        ambiguous = np.flatnonzero(~confident)
+        if len(ambiguous) > 0:
+            bboxes[ambiguous], scores[ambiguous] = predict_bboxes_and_scores(
+                model, feature_extractor, [list_of_images[index] for index in ambiguous], device, precision,
+                early_exit)
+        return bboxes, scores
+    pixel_values, pixel_mask = preprocess_images(feature_extractor, list_of_images, device)
+    outputs = run_model(model, pixel_values, pixel_mask, precision, early_exit)
+    return postprocess_outputs(outputs, list_of_images)
+
+
+def load_calibration_images(input_dir, number_of_images, codec):
+    """
+    :return: The first number_of_images images of input_dir in sorted order, the files that codec can not decode are
+    skipped.
+    """
+    list_of_images = []
+    for filename in sorted(os.listdir(input_dir)):
+        if len(list_of_images) == number_of_images:
+            break
+        try:
+            list_of_images.append(codec.read(os.path.join(input_dir, filename)))
+        except (OSError, ValueError):
+            continue
+    return list_of_images
+
+
+def get_calibration_pixel_values(feature_extractor, list_of_images):
+    """
+    :return: List of pixel_values, one per image, used to calibrate the static quantization.
+    """
+    return [feature_extractor(images=[image], return_tensors="pt")["pixel_values"] for image in list_of_images]
+
+
+def get_crop_box(args, image_size, bbox):
+    """
+    Scale the predicted bounding box, and optionally extend it to 4:3, rotating the image by 90 degrees if the insect
+    is taller than wide and args.rotate_image is set.
+    :param image_size: (width, height) of the image the bounding box was predicted on.
+    :param bbox: Bounding box in (left, top, right, bottom).
+    :return: The crop box (left, top, right, bottom) in the possibly rotated image, it can go beyond the image, and
+    whether the image has to be rotated.
+    """
+    left, top, right, bottom = scale_bbox(args, bbox[0], bbox[1], bbox[2], bbox[3])
+    rotated = False
+
+    if args.fix_ratio:
+        width = right - left
+        height = bottom - top
+
+        if height > width and args.rotate_image:
+            # Same as rotate_image_and_bbox_if_necesscary without rotating the image.
+            left, top, right, bottom = top, image_size[0] - right, bottom, image_size[0] - left
+            rotated = True
+
+        left, top, right, bottom = change_size_to_4_3(left, top, right, bottom)
+        left = round(left)
+        top = round(top)
+        right = round(right)
+        bottom = round(bottom)
+
+    return (left, top, right, bottom), rotated
+
+
+def make_crop_record(args, filename, image_size, bbox, score, content_hash=None, checkpoint_hash=None, status=0):
+    """
+    :return: Dictionary with the metadata of one cropped image, as stored by util/bbox_metadata_store.py.
+    """
+    crop_box, rotated = get_crop_box(args, image_size, bbox)
+    return {'filename': filename, 'original_size': tuple(image_size), 'bbox': [float(value) for value in bbox],
+            'score': float(score), 'crop_box': [int(value) for value in crop_box], 'rotated': rotated,
+            'status': status, 'content_hash': content_hash, 'checkpoint_hash': checkpoint_hash}
+
+
+def crop_image_with_bbox(args, image, bbox):
+    """
+    Crop the image with the box from get_crop_box, padding the image with the background color where the box goes
+    beyond the image.
+    :param image: PIL image the bounding box was predicted on.
+    :param bbox: Bounding box in (left, top, right, bottom).
+    :return: The cropped image.
+    """
+    if args.show_bbox:
+        draw = ImageDraw.Draw(image)
+        draw.rectangle((bbox[0], bbox[1], bbox[2], bbox[3]), outline=(255, 0, 0), width=args.width_of_bbox)
+    (left, top, right, bottom), rotated = get_crop_box(args, image.size, bbox)
+    if rotated:
+        image = image.rotate(90, expand=True)
+
+    # Pad the image if the box goes beyond it.
+
+    if left < 0:
+        border_size = 0 - left
+        right = right - left
+        left = 0
+        image = expand_image(args, image, border_size, 'left')
+
+    if top < 0:
+        border_size = 0 - top
+        bottom = bottom - top
+        top = 0
+        image = expand_image(args, image, border_size, 'top')
+
+    if right > image.size[0]:
+        border_size = right - image.size[0] + 1
+        image = expand_image(args, image, border_size, 'right')
+
+    if bottom > image.size[1]:
+        border_size = bottom - image.size[1] + 1
+        image = expand_image(args, image, border_size, 'bottom')
+
+    return image.crop((left, top, right, bottom))
+
+
+def add_crop_arguments(parser):
+    """
+    Add the arguments that control the crop geometry, same as in scripts/crop_images.py.
+    """
+    parser.add_argument('--crop_ratio', type=float, default=1.4,
+                        help="Scale the bbox to crop larger or small area.")
+    parser.add_argument('--show_bbox', default=False,
+                        action='store_true')
+    parser.add_argument('--width_of_bbox', type=int, default=3,
+                        help="Define the width of the bound of bounding boxes.")
+    parser.add_argument('--fix_ratio', default=False,
+                        action='store_true', help='Further extent the image to make the ratio in 4:3.')
+    parser.add_argument('--equal_extend', default=True,
+                        action='store_true', help='Extand equal size in both height and width.')
+    parser.add_argument('--rotate_image', default=False,
+                        action='store_true', help='Rotate the insect to fit 4:3 naturally.')
+    parser.add_argument('--background_color_R', type=int, default=234,
+                        help="Define the background color's R value.")
+    parser.add_argument('--background_color_G', type=int, default=242,
+                        help="Define the background color's G value.")
+    parser.add_argument('--background_color_B', type=int, default=245,
+                        help="Define the background color's B value.")
+    register_crop_parameters(parser, ['crop_ratio', 'show_bbox', 'width_of_bbox', 'fix_ratio', 'equal_extend',
+                                      'rotate_image', 'background_color_R', 'background_color_G',
+                                      'background_color_B'])
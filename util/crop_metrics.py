@@ -0,0 +1,244 @@
+"""
+Instrumentation of the crop pipeline: per-stage latency histograms, images per second, queue depths, bytes read and
+written and failure counts. Snapshots can be written periodically as JSON lines and as a Prometheus textfile
+collector file, and a sampling profiler can record where the time goes without attaching a profiler by hand.
+"""
+import collections
+import contextlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets in seconds.
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf')]
+
+
+class CropMetrics:
+    def __init__(self, metrics_dir=None, snapshot_interval=60, job_name='crop'):
+        """
+        :param metrics_dir: Folder for metrics.jsonl and metrics.prom, no snapshot is written if it is None.
+        :param snapshot_interval: Minimum number of seconds between two snapshots.
+        """
+        self.metrics_dir = metrics_dir
+        self.snapshot_interval = snapshot_interval
+        self.job_name = job_name
+        self.hostname = socket.gethostname()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_snapshot_time = None
+        self.last_snapshot_images = 0
+        self.stage_bucket_counts = collections.defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.stage_sums = collections.defaultdict(float)
+        self.stage_counts = collections.defaultdict(int)
+        self.images = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.failures = collections.Counter()
+        self.counters = collections.Counter()
+        self.queue_depths = {}
+        self.labels = {}
+        self.profiler = None
+        if metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+    def observe_stage(self, stage, seconds, count=1):
+        """
+        Record that a stage took the given seconds, count is the number of observations it stands for.
+        """
+        with self.lock:
+            for index, upper_bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= upper_bound:
+                    self.stage_bucket_counts[stage][index] += count
+                    break
+            self.stage_sums[stage] += seconds * count
+            self.stage_counts[stage] += count
+
+    @contextlib.contextmanager
+    def time_stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def add_images(self, number_of_images):
+        with self.lock:
+            self.images += number_of_images
+
+    def add_bytes_read(self, number_of_bytes):
+        with self.lock:
+            self.bytes_read += number_of_bytes
+
+    def add_bytes_written(self, number_of_bytes):
+        with self.lock:
+            self.bytes_written += number_of_bytes
+
+    def record_failure(self, reason):
+        with self.lock:
+            self.failures[reason] += 1
+
+    def increment_counter(self, counter_name, value=1):
+        """
+        Count an event that is neither a failure nor a processed image, for example a deduplicated image.
+        """
+        with self.lock:
+            self.counters[counter_name] += value
+
+    def set_queue_depth(self, queue_name, depth):
+        with self.lock:
+            self.queue_depths[queue_name] = depth
+
+    def set_label(self, name, value):
+        """
+        Extra information attached to every snapshot, for example the current part.
+        """
+        with self.lock:
+            self.labels[name] = value
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            elapsed = now - self.start_time
+            if self.last_snapshot_time is None:
+                recent_images_per_second = self.images / elapsed if elapsed > 0 else 0.0
+            else:
+                interval = now - self.last_snapshot_time
+                recent_images_per_second = (self.images - self.last_snapshot_images) / interval if interval > 0 \
+                    else 0.0
+            stages = {}
+            for stage, bucket_counts in self.stage_bucket_counts.items():
+                stages[stage] = {'count': self.stage_counts[stage], 'sum_seconds': self.stage_sums[stage],
+                                 'mean_seconds': self.stage_sums[stage] / max(self.stage_counts[stage], 1),
+                                 'bucket_counts': list(bucket_counts)}
+            return {'time': now, 'job': self.job_name, 'hostname': self.hostname, 'pid': os.getpid(),
+                    'labels': dict(self.labels), 'elapsed_seconds': elapsed, 'images': self.images,
+                    'images_per_second': self.images / elapsed if elapsed > 0 else 0.0,
+                    'recent_images_per_second': recent_images_per_second,
+                    'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                    'failures': dict(self.failures), 'counters': dict(self.counters),
+                    'queue_depths': dict(self.queue_depths), 'stages': stages}
+
+    def to_prometheus_text(self, snapshot=None):
+        if snapshot is None:
+            snapshot = self.snapshot()
+        job = f'job="{self.job_name}"'
+        lines = ['# TYPE croptool_stage_seconds histogram']
+        for stage, stage_snapshot in snapshot['stages'].items():
+            cumulative_count = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, stage_snapshot['bucket_counts']):
+                cumulative_count += count
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                lines.append(f'croptool_stage_seconds_bucket{{{job},stage="{stage}",le="{le}"}} {cumulative_count}')
+            lines.append(f'croptool_stage_seconds_sum{{{job},stage="{stage}"}} {stage_snapshot["sum_seconds"]}')
+            lines.append(f'croptool_stage_seconds_count{{{job},stage="{stage}"}} {stage_snapshot["count"]}')
+        lines.append('# TYPE croptool_images_total counter')
+        lines.append(f'croptool_images_total{{{job}}} {snapshot["images"]}')
+        lines.append('# TYPE croptool_images_per_second gauge')
+        lines.append(f'croptool_images_per_second{{{job}}} {snapshot["recent_images_per_second"]}')
+        lines.append('# TYPE croptool_bytes_read_total counter')
+        lines.append(f'croptool_bytes_read_total{{{job}}} {snapshot["bytes_read"]}')
+        lines.append('# TYPE croptool_bytes_written_total counter')
+        lines.append(f'croptool_bytes_written_total{{{job}}} {snapshot["bytes_written"]}')
+        lines.append('# TYPE croptool_failures_total counter')
+        for reason, count in snapshot['failures'].items():
+            lines.append(f'croptool_failures_total{{{job},reason="{reason}"}} {count}')
+        lines.append('# TYPE croptool_events_total counter')
+        for counter_name, count in snapshot['counters'].items():
+            lines.append(f'croptool_events_total{{{job},event="{counter_name}"}} {count}')
+        lines.append('# TYPE croptool_queue_depth gauge')
+        for queue_name, depth in snapshot['queue_depths'].items():
+            lines.append(f'croptool_queue_depth{{{job},queue="{queue_name}"}} {depth}')
+        return '\n'.join(lines) + '\n'
+
+    def write_snapshot(self):
+        snapshot = self.snapshot()
+        with open(os.path.join(self.metrics_dir, 'metrics.jsonl'), 'a') as file:
+            file.write(json.dumps(snapshot) + '\n')
+        # Write to a temporary file first, so the node exporter never reads a half written file.
+        prometheus_path = os.path.join(self.metrics_dir, 'metrics.prom')
+        with open(prometheus_path + '.tmp', 'w') as file:
+            file.write(self.to_prometheus_text(snapshot))
+        os.replace(prometheus_path + '.tmp', prometheus_path)
+        with self.lock:
+            self.last_snapshot_time = snapshot['time']
+            self.last_snapshot_images = snapshot['images']
+        return snapshot
+
+    def maybe_write_snapshot(self):
+        """
+        Write a snapshot if the snapshot interval has passed since the last one, cheap enough to call per image.
+        """
+        if self.metrics_dir is None:
+            return None
+        last_snapshot_time = self.last_snapshot_time if self.last_snapshot_time is not None else self.start_time
+        if time.time() - last_snapshot_time >= self.snapshot_interval:
+            return self.write_snapshot()
+        return None
+
+    def start_profiler(self, output_path, interval=0.01):
+        self.profiler = SamplingProfiler(output_path, interval)
+        self.profiler.start()
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.metrics_dir is not None:
+            self.write_snapshot()
+
+
+class SamplingProfiler:
+    """
+    Sample the stack of one thread at a fixed interval and write the counts as collapsed stacks, which can be
+    rendered by flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, output_path, interval=0.01, thread_id=None):
+        self.output_path = output_path
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stack_counts = collections.Counter()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stack_counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        with open(self.output_path, 'w') as file:
+            for stack, count in self.stack_counts.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics_dir', type=str, default=None,
+                        help="Folder to write metrics.jsonl and the Prometheus textfile metrics.prom.")
+    parser.add_argument('--metrics_interval', type=float, default=60,
+                        help="Seconds between two metrics snapshots.")
+    parser.add_argument('--profile_output', type=str, default=None,
+                        help="Run the sampling profiler and write the collapsed stacks to this path.")
+    parser.add_argument('--profile_interval', type=float, default=0.01,
+                        help="Seconds between two samples of the sampling profiler.")
+
+
+def init_metrics_from_args(args, job_name='crop'):
+    metrics = CropMetrics(args.metrics_dir, args.metrics_interval, job_name)
+    if args.profile_output is not None:
+        metrics.start_profiler(args.profile_output, args.profile_interval)
+    return metrics
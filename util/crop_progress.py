@@ -0,0 +1,143 @@
+"""
+Per-part progress manifests of the cluster runs of scripts/copy_to_local_then_crop_images_6M.py. The node that crops a
+part rewrites a small JSON file for it in a shared folder (--progress_dir) every --progress_interval seconds, so
+scripts/crop_status.py follows all the parts of a run from these manifests alone, without opening the crops or the
+metadata of the parts.
+"""
+import collections
+import json
+import os
+import socket
+import time
+
+# The input of the part is being copied and extracted, the manifest is not updated until the cropping starts.
+STATUS_COPYING = 'copying'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def get_manifest_path(progress_dir, part):
+    return os.path.join(progress_dir, f'part{part}.json')
+
+
+def load_manifest(manifest_path):
+    """
+    :return: The record of the manifest, or None if it does not exist or can not be parsed.
+    """
+    try:
+        with open(manifest_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+class PartProgress:
+    def __init__(self, progress_dir, part, write_interval=30):
+        """
+        :param progress_dir: Shared folder of the manifests of all the parts of the run.
+        :param part: Index of the part at the end of the zip name.
+        :param write_interval: Minimum number of seconds between two writes of the manifest.
+        """
+        self.progress_dir = progress_dir
+        self.part = part
+        self.write_interval = write_interval
+        self.manifest_path = get_manifest_path(progress_dir, part)
+        self.hostname = socket.gethostname()
+        self.start_time = time.time()
+        self.status = STATUS_RUNNING
+        self.error = None
+        self.total_images = None
+        # Images cropped by an earlier attempt at the part, a resumed part does not crop them again.
+        self.images_before = 0
+        self.images = 0
+        self.failures = collections.Counter()
+        self.last_write_time = None
+        self.last_write_images = 0
+        self.recent_images_per_second = 0.0
+        os.makedirs(progress_dir, exist_ok=True)
+        previous_record = load_manifest(self.manifest_path)
+        if previous_record is None:
+            self.first_start_time = self.start_time
+            self.attempts = 1
+        else:
+            self.first_start_time = previous_record.get('first_start_time', self.start_time)
+            self.attempts = previous_record.get('attempts', 1) + 1
+
+    def start_copying(self):
+        """
+        Called before the input of the part is copied, so the part shows in crop_status.py without being stalled.
+        """
+        self.status = STATUS_COPYING
+        self.write()
+
+    def start(self, total_images, images_done=0):
+        """
+        Called once the images of the part are known, writes the manifest.
+        :param total_images: Number of images of the part.
+        :param images_done: Number of images of the part that were already cropped.
+        """
+        # The images per second only count the time spent cropping, not the copy of the input.
+        self.start_time = time.time()
+        self.last_write_time = None
+        self.status = STATUS_RUNNING
+        self.total_images = total_images
+        self.images_before = images_done
+        self.write()
+
+    def add_images(self, number_of_images):
+        self.images += number_of_images
+
+    def record_failure(self, reason):
+        self.failures[reason] += 1
+
+    def to_record(self, now):
+        elapsed = now - self.start_time
+        return {'part': self.part, 'status': self.status, 'hostname': self.hostname, 'pid': os.getpid(),
+                'attempts': self.attempts, 'first_start_time': self.first_start_time, 'start_time': self.start_time,
+                'update_time': now, 'total_images': self.total_images,
+                'images_done': self.images_before + self.images, 'images_cropped': self.images,
+                'images_failed': sum(self.failures.values()), 'failures': dict(self.failures),
+                'images_per_second': self.images / elapsed if elapsed > 0 else 0.0,
+                'recent_images_per_second': self.recent_images_per_second, 'error': self.error}
+
+    def write(self):
+        now = time.time()
+        last_write_time = self.last_write_time if self.last_write_time is not None else self.start_time
+        if now > last_write_time:
+            self.recent_images_per_second = (self.images - self.last_write_images) / (now - last_write_time)
+        record = self.to_record(now)
+        # Write to a temporary file first, so crop_status.py never reads a half written manifest.
+        with open(self.manifest_path + '.tmp', 'w') as file:
+            json.dump(record, file)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        self.last_write_time = now
+        self.last_write_images = self.images
+        return record
+
+    def maybe_write(self):
+        """
+        Write the manifest if the write interval has passed since the last write, cheap enough to call per image.
+        """
+        last_write_time = self.last_write_time if self.last_write_time is not None else self.start_time
+        if time.time() - last_write_time >= self.write_interval:
+            return self.write()
+        return None
+
+    def finish(self, status=STATUS_DONE, error=None):
+        self.status = status
+        self.error = error
+        return self.write()
+
+
+def add_progress_arguments(parser):
+    parser.add_argument('--progress_dir', type=str, default=None,
+                        help="Shared folder to write a progress manifest per part, read by scripts/crop_status.py.")
+    parser.add_argument('--progress_interval', type=float, default=30,
+                        help="Seconds between two writes of the manifest of the current part.")
+
+
+def init_part_progress_from_args(args, part):
+    if args.progress_dir is None:
+        return None
+    return PartProgress(args.progress_dir, part, args.progress_interval)
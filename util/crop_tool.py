@@ -0,0 +1,144 @@
+"""
+In-process API of the crop tool, for code that wants boxes and crops in memory instead of folders of files.
+
+    crop_tool = CropTool('ckpt_for_pined_images.ckpt', crop_ratio=1.4, fix_ratio=True)
+    bboxes, scores = crop_tool.detect(list_of_images)
+    crops, bboxes, scores = crop_tool.crop(list_of_images, output_format='numpy')
+
+The images can be HxWx3 (or HxW) uint8 numpy arrays, PIL images or encoded image bytes, in any mix.
+"""
+import argparse
+import numpy as np
+import torch
+from PIL import Image
+from model.precision import apply_precision
+from model.student import STUDENT_PRECISION_MODES, Student
+from util.background_detector import init_background_detector_from_args
+from util.crop_engine import crop_image_with_bbox, load_crop_model, predict_bboxes_and_scores
+from util.early_exit import init_early_exit_from_args
+from util.image_codecs import DEFAULT_JPEG_QUALITY, get_codec
+
+OUTPUT_FORMATS = ['pil', 'numpy', 'jpeg']
+
+
+def to_pil_image(image, codec=None):
+    """
+    :param image: HxWx3 or HxW uint8 numpy array, PIL image or encoded image bytes.
+    :param codec: Codec from util/image_codecs.py that decodes the bytes, PIL by default.
+    :return: RGB PIL image.
+    """
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    if isinstance(image, np.ndarray):
+        if image.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 array, got {image.dtype}.")
+        return Image.fromarray(image).convert("RGB")
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return (codec if codec is not None else get_codec('pil')).decode(bytes(image))
+    raise TypeError(f"Unsupported image type {type(image).__name__}, use a numpy array, a PIL image or bytes.")
+
+
+def convert_crop(cropped_img, output_format, codec=None, jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """
+    :param codec: Codec from util/image_codecs.py that encodes the jpeg output format, PIL by default, like the crop
+    scripts.
+    """
+    if output_format == 'pil':
+        return cropped_img
+    if output_format == 'numpy':
+        return np.asarray(cropped_img)
+    if output_format == 'jpeg':
+        return (codec if codec is not None else get_codec('pil')).encode(cropped_img, jpeg_quality)
+    raise ValueError(f"Unknown output format {output_format}, choose from {OUTPUT_FORMATS}.")
+
+
+class CropTool:
+    def __init__(self, checkpoint_path, crop_ratio=1.4, fix_ratio=False, equal_extend=True, rotate_image=False,
+                 show_bbox=False, width_of_bbox=3, background_color=(234, 242, 245), batch_size=8, precision='fp32',
+                 device=None, inference_shortest_edge=800, inference_longest_edge=1333, early_exit=None,
+                 background_detector=None, codec=None, jpeg_quality=DEFAULT_JPEG_QUALITY):
+        """
+        Load the model once, the crop options have the same meaning as the arguments of scripts/crop_images.py.
+        :param checkpoint_path: Checkpoint of the Detr model, or of the student of scripts/train_student.py.
+        :param precision: fp32, int8_dynamic or bf16, see model/precision.py.
+        :param early_exit: Optional EarlyExitDecoder from util/early_exit.py.
+        :param background_detector: Optional BackgroundDetector from util/background_detector.py, the model only runs
+        on the images it is not confident about.
+        :param codec: Codec from util/image_codecs.py that decodes the input bytes and encodes the jpeg crops, PIL by
+        default.
+        :param jpeg_quality: Quality of the jpeg crops, the default of the crop scripts.
+        """
+        # The crop functions of util/crop_engine.py read the crop options from an argparse namespace.
+        self.crop_options = argparse.Namespace(
+            crop_ratio=crop_ratio, fix_ratio=fix_ratio, equal_extend=equal_extend, rotate_image=rotate_image,
+            show_bbox=show_bbox, width_of_bbox=width_of_bbox, background_color_R=background_color[0],
+            background_color_G=background_color[1], background_color_B=background_color[2])
+        self.batch_size = batch_size
+        self.codec = codec if codec is not None else get_codec('pil')
+        self.jpeg_quality = jpeg_quality
+        self.early_exit = early_exit
+        self.background_detector = background_detector
+        model, self.feature_extractor = load_crop_model(argparse.Namespace(
+            checkpoint_path=checkpoint_path, inference_shortest_edge=inference_shortest_edge,
+            inference_longest_edge=inference_longest_edge))
+        if isinstance(model, Student) and (precision not in STUDENT_PRECISION_MODES or early_exit is not None):
+            raise ValueError(f"The student model runs in {' or '.join(STUDENT_PRECISION_MODES)}, without early exit.")
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available() and precision == 'fp32' else 'cpu')
+        self.device = device
+        model.to(device)
+        self.model, self.precision = apply_precision(model, precision)
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Build a CropTool from the arguments of add_crop_arguments and the checkpoint_path argument, the inference size,
+        early exit and background detector arguments of scripts/crop_images.py are used if they are present.
+        """
+        return cls(args.checkpoint_path, args.crop_ratio, args.fix_ratio, args.equal_extend, args.rotate_image,
+                   args.show_bbox, args.width_of_bbox,
+                   (args.background_color_R, args.background_color_G, args.background_color_B),
+                   getattr(args, 'batch_size', 8), getattr(args, 'precision', 'fp32'),
+                   inference_shortest_edge=getattr(args, 'inference_shortest_edge', 800),
+                   inference_longest_edge=getattr(args, 'inference_longest_edge', 1333),
+                   early_exit=init_early_exit_from_args(args),
+                   background_detector=init_background_detector_from_args(args),
+                   codec=get_codec(getattr(args, 'codec', 'pil')),
+                   jpeg_quality=getattr(args, 'jpeg_quality', DEFAULT_JPEG_QUALITY))
+
+    def detect_pil_images(self, list_of_images):
+        list_of_bboxes, list_of_scores = [], []
+        for start in range(0, len(list_of_images), self.batch_size):
+            bboxes, scores = predict_bboxes_and_scores(self.model, self.feature_extractor,
+                                                       list_of_images[start: start + self.batch_size], self.device,
+                                                       self.precision, self.early_exit, self.background_detector)
+            list_of_bboxes.append(bboxes)
+            list_of_scores.append(scores)
+        if len(list_of_bboxes) == 0:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+        return np.concatenate(list_of_bboxes), np.concatenate(list_of_scores)
+
+    def detect(self, batch):
+        """
+        :param batch: List of images, or an NxHxWx3 uint8 array.
+        :return: Numpy array of bounding boxes in (left, top, right, bottom) and a numpy array of their scores.
+        """
+        return self.detect_pil_images([to_pil_image(image, self.codec) for image in batch])
+
+    def crop(self, batch, output_format='pil', jpeg_quality=None):
+        """
+        :param batch: List of images, or an NxHxWx3 uint8 array.
+        :param output_format: pil, numpy (HxWx3 uint8 arrays) or jpeg (encoded bytes).
+        :param jpeg_quality: Quality of the jpeg crops, the jpeg_quality of the CropTool if None.
+        :return: List of crops, and the bounding boxes and scores of detect.
+        """
+        if jpeg_quality is None:
+            jpeg_quality = self.jpeg_quality
+        list_of_images = [to_pil_image(image, self.codec) for image in batch]
+        bboxes, scores = self.detect_pil_images(list_of_images)
+        list_of_crops = []
+        # to_pil_image returns a copy of PIL images, so show_bbox never draws on an image of the caller.
+        for image, bbox in zip(list_of_images, bboxes):
+            list_of_crops.append(convert_crop(crop_image_with_bbox(self.crop_options, image, bbox), output_format,
+                                              self.codec, jpeg_quality))
+        return list_of_crops, bboxes, scores
@@ -0,0 +1,214 @@
+"""
+Build the train/val folders of the detection dataset from a folder of images and its processed COCO annotation file.
+The images are hard linked, reflinked or copied, or resized to the input resolution of the model, in a thread pool,
+and the annotations are assigned to their split with a dictionary instead of searching a list of ids.
+
+A manifest in the dataset folder records the split of each image, the size and modification time of its source and
+the build options, so scripts/ingest_annotations.py can add new annotation batches without rebuilding the dataset.
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from sklearn.model_selection import train_test_split
+from util.file_utils import place_file
+
+MANIFEST_FILE_NAME = 'dataset_manifest.json'
+SPLIT_FILE_NAMES = {'train': 'custom_train.json', 'val': 'custom_val.json'}
+
+
+def complete_coco_annotations(coco_annotation_dict):
+    """
+    Add the information that the TORAS export misses: the file name, the area (of the bbox, not of the mask) and
+    iscrowd.
+    """
+    images = coco_annotation_dict['images']
+    annotations = coco_annotation_dict['annotations']
+    for i in images:
+        i['file_name'] = os.path.basename(os.path.normpath(i['toras_path']))
+    for i in annotations:
+        i['area'] = i['bbox'][2] * i['bbox'][3]
+        i['iscrowd'] = 0
+    return images, annotations
+
+
+def remove_empty_annotations(images, annotations, start_id=0):
+    """
+    The TORAS export has one annotation per image in the same order. Drop the image and annotation pairs whose box is
+    empty, then renumber the ids of the images and the annotations from start_id.
+    """
+    pairs = [(image, annotation) for image, annotation in zip(images, annotations) if annotation['area'] != 0]
+    kept_images, kept_annotations = [], []
+    for idx, (image, annotation) in enumerate(pairs, start_id):
+        image['id'] = idx
+        annotation['id'] = idx
+        annotation['image_id'] = idx
+        kept_images.append(image)
+        kept_annotations.append(annotation)
+    return kept_images, kept_annotations
+
+
+def hash_annotations(annotations):
+    """
+    Hash of the boxes, categories and masks of an image, to find the images whose annotation changed.
+    """
+    content = [[annotation['bbox'], annotation.get('category_id'), annotation.get('segmentation')]
+               for annotation in annotations]
+    return hashlib.blake2b(json.dumps(content, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def hash_split(file_name, val_fraction=0.1, seed=0):
+    """
+    Deterministic split from the hash of the file name, an image stays in the same split when more annotations are
+    added.
+    """
+    digest = hashlib.blake2b(f'{seed}:{file_name}'.encode(), digest_size=8).digest()
+    return 'val' if int.from_bytes(digest, 'big') / 2 ** 64 < val_fraction else 'train'
+
+
+def assign_splits(images, split_method='random', val_fraction=0.1, seed=0):
+    """
+    :return: Dictionary from image id to train or val.
+    """
+    if split_method == 'hash':
+        return {image['id']: hash_split(image['file_name'], val_fraction, seed) for image in images}
+    if split_method == 'random':
+        ids = [image['id'] for image in images]
+        train_ids, val_ids = train_test_split(ids, test_size=val_fraction, random_state=seed)
+        splits = {image_id: 'train' for image_id in train_ids}
+        splits.update({image_id: 'val' for image_id in val_ids})
+        return splits
+    raise ValueError(f"Unknown split method {split_method}, choose from random and hash.")
+
+
+def get_resized_size(width, height, shortest_edge, longest_edge):
+    """
+    Size of the image after the resizing of DetrFeatureExtractor, or the original size if that would enlarge it.
+    """
+    scale = shortest_edge / min(width, height)
+    if max(width, height) * scale > longest_edge:
+        scale = longest_edge / max(width, height)
+    if scale >= 1:
+        return width, height
+    return int(round(width * scale)), int(round(height * scale))
+
+
+def scale_annotation(annotation, x_scale, y_scale):
+    x, y, w, h = annotation['bbox']
+    annotation['bbox'] = [x * x_scale, y * y_scale, w * x_scale, h * y_scale]
+    annotation['area'] = annotation['area'] * x_scale * y_scale
+    if isinstance(annotation.get('segmentation'), list):
+        annotation['segmentation'] = [[coordinate * (x_scale if index % 2 == 0 else y_scale)
+                                       for index, coordinate in enumerate(polygon)]
+                                      for polygon in annotation['segmentation']]
+
+
+def resize_image_and_annotations(src, dst, image, annotations, shortest_edge, longest_edge):
+    """
+    Save a resized copy of the image and scale its annotations, the image information gets the new width and height.
+    :return: True if the image is resized, False if it is already small enough and only placed.
+    """
+    with Image.open(src) as pil_image:
+        width, height = pil_image.size
+        new_width, new_height = get_resized_size(width, height, shortest_edge, longest_edge)
+        if (new_width, new_height) == (width, height):
+            return False
+        pil_image.convert('RGB').resize((new_width, new_height), Image.BILINEAR).save(dst, quality=95)
+    image['width'], image['height'] = new_width, new_height
+    for annotation in annotations:
+        scale_annotation(annotation, new_width / width, new_height / height)
+    return True
+
+
+def prepare_image(input_dir, split_folder, image, annotations, link_mode='hardlink', resize_shortest_edge=None,
+                  resize_longest_edge=1333):
+    """
+    Put one image into its split folder.
+    :return: The manifest entry of the image, without the split.
+    """
+    src = os.path.join(input_dir, image['file_name'])
+    dst = os.path.join(split_folder, image['file_name'])
+    stat = os.stat(src)
+    annotation_hash = hash_annotations(annotations)
+    resized = False
+    if resize_shortest_edge is not None:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        resized = resize_image_and_annotations(src, dst, image, annotations, resize_shortest_edge,
+                                               resize_longest_edge)
+    if not resized:
+        place_file(src, dst, link_mode)
+    return {'source_path': os.path.abspath(src), 'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns,
+            'annotation_hash': annotation_hash, 'resized': resized}
+
+
+def prepare_images(input_dir, dataset_name, images, annotations, splits, build_options, num_workers=8):
+    """
+    Place all images into their split folders in a thread pool, the annotations of resized images are scaled in place.
+    :return: Dictionary from file name to its manifest entry.
+    """
+    annotations_by_image_id = {}
+    for annotation in annotations:
+        annotations_by_image_id.setdefault(annotation['image_id'], []).append(annotation)
+
+    def prepare(image):
+        split = splits[image['id']]
+        entry = prepare_image(input_dir, os.path.join(dataset_name, split), image,
+                              annotations_by_image_id.get(image['id'], []), build_options['link_mode'],
+                              build_options['resize_shortest_edge'], build_options['resize_longest_edge'])
+        return image['file_name'], dict(entry, split=split)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return dict(executor.map(prepare, images))
+
+
+def write_split_files(dataset_name, images, annotations, categories, splits):
+    for split, file_name in SPLIT_FILE_NAMES.items():
+        split_images = [image for image in images if splits[image['id']] == split]
+        split_annotations = [annotation for annotation in annotations if splits[annotation['image_id']] == split]
+        write_json_atomically(os.path.join(dataset_name, split, file_name),
+                              {'images': split_images, 'categories': categories, 'annotations': split_annotations})
+
+
+def write_json_atomically(path, data, indent=None):
+    # Write to a temporary file first, so an interrupted build never leaves a half written annotation file.
+    with open(path + '.tmp', 'w') as file:
+        json.dump(data, file, indent=indent)
+    os.replace(path + '.tmp', path)
+
+
+def load_manifest(dataset_name):
+    with open(os.path.join(dataset_name, MANIFEST_FILE_NAME)) as file:
+        return json.load(file)
+
+
+def save_manifest(dataset_name, manifest):
+    write_json_atomically(os.path.join(dataset_name, MANIFEST_FILE_NAME), manifest)
+
+
+def build_dataset(input_dir, dataset_name, split_method='random', val_fraction=0.1, seed=0, link_mode='hardlink',
+                  resize_shortest_edge=None, resize_longest_edge=1333, num_workers=8):
+    """
+    Build dataset_name/train and dataset_name/val from input_dir/coco_annotations_processed.json.
+    :param link_mode: copy, hardlink or reflink, the images that are resized are always written.
+    :param resize_shortest_edge: Resize the images to the input resolution of the model if it is set.
+    """
+    with open(os.path.join(input_dir, "coco_annotations_processed.json")) as file:
+        coco_annotation_dict = json.load(file)
+    categories = coco_annotation_dict['categories']
+    images, annotations = remove_empty_annotations(coco_annotation_dict['images'],
+                                                   coco_annotation_dict['annotations'])
+    splits = assign_splits(images, split_method, val_fraction, seed)
+    build_options = {'input_dir': os.path.abspath(input_dir), 'split_method': split_method,
+                     'val_fraction': val_fraction, 'seed': seed, 'link_mode': link_mode,
+                     'resize_shortest_edge': resize_shortest_edge, 'resize_longest_edge': resize_longest_edge}
+
+    for split in SPLIT_FILE_NAMES:
+        os.makedirs(os.path.join(dataset_name, split), exist_ok=True)
+    manifest_images = prepare_images(input_dir, dataset_name, images, annotations, splits, build_options,
+                                     num_workers)
+    write_split_files(dataset_name, images, annotations, categories, splits)
+    save_manifest(dataset_name, {'build_options': build_options, 'next_id': len(images), 'images': manifest_images})
+    print(f"{sum(split == 'train' for split in splits.values())} training images and "
+          f"{sum(split == 'val' for split in splits.values())} validation images in {dataset_name}.")
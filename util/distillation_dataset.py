@@ -0,0 +1,133 @@
+"""
+Datasets of scripts/train_student.py. DistillationDataset pairs the original images of crop runs with the boxes that
+the teacher stored for them (bbox_metadata or size_of_original_image_and_bbox.json) as pseudo-labels, so millions of
+images can be used without annotations. StudentDetectionDataset reads the annotated split like DetectionDataset, with
+labels in the format of DetectionDataset, so util/fast_evaluation.py evaluates the student like the teacher.
+
+The filenames are kept in a numpy byte array rather than a list of strings, the loader workers then share it without
+copying it page by page.
+"""
+import os
+import random
+import numpy as np
+import torch
+import torchvision
+from PIL import Image
+from torch.utils.data import Dataset
+from util.bbox_metadata_store import STATUS_FAILED
+from util.bbox_store import load_bbox_store
+from util.image_codecs import get_codec
+
+
+def load_teacher_boxes(metadata_path):
+    """
+    :param metadata_path: Folder of a columnar store or a size_of_original_image_and_bbox.json file of a crop run.
+    :return: Numpy arrays of the filenames, the original sizes in (width, height), the boxes in (left, top, right,
+    bottom) and the scores (nan for old records without a score), without the failed images.
+    """
+    list_of_original_image_size_and_bbox = [record for record in load_bbox_store(metadata_path).values()
+                                            if record.get('status', 0) != STATUS_FAILED]
+    return np.array([record['filename'] for record in list_of_original_image_size_and_bbox]), \
+        np.array([record['original_size'] for record in list_of_original_image_size_and_bbox],
+                 dtype=np.int32).reshape(-1, 2), \
+        np.array([record['bbox'] for record in list_of_original_image_size_and_bbox],
+                 dtype=np.float32).reshape(-1, 4), \
+        np.array([record.get('score', np.nan) for record in list_of_original_image_size_and_bbox], dtype=np.float32)
+
+
+def to_normalized_cxcywh(boxes, sizes):
+    """
+    :param boxes: Numpy array of boxes in (left, top, right, bottom) in pixels.
+    :param sizes: Numpy array of the (width, height) of the images.
+    :return: Numpy array of the boxes in normalized cx, cy, w, h, clipped to the image.
+    """
+    scale = np.concatenate([sizes, sizes], axis=1).astype(np.float32)
+    boxes = np.clip(boxes / scale, 0, 1)
+    return np.concatenate([(boxes[:, :2] + boxes[:, 2:]) / 2, boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+class DistillationDataset(Dataset):
+    def __init__(self, list_of_image_dirs, list_of_metadata_paths, feature_extractor, min_score=0.9, train=True,
+                 codec=None, decode_scale=2):
+        """
+        :param list_of_image_dirs: Folders of the original images, one per metadata path.
+        :param list_of_metadata_paths: Metadata of the crop runs of these folders, see load_teacher_boxes.
+        :param feature_extractor: StudentFeatureExtractor from model/student.py.
+        :param min_score: Leave out the images whose teacher box has a lower score, the records without a score are
+        kept.
+        :param train: Flip the images and their boxes at random.
+        :param decode_scale: Decode the images at 1/decode_scale of their size, the input of the student is small.
+        """
+        self.list_of_image_dirs = list_of_image_dirs
+        self.feature_extractor = feature_extractor
+        self.train = train
+        self.codec = codec if codec is not None else get_codec('pil')
+        self.decode_scale = decode_scale
+        list_of_filenames, list_of_sources, list_of_boxes, list_of_scores = [], [], [], []
+        for source, metadata_path in enumerate(list_of_metadata_paths):
+            filenames, original_sizes, bboxes, scores = load_teacher_boxes(metadata_path)
+            keep = ~(scores < min_score) & (bboxes[:, 2] > bboxes[:, 0]) & (bboxes[:, 3] > bboxes[:, 1])
+            list_of_filenames.append(np.char.encode(filenames[keep].astype(str), 'utf-8'))
+            list_of_sources.append(np.full(int(keep.sum()), source, dtype=np.int32))
+            list_of_boxes.append(to_normalized_cxcywh(bboxes[keep], original_sizes[keep]))
+            list_of_scores.append(np.nan_to_num(scores[keep], nan=1.0))
+            print(f"{metadata_path}: {int(keep.sum())} of {len(keep)} teacher boxes kept.")
+        self.filenames = np.concatenate(list_of_filenames) if list_of_filenames else np.zeros(0, dtype='S1')
+        self.sources = np.concatenate(list_of_sources) if list_of_sources else np.zeros(0, dtype=np.int32)
+        self.boxes = np.concatenate(list_of_boxes).astype(np.float32) if list_of_boxes else np.zeros((0, 4))
+        self.scores = np.concatenate(list_of_scores).astype(np.float32) if list_of_scores else np.zeros(0)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        """
+        :return: pixel_values and the target with the box in normalized cx, cy, w, h and the score of the teacher.
+        """
+        path = os.path.join(self.list_of_image_dirs[self.sources[idx]], self.filenames[idx].decode('utf-8'))
+        image = self.codec.read(path, self.decode_scale)
+        box = self.boxes[idx].copy()
+        if self.train:
+            # The insects lie in any direction on the plate, both flips give valid images.
+            if random.random() < 0.5:
+                image = image.transpose(Image.FLIP_LEFT_RIGHT)
+                box[0] = 1 - box[0]
+            if random.random() < 0.5:
+                image = image.transpose(Image.FLIP_TOP_BOTTOM)
+                box[1] = 1 - box[1]
+        target = {'boxes': torch.from_numpy(box).unsqueeze(0), 'score': torch.tensor(self.scores[idx])}
+        return self.feature_extractor.preprocess(image), target
+
+
+class StudentDetectionDataset(torchvision.datasets.CocoDetection):
+    """
+    The annotated split for the student, with the labels of DetectionDataset and a score of 1.
+    """
+
+    def __init__(self, img_folder, feature_extractor, train=False):
+        ann_file = os.path.join(img_folder, "custom_train.json" if train else "custom_val.json")
+        super(StudentDetectionDataset, self).__init__(img_folder, ann_file)
+        self.feature_extractor = feature_extractor
+
+    def __getitem__(self, idx):
+        img, annotations = super(StudentDetectionDataset, self).__getitem__(idx)
+        width, height = img.size
+        boxes = np.array([annotation['bbox'] for annotation in annotations], dtype=np.float32).reshape(-1, 4)
+        # COCO boxes are x, y, w, h in pixels.
+        boxes[:, 2:] += boxes[:, :2]
+        sizes = np.tile(np.array([[width, height]]), (len(boxes), 1))
+        target = {'boxes': torch.from_numpy(to_normalized_cxcywh(boxes, sizes)),
+                  'class_labels': torch.tensor([annotation['category_id'] for annotation in annotations]),
+                  'image_id': torch.tensor([self.ids[idx]]), 'orig_size': torch.tensor([height, width]),
+                  'score': torch.tensor(1.0)}
+        return self.feature_extractor.preprocess(img), target
+
+
+def student_collate_fn(batch):
+    """
+    Batch in the format of the collate_fn of scripts/train.py, the pixel mask is all ones.
+    """
+    pixel_values = torch.stack([item[0] for item in batch])
+    return {'pixel_values': pixel_values,
+            'pixel_mask': torch.ones((len(batch),) + pixel_values.shape[2:], dtype=torch.long),
+            'labels': [item[1] for item in batch]}
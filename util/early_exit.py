@@ -0,0 +1,165 @@
+"""
+Early exit decoding for DETR. The class and box heads are shared by all decoder layers, so the top-1 box can be read
+after every layer. The boxes of the intermediate layers are only meaningful if the heads were trained on them, with
+scripts/train.py --auxiliary_loss, and a warning is raised on a model trained without it. An image leaves the decoder as
+soon as its top-1 score is above score_threshold and its top-1 box moved less than box_delta_threshold (in normalized
+cx, cy, w, h) since the previous layer, and the remaining images of the batch go on with a smaller batch.
+
+The decoder loop follows DetrModel.forward and DetrDecoder.forward of transformers 4.26.
+"""
+import collections
+import warnings
+import torch
+from transformers.models.detr.modeling_detr import _expand_mask
+from model.precision import get_detr_model
+from util.content_index import register_crop_parameters
+
+EarlyExitOutput = collections.namedtuple('EarlyExitOutput', ['logits', 'pred_boxes', 'exit_layers'])
+
+
+def get_detection_model(model):
+    """
+    :param model: Detr LightningModule or DetrForObjectDetection.
+    :return: The DetrForObjectDetection inside, which holds the class and box heads.
+    """
+    while not hasattr(model, 'class_labels_classifier'):
+        model = model.model
+    return model
+
+
+def run_encoder(detr_model, pixel_values, pixel_mask=None):
+    """
+    :return: The encoder hidden states, the position embeddings and the mask of the flattened feature map.
+    """
+    batch_size, _, height, width = pixel_values.shape
+    if pixel_mask is None:
+        pixel_mask = torch.ones((batch_size, height, width), device=pixel_values.device)
+    features, position_embeddings_list = detr_model.backbone(pixel_values, pixel_mask)
+    feature_map, mask = features[-1]
+    flattened_features = detr_model.input_projection(feature_map).flatten(2).permute(0, 2, 1)
+    position_embeddings = position_embeddings_list[-1].flatten(2).permute(0, 2, 1)
+    flattened_mask = mask.flatten(1)
+    encoder_outputs = detr_model.encoder(inputs_embeds=flattened_features, attention_mask=flattened_mask,
+                                         position_embeddings=position_embeddings, return_dict=False)
+    return encoder_outputs[0], position_embeddings, flattened_mask
+
+
+class EarlyExitDecoder:
+    def __init__(self, score_threshold=0.9, box_delta_threshold=0.01, min_layers=2):
+        """
+        :param score_threshold: Minimum score of the top-1 box to exit.
+        :param box_delta_threshold: Maximum change of the top-1 box since the previous layer to exit.
+        :param min_layers: Minimum number of decoder layers that every image goes through, at least 2 since the box
+        change needs a previous layer.
+        """
+        self.score_threshold = score_threshold
+        self.box_delta_threshold = box_delta_threshold
+        self.min_layers = max(min_layers, 2)
+        self.exit_layer_counts = collections.Counter()
+        self.checked_auxiliary_loss = False
+
+    def check_auxiliary_loss(self, detection_model):
+        if self.checked_auxiliary_loss:
+            return
+        self.checked_auxiliary_loss = True
+        if not detection_model.config.auxiliary_loss:
+            warnings.warn("Early exit on a model trained without --auxiliary_loss: its heads were only trained on "
+                          "the last decoder layer, so the boxes of the earlier layers and the exits are unreliable. "
+                          "Fine-tune with scripts/train.py --auxiliary_loss, or check the exits with "
+                          "scripts/evaluate.py --fast --early_exit first.")
+
+    def __call__(self, model, pixel_values, pixel_mask=None):
+        """
+        :return: EarlyExitOutput with the logits and boxes of the layer each image exited at, and the exit layers
+        counted from 1.
+        """
+        detr_model = get_detr_model(model)
+        detection_model = get_detection_model(model)
+        self.check_auxiliary_loss(detection_model)
+        decoder = detr_model.decoder
+        encoder_hidden_states, position_embeddings, flattened_mask = run_encoder(detr_model, pixel_values,
+                                                                                 pixel_mask)
+        batch_size = pixel_values.shape[0]
+        query_position_embeddings = detr_model.query_position_embeddings.weight.unsqueeze(0).repeat(batch_size, 1, 1)
+        hidden_states = torch.zeros_like(query_position_embeddings)
+        encoder_attention_mask = _expand_mask(flattened_mask, hidden_states.dtype, tgt_len=hidden_states.shape[1])
+
+        final_logits = final_boxes = None
+        exit_layers = torch.zeros(batch_size, dtype=torch.long)
+        active = torch.arange(batch_size, device=pixel_values.device)
+        previous_top_boxes = None
+        for layer_index, decoder_layer in enumerate(decoder.layers):
+            hidden_states = decoder_layer(hidden_states, attention_mask=None, position_embeddings=position_embeddings,
+                                          query_position_embeddings=query_position_embeddings,
+                                          encoder_hidden_states=encoder_hidden_states,
+                                          encoder_attention_mask=encoder_attention_mask)[0]
+            normalized_hidden_states = decoder.layernorm(hidden_states)
+            logits = detection_model.class_labels_classifier(normalized_hidden_states).float()
+            boxes = detection_model.bbox_predictor(normalized_hidden_states).sigmoid().float()
+            if final_logits is None:
+                final_logits = logits.new_zeros((batch_size,) + logits.shape[1:])
+                final_boxes = boxes.new_zeros((batch_size,) + boxes.shape[1:])
+
+            scores, top_query = logits.softmax(-1)[:, :, :-1].max(-1).values.max(-1)
+            top_boxes = boxes[torch.arange(len(top_query), device=boxes.device), top_query]
+            if layer_index == len(decoder.layers) - 1:
+                done = torch.ones_like(scores, dtype=torch.bool)
+            elif layer_index + 1 < self.min_layers:
+                done = torch.zeros_like(scores, dtype=torch.bool)
+            else:
+                box_delta = (top_boxes - previous_top_boxes).abs().max(-1).values
+                done = (scores >= self.score_threshold) & (box_delta <= self.box_delta_threshold)
+
+            final_logits[active[done]] = logits[done]
+            final_boxes[active[done]] = boxes[done]
+            exit_layers[active[done].cpu()] = layer_index + 1
+            if done.all():
+                break
+            keep = ~done
+            active = active[keep]
+            hidden_states = hidden_states[keep]
+            query_position_embeddings = query_position_embeddings[keep]
+            position_embeddings = position_embeddings[keep]
+            encoder_hidden_states = encoder_hidden_states[keep]
+            encoder_attention_mask = encoder_attention_mask[keep]
+            previous_top_boxes = top_boxes[keep]
+
+        self.exit_layer_counts.update(exit_layers.tolist())
+        return EarlyExitOutput(final_logits, final_boxes, exit_layers)
+
+    def get_exit_layer_distribution(self):
+        """
+        :return: Dictionary from exit layer to the fraction of images that exited there.
+        """
+        number_of_images = sum(self.exit_layer_counts.values())
+        return {layer: count / number_of_images for layer, count in sorted(self.exit_layer_counts.items())}
+
+    def report(self):
+        distribution = self.get_exit_layer_distribution()
+        if len(distribution) == 0:
+            return
+        mean_layer = sum(layer * fraction for layer, fraction in distribution.items())
+        print(f"Early exit: mean exit layer {mean_layer:.2f}, " +
+              ", ".join(f"layer {layer}: {fraction:.1%}" for layer, fraction in distribution.items()))
+
+
+def add_early_exit_arguments(parser):
+    parser.add_argument('--early_exit', default=False, action='store_true',
+                        help="Stop decoding an image once its top-1 box is confident and stable.")
+    parser.add_argument('--early_exit_score_threshold', type=float, default=0.9,
+                        help="Minimum score of the top-1 box to exit.")
+    parser.add_argument('--early_exit_box_delta', type=float, default=0.01,
+                        help="Maximum change of the normalized top-1 box since the previous layer to exit.")
+    parser.add_argument('--early_exit_min_layers', type=int, default=2,
+                        help="Minimum number of decoder layers for every image.")
+    register_crop_parameters(parser, ['early_exit', 'early_exit_score_threshold', 'early_exit_box_delta',
+                                      'early_exit_min_layers'])
+
+
+def init_early_exit_from_args(args):
+    """
+    :return: An EarlyExitDecoder, or None if early exit is not enabled.
+    """
+    if not getattr(args, 'early_exit', False):
+        return None
+    return EarlyExitDecoder(args.early_exit_score_threshold, args.early_exit_box_delta, args.early_exit_min_layers)
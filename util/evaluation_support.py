@@ -1,4 +1,5 @@
-from util.visualize_and_process_bbox import convert_to_xywh
+import torch
+from util.visualize_and_process_bbox import convert_to_xywh, box_cxcywh_to_xyxy
 
 
 def prepare_for_evaluation(predictions):
@@ -9,9 +10,9 @@ def prepare_for_evaluation(predictions):
     """
     coco_results = []
     for original_id, prediction in predictions.items():
-        if len(prediction) == 0:
-            exit(1)
-        #     TODO handle the special case.
+        if len(prediction) == 0 or len(prediction["boxes"]) == 0:
+            # No prediction for this image, it only lowers the recall.
+            continue
         boxes = prediction["boxes"]
         boxes = convert_to_xywh(boxes).tolist()
         scores = prediction["scores"].tolist()
@@ -28,3 +29,52 @@ def prepare_for_evaluation(predictions):
             ]
         )
     return coco_results
+
+
+def box_iou_for_pairs(boxes_a, boxes_b):
+    """
+    IoU between each pair of boxes, not all combinations.
+    :param boxes_a: Tensor of shape (N, 4) in x_min, y_min, x_max, y_max.
+    :param boxes_b: Tensor of shape (N, 4) in x_min, y_min, x_max, y_max.
+    :return: Tensor of shape (N,).
+    """
+    top_left = torch.max(boxes_a[:, :2], boxes_b[:, :2])
+    bottom_right = torch.min(boxes_a[:, 2:], boxes_b[:, 2:])
+    intersection = (bottom_right - top_left).clamp(min=0).prod(dim=1)
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).clamp(min=0).prod(dim=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).clamp(min=0).prod(dim=1)
+    return intersection / (area_a + area_b - intersection).clamp(min=1e-6)
+
+
+def generalized_box_iou_for_pairs(boxes_a, boxes_b):
+    """
+    Generalized IoU between each pair of boxes, it still decreases with the distance of boxes that do not overlap.
+    :param boxes_a: Tensor of shape (N, 4) in x_min, y_min, x_max, y_max.
+    :param boxes_b: Tensor of shape (N, 4) in x_min, y_min, x_max, y_max.
+    :return: Tensor of shape (N,) in [-1, 1].
+    """
+    top_left = torch.max(boxes_a[:, :2], boxes_b[:, :2])
+    bottom_right = torch.min(boxes_a[:, 2:], boxes_b[:, 2:])
+    intersection = (bottom_right - top_left).clamp(min=0).prod(dim=1)
+    area_a = (boxes_a[:, 2:] - boxes_a[:, :2]).clamp(min=0).prod(dim=1)
+    area_b = (boxes_b[:, 2:] - boxes_b[:, :2]).clamp(min=0).prod(dim=1)
+    union = (area_a + area_b - intersection).clamp(min=1e-6)
+    enclosing_area = (torch.max(boxes_a[:, 2:], boxes_b[:, 2:]) - torch.min(boxes_a[:, :2], boxes_b[:, :2])) \
+        .clamp(min=0).prod(dim=1).clamp(min=1e-6)
+    return intersection / union - (enclosing_area - union) / enclosing_area
+
+
+def get_top1_iou_with_ground_truth(results, labels):
+    """
+    IoU between the predicted box with the highest score and the first ground truth box of each image.
+    :param results: Output of feature_extractor.post_process.
+    :param labels: Labels from the DetectionDataset, with boxes in normalized cx, cy, w, h and orig_size in h, w.
+    :return: Tensor of IoU, one per image.
+    """
+    predicted_boxes = torch.stack([result['boxes'][result['scores'].argmax()] for result in results])
+    ground_truth_boxes = []
+    for target in labels:
+        height, width = target['orig_size'].tolist()
+        box = box_cxcywh_to_xyxy(target['boxes'][:1])[0]
+        ground_truth_boxes.append(box * torch.tensor([width, height, width, height], dtype=torch.float32))
+    return box_iou_for_pairs(predicted_boxes.float().cpu(), torch.stack(ground_truth_boxes))
@@ -0,0 +1,270 @@
+"""
+Single pass evaluation of the top-1 box of each image, which is the only box used for cropping. The forward passes run
+in inference mode and the top-1 box of the whole batch is picked with tensor operations, then the mean IoU with the
+ground truth box, the fraction of crops that fully contain the ground truth box and the COCO AP of the top-1 boxes are
+computed from the same predictions.
+Under torch.distributed, each process evaluates its shard of the validation set and the predictions are gathered, so
+every process returns the result of the whole validation set.
+"""
+import argparse
+import contextlib
+import io
+import numpy as np
+import pytorch_lightning as pl
+import torch
+import torch.distributed as dist
+from pycocotools.cocoeval import COCOeval
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from model.precision import get_inference_context
+from util.evaluation_support import box_iou_for_pairs
+from util.visualize_and_process_bbox import box_cxcywh_to_xyxy, convert_to_xywh, scale_bbox
+
+# Defaults of the crop geometry of scripts/crop_images.py, see add_crop_geometry_arguments.
+DEFAULT_CROP_ARGS = argparse.Namespace(crop_ratio=1.4, equal_extend=True, fix_ratio=False, rotate_image=False)
+
+
+def get_top1_predictions(pred_logits, pred_boxes, orig_sizes):
+    """
+    :param orig_sizes: Tensor of shape (batch, 2) in height, width, as in the labels of DetectionDataset.
+    :return: Boxes in x_min, y_min, x_max, y_max of shape (batch, 4), their scores and their labels.
+    """
+    probas = pred_logits.softmax(-1)[:, :, :-1]
+    query_scores, query_labels = probas.max(-1)
+    scores, top_query = query_scores.max(-1)
+    batch_index = torch.arange(len(top_query), device=top_query.device)
+    height, width = orig_sizes.unbind(1)
+    scale = torch.stack([width, height, width, height], dim=1).float().cpu()
+    boxes = box_cxcywh_to_xyxy(pred_boxes[batch_index, top_query].float().cpu()) * scale
+    return boxes, scores.float().cpu(), query_labels[batch_index, top_query].cpu()
+
+
+def get_ground_truth_boxes(labels):
+    """
+    :return: The first ground truth box of each image in x_min, y_min, x_max, y_max in pixels of the original image.
+    """
+    orig_sizes = torch.stack([target['orig_size'] for target in labels]).cpu()
+    height, width = orig_sizes.unbind(1)
+    scale = torch.stack([width, height, width, height], dim=1).float()
+    boxes = torch.stack([target['boxes'][0] for target in labels]).float().cpu()
+    return box_cxcywh_to_xyxy(boxes) * scale
+
+
+def scale_boxes(args, boxes):
+    """
+    Vectorized version of scale_bbox in util/visualize_and_process_bbox.py, computed in float64 and truncated like it
+    so the results are the same.
+    """
+    boxes = boxes.double()
+    sizes = boxes[:, 2:] - boxes[:, :2]
+    if args.equal_extend:
+        changes = ((args.crop_ratio - 1) * sizes.max(dim=1, keepdim=True).values).expand(-1, 2)
+    else:
+        changes = sizes * args.crop_ratio - sizes
+    return torch.cat([torch.trunc(boxes[:, :2] - changes / 2), torch.trunc(boxes[:, 2:] + changes / 2)], dim=1)
+
+
+def get_crop_boxes(args, boxes):
+    """
+    Vectorized version of get_crop_box in util/crop_engine.py, in the coordinates of the image before the rotation.
+    :param args: crop_ratio, equal_extend, fix_ratio and rotate_image of the crop scripts.
+    """
+    boxes = scale_boxes(args, boxes)
+    if not args.fix_ratio:
+        return boxes
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    # change_size_to_4_3 of the rotated image extends the box to 3:4 in the image before the rotation.
+    rotated = heights > widths if args.rotate_image else torch.zeros_like(widths, dtype=torch.bool)
+    new_widths = torch.where(rotated, torch.max(widths, heights / 4 * 3), torch.max(widths, heights / 3 * 4))
+    new_heights = torch.where(rotated, torch.max(heights, widths / 3 * 4), torch.max(heights, widths / 4 * 3))
+    width_extensions = new_widths - widths
+    height_extensions = new_heights - heights
+    return torch.round(torch.stack([boxes[:, 0] - width_extensions / 2, boxes[:, 1] - height_extensions / 2,
+                                    boxes[:, 2] + width_extensions - width_extensions / 2,
+                                    boxes[:, 3] + height_extensions - height_extensions / 2], dim=1))
+
+
+def check_scale_boxes(args, boxes, number_of_boxes=16):
+    """
+    Check that scale_boxes gives the boxes of scale_bbox, so the containment is the one of the crops of the crop
+    scripts.
+    """
+    boxes = boxes[:number_of_boxes]
+    expected_boxes = torch.tensor([scale_bbox(args, *box) for box in boxes.tolist()], dtype=torch.float64)
+    if not torch.equal(scale_boxes(args, boxes), expected_boxes.reshape(-1, 4)):
+        raise RuntimeError("scale_boxes does not match scale_bbox of util/visualize_and_process_bbox.py.")
+
+
+def box_contains(outer_boxes, inner_boxes):
+    return (outer_boxes[:, :2] <= inner_boxes[:, :2]).all(dim=1) & \
+        (outer_boxes[:, 2:] >= inner_boxes[:, 2:]).all(dim=1)
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_sharded_dataloader(dataloader, num_replicas, rank):
+    """
+    The same dataloader over the shard of the dataset of one process, without shuffling.
+    """
+    sampler = DistributedSampler(dataloader.dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+    return DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, sampler=sampler,
+                      collate_fn=dataloader.collate_fn, num_workers=dataloader.num_workers)
+
+
+def gather_top1_predictions(image_ids, boxes, scores, labels, ground_truth_boxes):
+    """
+    Gather the predictions of all processes, the images that DistributedSampler repeated to even out the shards are
+    only kept once.
+    """
+    gathered = [None] * dist.get_world_size()
+    dist.all_gather_object(gathered, (image_ids, boxes, scores, labels, ground_truth_boxes))
+    seen_image_ids = set()
+    keep_image_ids, keep_boxes, keep_scores, keep_labels, keep_ground_truth_boxes = [], [], [], [], []
+    for process_image_ids, process_boxes, process_scores, process_labels, process_ground_truth_boxes in gathered:
+        for index, image_id in enumerate(process_image_ids):
+            if image_id in seen_image_ids:
+                continue
+            seen_image_ids.add(image_id)
+            keep_image_ids.append(image_id)
+            keep_boxes.append(process_boxes[index])
+            keep_scores.append(process_scores[index])
+            keep_labels.append(process_labels[index])
+            keep_ground_truth_boxes.append(process_ground_truth_boxes[index])
+    if len(keep_image_ids) == 0:
+        return [], boxes, scores, labels, ground_truth_boxes
+    return keep_image_ids, torch.stack(keep_boxes), torch.stack(keep_scores), torch.stack(keep_labels), \
+        torch.stack(keep_ground_truth_boxes)
+
+
+def compute_top1_coco_ap(coco, image_ids, boxes, scores, labels):
+    """
+    COCO AP of one detection per image.
+    :return: The stats of COCOeval, or a list of zeros if there is no detection.
+    """
+    if len(image_ids) == 0:
+        return [0.0] * 12
+    xywh_boxes = convert_to_xywh(boxes).numpy()
+    detections = np.column_stack([np.asarray(image_ids, dtype=np.float64), xywh_boxes, scores.numpy(),
+                                  labels.numpy()])
+    coco_detections = coco.loadRes(detections)
+    coco_eval = COCOeval(coco, coco_detections, 'bbox')
+    coco_eval.params.imgIds = list(image_ids)
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return coco_eval.stats.tolist()
+
+
+def fast_evaluation(model, val_dataset, val_dataloader, crop_args=None, precision='fp32', device=None,
+                    verbose=True, early_exit=None):
+    """
+    :param model: Detr LightningModule.
+    :param val_dataloader: Dataloader over the whole validation set, it is sharded if torch.distributed is initialized.
+    :param crop_args: crop_ratio, equal_extend, fix_ratio and rotate_image used for cropping, a crop contains the
+    ground truth box if the crop box of the crop scripts does, DEFAULT_CROP_ARGS if None.
+    :param early_exit: Optional EarlyExitDecoder from util/early_exit.py, to check the accuracy of its thresholds.
+    :return: Dictionary with AP, AP50, AP75, mean_iou, iou_above_0.5, iou_above_0.75, containment and the number of
+    images.
+    """
+    if device is None:
+        device = next(model.parameters()).device
+    if is_distributed():
+        val_dataloader = get_sharded_dataloader(val_dataloader, dist.get_world_size(), dist.get_rank())
+        verbose = verbose and dist.get_rank() == 0
+    was_training = model.training
+    model.eval()
+    list_of_image_ids = []
+    list_of_boxes = []
+    list_of_scores = []
+    list_of_labels = []
+    list_of_ground_truth_boxes = []
+    with torch.inference_mode(), get_inference_context(precision):
+        for batch in val_dataloader:
+            labels = batch['labels']
+            if early_exit is not None:
+                outputs = early_exit(model, batch['pixel_values'].to(device), batch['pixel_mask'].to(device))
+            else:
+                outputs = model.model(pixel_values=batch['pixel_values'].to(device),
+                                      pixel_mask=batch['pixel_mask'].to(device))
+            orig_sizes = torch.stack([target['orig_size'] for target in labels]).to(outputs.logits.device)
+            boxes, scores, predicted_labels = get_top1_predictions(outputs.logits, outputs.pred_boxes, orig_sizes)
+            list_of_image_ids.extend(target['image_id'].item() for target in labels)
+            list_of_boxes.append(boxes)
+            list_of_scores.append(scores)
+            list_of_labels.append(predicted_labels)
+            list_of_ground_truth_boxes.append(get_ground_truth_boxes(labels))
+    if was_training:
+        model.train()
+    if early_exit is not None and verbose:
+        early_exit.report()
+
+    boxes = torch.cat(list_of_boxes) if list_of_boxes else torch.zeros((0, 4))
+    scores = torch.cat(list_of_scores) if list_of_scores else torch.zeros(0)
+    labels = torch.cat(list_of_labels) if list_of_labels else torch.zeros(0, dtype=torch.long)
+    ground_truth_boxes = torch.cat(list_of_ground_truth_boxes) if list_of_ground_truth_boxes else torch.zeros((0, 4))
+    if is_distributed():
+        list_of_image_ids, boxes, scores, labels, ground_truth_boxes = gather_top1_predictions(
+            list_of_image_ids, boxes, scores, labels, ground_truth_boxes)
+    return summarize_top1_predictions(val_dataset.coco, list_of_image_ids, boxes, scores, labels, ground_truth_boxes,
+                                      crop_args, verbose)
+
+
+def summarize_top1_predictions(coco, image_ids, boxes, scores, labels, ground_truth_boxes, crop_args=None,
+                               verbose=True):
+    if crop_args is None:
+        crop_args = DEFAULT_CROP_ARGS
+    iou = box_iou_for_pairs(boxes, ground_truth_boxes)
+    check_scale_boxes(crop_args, boxes)
+    contained = box_contains(get_crop_boxes(crop_args, boxes), ground_truth_boxes.double())
+    stats = compute_top1_coco_ap(coco, image_ids, boxes, scores, labels)
+    number_of_images = len(image_ids)
+    result = {'AP': stats[0], 'AP50': stats[1], 'AP75': stats[2],
+              'mean_iou': iou.mean().item() if number_of_images > 0 else 0.0,
+              'iou_above_0.5': (iou > 0.5).float().mean().item() if number_of_images > 0 else 0.0,
+              'iou_above_0.75': (iou > 0.75).float().mean().item() if number_of_images > 0 else 0.0,
+              'containment': contained.float().mean().item() if number_of_images > 0 else 0.0,
+              'number_of_images': number_of_images}
+    if verbose:
+        print(f"Top-1 evaluation on {number_of_images} images: AP {result['AP']:.4f}, AP50 {result['AP50']:.4f}, "
+              f"mean IoU {result['mean_iou']:.4f}, crops containing the ground truth at crop_ratio {crop_args.crop_ratio}: "
+              f"{result['containment']:.4f}")
+    return result
+
+
+class FastEvaluationCallback(pl.Callback):
+    """
+    Run fast_evaluation at the end of every training epoch and log the results as val_top1_*. Every process has to
+    run it under distributed training, since the predictions of all shards are gathered.
+    """
+
+    def __init__(self, val_dataset, val_dataloader, crop_args=None):
+        self.val_dataset = val_dataset
+        self.val_dataloader = val_dataloader
+        self.crop_args = crop_args
+        self.history = []
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        result = fast_evaluation(pl_module, self.val_dataset, self.val_dataloader, self.crop_args,
+                                 device=pl_module.device)
+        self.history.append(dict(result, epoch=trainer.current_epoch))
+        for name, value in result.items():
+            pl_module.log('val_top1_' + name, float(value), rank_zero_only=True)
+
+
+def add_crop_geometry_arguments(parser):
+    """
+    The arguments of the crop scripts that decide the crop box, used to check if the crops contain the ground truth
+    box. Pass the same values as to the crop script.
+    """
+    parser.add_argument('--crop_ratio', type=float, default=1.4,
+                        help="Crop ratio used to check if the crops contain the ground truth box.")
+    parser.add_argument('--fix_ratio', default=False,
+                        action='store_true', help='The crops are extended to 4:3.')
+    parser.add_argument('--equal_extend', default=True,
+                        action='store_true', help='The crops extend equal size in both height and width.')
+    parser.add_argument('--rotate_image', default=False,
+                        action='store_true', help='The crops are rotated to fit 4:3 naturally.')
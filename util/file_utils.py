@@ -0,0 +1,50 @@
+import os
+import shutil
+
+
+def link_or_copy(src, dst):
+    """
+    Hard link dst to src, copy the file if a hard link is not possible (e.g. across file systems).
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+# ioctl request to share the extents of a file on copy-on-write file systems (btrfs, xfs), from linux/fs.h.
+FICLONE = 0x40049409
+
+
+def reflink_or_copy(src, dst):
+    """
+    Make dst a copy-on-write clone of src, which takes no extra space until one of them is modified, copy the file if
+    the file system does not support it.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        import fcntl
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except (ImportError, OSError):
+        shutil.copyfile(src, dst)
+
+
+def place_file(src, dst, link_mode='copy'):
+    """
+    :param link_mode: copy, hardlink or reflink, the last two fall back to a copy.
+    """
+    if link_mode == 'hardlink':
+        link_or_copy(src, dst)
+    elif link_mode == 'reflink':
+        reflink_or_copy(src, dst)
+    elif link_mode == 'copy':
+        # Remove dst first, writing through a hard link would modify the file it is linked to.
+        if os.path.lexists(dst):
+            os.remove(dst)
+        shutil.copyfile(src, dst)
+    else:
+        raise ValueError(f"Unknown link mode {link_mode}, choose from copy, hardlink and reflink.")
@@ -0,0 +1,200 @@
+"""
+Interchangeable JPEG decode and encode backends for the crop path.
+
+    codec = get_codec('turbojpeg')
+    image = codec.read('image.jpg')            # RGB PIL image
+    codec.save(cropped_img, 'cropped.jpg')
+
+pil is always available. turbojpeg (pip install PyTurboJPEG, needs libjpeg-turbo) and opencv
+(pip install opencv-python-headless) are optional, get_codec falls back to the next available backend when one is
+missing, and auto picks the fastest available one. The fast backends only handle JPEG, other formats go through PIL.
+
+libjpeg-turbo and OpenCV can also decode at 1/2, 1/4 or 1/8 of the size, which skips most of the decoding work when
+a smaller image is enough, see --decode_scale of scripts/qa_report.py and util/distillation_dataset.py. No backend
+applies the EXIF orientation, so all of them return the pixels in the order they are stored.
+"""
+import io
+import os
+import numpy as np
+from PIL import Image
+from util.content_index import register_crop_parameters
+
+CODEC_BACKENDS = ['pil', 'turbojpeg', 'opencv', 'auto']
+
+# Order of preference of the auto backend.
+AUTO_BACKENDS = ['turbojpeg', 'opencv', 'pil']
+
+# PIL's default, the quality that the crop scripts have always written.
+DEFAULT_JPEG_QUALITY = 75
+
+JPEG_EXTENSIONS = ['.jpg', '.jpeg']
+
+SCALE_DENOMINATORS = [1, 2, 4, 8]
+
+
+def is_jpeg(data):
+    return data[:2] == b'\xff\xd8'
+
+
+class PILCodec:
+    name = 'pil'
+
+    def decode(self, data, scale_denominator=1):
+        """
+        :param data: Encoded image bytes.
+        :param scale_denominator: Decode at 1/scale_denominator of the size, one of 1, 2, 4 and 8.
+        :return: RGB PIL image.
+        """
+        image = Image.open(io.BytesIO(data))
+        if scale_denominator > 1:
+            # draft lets libjpeg decode at a reduced size, other formats are decoded in full and resized.
+            target_size = (image.size[0] // scale_denominator, image.size[1] // scale_denominator)
+            image.draft('RGB', target_size)
+            image = image.convert("RGB")
+            if image.size != target_size:
+                image = image.resize(target_size)
+            return image
+        return image.convert("RGB")
+
+    def read(self, path, scale_denominator=1):
+        with open(path, 'rb') as file:
+            return self.decode(file.read(), scale_denominator)
+
+    def encode(self, image, quality=DEFAULT_JPEG_QUALITY, format='JPEG'):
+        buffer = io.BytesIO()
+        if format == 'JPEG':
+            image.convert('RGB').save(buffer, format=format, quality=quality)
+        else:
+            image.save(buffer, format=format)
+        return buffer.getvalue()
+
+    def save(self, image, path, quality=DEFAULT_JPEG_QUALITY):
+        """
+        Save the image in the format of the extension of path, like PIL.
+        """
+        if os.path.splitext(path)[1].lower() not in JPEG_EXTENSIONS:
+            image.save(path)
+            return
+        data = self.encode(image, quality)
+        with open(path, 'wb') as file:
+            file.write(data)
+
+
+class TurboJPEGCodec(PILCodec):
+    name = 'turbojpeg'
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG
+        # Raises if the libjpeg-turbo library is not found.
+        self.jpeg = TurboJPEG()
+
+    def __getstate__(self):
+        # The ctypes handle can not be pickled, the loader workers load the library again.
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def decode(self, data, scale_denominator=1):
+        if not is_jpeg(data):
+            return super().decode(data, scale_denominator)
+        from turbojpeg import TJPF_RGB
+        array = self.jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, scale_denominator)
+                                 if scale_denominator > 1 else None)
+        return Image.fromarray(array)
+
+    def encode(self, image, quality=DEFAULT_JPEG_QUALITY, format='JPEG'):
+        if format != 'JPEG':
+            return super().encode(image, quality, format)
+        from turbojpeg import TJPF_RGB, TJSAMP_420
+        # 4:2:0 chroma subsampling like PIL.
+        return self.jpeg.encode(np.ascontiguousarray(np.asarray(image.convert('RGB'))), quality=quality,
+                                pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+
+
+class OpenCVCodec(PILCodec):
+    name = 'opencv'
+
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        # The crop workers already run in parallel, OpenCV should not start its own threads.
+        cv2.setNumThreads(1)
+        # imdecode rotates the image by its EXIF orientation, PIL and turbojpeg do not, so the boxes would not match.
+        self.reduced_flags = {scale_denominator: flag | cv2.IMREAD_IGNORE_ORIENTATION for scale_denominator, flag in
+                              {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4,
+                               8: cv2.IMREAD_REDUCED_COLOR_8}.items()}
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def decode(self, data, scale_denominator=1):
+        if not is_jpeg(data):
+            return super().decode(data, scale_denominator)
+        array = self.cv2.imdecode(np.frombuffer(data, dtype=np.uint8), self.reduced_flags[scale_denominator])
+        if array is None:
+            raise OSError("OpenCV can not decode the image.")
+        return Image.fromarray(self.cv2.cvtColor(array, self.cv2.COLOR_BGR2RGB))
+
+    def encode(self, image, quality=DEFAULT_JPEG_QUALITY, format='JPEG'):
+        if format != 'JPEG':
+            return super().encode(image, quality, format)
+        array = self.cv2.cvtColor(np.asarray(image.convert('RGB')), self.cv2.COLOR_RGB2BGR)
+        success, buffer = self.cv2.imencode('.jpg', array, [self.cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not success:
+            raise OSError("OpenCV can not encode the image.")
+        return buffer.tobytes()
+
+
+CODEC_CLASSES = {'pil': PILCodec, 'turbojpeg': TurboJPEGCodec, 'opencv': OpenCVCodec}
+
+_codecs = {}
+
+
+def get_codec(name='pil'):
+    """
+    :param name: One of CODEC_BACKENDS.
+    :return: The codec of the backend, or of the next available backend of AUTO_BACKENDS if it is missing.
+    """
+    if name == 'auto':
+        candidates = AUTO_BACKENDS
+    else:
+        candidates = [name] + [backend for backend in AUTO_BACKENDS if backend != name]
+    if candidates[0] in _codecs:
+        return _codecs[candidates[0]]
+    for backend in candidates:
+        try:
+            codec = CODEC_CLASSES[backend]()
+        except (ImportError, OSError, RuntimeError) as e:
+            if name != 'auto':
+                print(f"Image codec {backend} is not available ({e}), falling back to the next backend.")
+            continue
+        _codecs[candidates[0]] = codec
+        return codec
+    raise RuntimeError("No image codec is available.")
+
+
+def get_available_codecs():
+    """
+    :return: Names of the backends that can be loaded on this machine.
+    """
+    available = []
+    for backend, codec_class in CODEC_CLASSES.items():
+        try:
+            codec_class()
+        except (ImportError, OSError, RuntimeError):
+            continue
+        available.append(backend)
+    return available
+
+
+def add_codec_arguments(parser):
+    parser.add_argument('--codec', type=str, default='pil', choices=CODEC_BACKENDS,
+                        help="Backend that decodes the input images and encodes the crops, missing backends fall "
+                             "back to the next available one.")
+    parser.add_argument('--jpeg_quality', type=int, default=DEFAULT_JPEG_QUALITY,
+                        help="Quality of the JPEG crops.")
+    register_crop_parameters(parser, ['codec', 'jpeg_quality'])
@@ -0,0 +1,101 @@
+"""
+Coalesce concurrent inference requests into batches. Requests are queued by many threads and one worker thread takes
+up to max_batch_size of them, waiting at most max_wait_seconds after the first one for the batch to fill, so a
+lone request is delayed by at most max_wait_seconds and a burst of requests runs in full batches.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    """
+    Raised by InferenceBatcher.submit when the queue is full, the caller should retry later.
+    """
+
+
+class InferenceBatcher:
+    def __init__(self, predict_batch, max_batch_size=8, max_wait_seconds=0.01, max_queue_size=64, metrics=None):
+        """
+        :param predict_batch: Function from a list of items to the list of their results, in the same order.
+        :param max_queue_size: Number of queued items above which submit raises QueueFullError.
+        :param metrics: Optional CropMetrics that records the batch sizes, the queue depth and the waiting time.
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.metrics = metrics
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def submit(self, item):
+        """
+        :return: A Future with the result of the item.
+        """
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future, time.perf_counter()))
+        except queue.Full:
+            if self.metrics is not None:
+                self.metrics.record_failure('queue_full')
+            raise QueueFullError(f"{self.queue.maxsize} requests are already waiting.")
+        return future
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def next_batch(self):
+        """
+        Block until there is a request, then collect more until the batch is full or the wait time is over.
+        """
+        try:
+            batch = [self.queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while not self.stop_event.is_set():
+            batch = self.next_batch()
+            # The requests that timed out were cancelled by their caller, they are left out of the batch.
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if len(batch) == 0:
+                continue
+            items = [item for item, _, _ in batch]
+            start = time.perf_counter()
+            if self.metrics is not None:
+                for _, _, submit_time in batch:
+                    self.metrics.observe_stage('queue_wait', start - submit_time)
+                # The mean batch size is batched_requests / batches.
+                self.metrics.increment_counter('batches')
+                self.metrics.increment_counter('batched_requests', len(batch))
+                self.metrics.set_queue_depth('inference_requests', self.queue.qsize())
+            try:
+                results = self.predict_batch(items)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            if self.metrics is not None:
+                self.metrics.observe_stage('batched_inference', time.perf_counter() - start)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
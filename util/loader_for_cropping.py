@@ -1,13 +1,16 @@
 import os
-from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 from torchvision.transforms import transforms
+from util.batch_autotuner import AutotunedBatchSampler
+from util.bbox_store import hash_bytes
+from util.image_codecs import get_codec
 
 
 class ImageFolderDataset(Dataset):
-    def __init__(self, path_to_input_folder, transform=None, list_of_images=None):
+    def __init__(self, path_to_input_folder, transform=None, list_of_images=None, codec=None):
         self.folder_path = path_to_input_folder
+        self.codec = codec if codec is not None else get_codec('pil')
         if list_of_images is None:
             self.image_names = os.listdir(path_to_input_folder)
         else:
@@ -23,16 +26,30 @@ class ImageFolderDataset(Dataset):
     def __getitem__(self, idx):
         image_name = self.image_names[idx]
         image_path = os.path.join(self.folder_path, image_name)
-        image = Image.open(image_path).convert("RGB")
+        with open(image_path, 'rb') as file:
+            data = file.read()
+        image = self.codec.decode(data)
 
         if self.transform is not None:
             image = self.transform(image)
 
-        return image, image_name
+        # The content hash of the record is computed from the bytes that are decoded, the file is only read once.
+        return image, image_name, hash_bytes(data)
 
 
+def collate_to_lists(batch):
+    """
+    Keep the images of a batch as a tuple of tensors, the images have different sizes so default_collate can not stack
+    them, preprocess_images pads them and returns the pixel mask of the padding.
+    """
+    return tuple(zip(*batch))
 
 
-
-def init_loader_with_folder_name_and_list_of_images(path_to_input_folder, batch_size, list_of_images = None):
-    return DataLoader(ImageFolderDataset(path_to_input_folder, list_of_images=list_of_images), batch_size=batch_size)
\ No newline at end of file
+def init_loader_with_folder_name_and_list_of_images(path_to_input_folder, batch_size, list_of_images = None,
+                                                    autotuner=None, num_workers=0, worker_init_fn=None, codec=None):
+    dataset = ImageFolderDataset(path_to_input_folder, list_of_images=list_of_images, codec=codec)
+    if autotuner is not None:
+        return DataLoader(dataset, batch_sampler=AutotunedBatchSampler(len(dataset), autotuner),
+                          collate_fn=collate_to_lists, num_workers=num_workers, worker_init_fn=worker_init_fn)
+    return DataLoader(dataset, batch_size=batch_size, collate_fn=collate_to_lists, num_workers=num_workers,
+                      worker_init_fn=worker_init_fn)
@@ -0,0 +1,334 @@
+"""
+Where the crop engine puts the cropped images.
+
+FolderCropSink saves one image file per crop, as the crop scripts always did.
+MemmapCropSink letterboxes every crop to a fixed size and writes it into a preallocated memory-mapped uint8 array, one
+row per input image, so training can read the crops without decoding JPEGs and the page cache is shared by all the
+loader workers. The rows are fixed by the list of filenames, so several processes can write into the same array.
+MemmapCropDataset reads such an array.
+TarShardSink writes WebDataset-style tar shards of a bounded size, each sample being the crop, the crop resized to a
+shorter edge of 256 and a JSON with the bbox and the original size, with an index of the offsets of every member
+for random access. The shards are written sequentially by one process, TarShardDataset reads them back.
+"""
+import io
+import json
+import os
+import tarfile
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+from util.content_index import register_crop_parameters
+from util.image_codecs import DEFAULT_JPEG_QUALITY, get_codec
+
+SHARD_INDEX_FILE_NAME = 'shard_index.jsonl'
+
+
+class FolderCropSink:
+    # The workers of util/parallel_inference.py write the crops themselves.
+    writes_in_workers = True
+
+    def __init__(self, output_dir, codec=None, jpeg_quality=DEFAULT_JPEG_QUALITY):
+        """
+        :param codec: Codec from util/image_codecs.py that encodes the crops, PIL by default.
+        """
+        self.output_dir = output_dir
+        self.codec = codec if codec is not None else get_codec('pil')
+        self.jpeg_quality = jpeg_quality
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, filename, cropped_img, record=None):
+        """
+        :return: The number of bytes written.
+        """
+        path = os.path.join(self.output_dir, filename)
+        # The file can be a hard link to an indexed output of another run, see util/content_index.py.
+        if os.path.lexists(path):
+            os.remove(path)
+        self.codec.save(cropped_img, path, self.jpeg_quality)
+        return os.path.getsize(path)
+
+    def close(self):
+        pass
+
+
+def letterbox(image, width, height, background_color):
+    """
+    Resize the image to fit in width x height keeping its aspect ratio and pad it with the background color.
+    :return: The uint8 array of shape (height, width, 3) and the box (left, top, width, height) of the image in it.
+    """
+    scale = min(width / image.size[0], height / image.size[1])
+    resized_width = max(min(round(image.size[0] * scale), width), 1)
+    resized_height = max(min(round(image.size[1] * scale), height), 1)
+    canvas = Image.new('RGB', (width, height), tuple(background_color))
+    left = (width - resized_width) // 2
+    top = (height - resized_height) // 2
+    canvas.paste(image.convert('RGB').resize((resized_width, resized_height), Image.BILINEAR), (left, top))
+    return np.asarray(canvas), (left, top, resized_width, resized_height)
+
+
+class MemmapCropSink:
+    writes_in_workers = True
+
+    def __init__(self, output_dir, list_of_file_name, height=256, width=341, background_color=(234, 242, 245)):
+        """
+        Create the arrays, or open them to resume if output_dir already holds a sink for the same filenames.
+        :param height: Height of the letterboxed crops, 256 x 341 keeps the 4:3 ratio of fix_ratio.
+        """
+        self.output_dir = output_dir
+        self.height = height
+        self.width = width
+        self.background_color = tuple(background_color)
+        self.rows = {filename: row for row, filename in enumerate(list_of_file_name)}
+        self.arrays = None
+        os.makedirs(output_dir, exist_ok=True)
+        index = {'filenames': list(list_of_file_name), 'height': height, 'width': width,
+                 'background_color': list(self.background_color)}
+        index_path = os.path.join(output_dir, 'index.json')
+        if os.path.exists(index_path):
+            with open(index_path) as file:
+                if json.load(file) == index:
+                    return
+        number_of_rows = len(list_of_file_name)
+        # open_memmap writes a .npy header, so the arrays can also be opened with np.load(mmap_mode='r').
+        np.lib.format.open_memmap(os.path.join(output_dir, 'crops.npy'), mode='w+', dtype=np.uint8,
+                                  shape=(number_of_rows, height, width, 3)).flush()
+        np.lib.format.open_memmap(os.path.join(output_dir, 'letterbox_boxes.npy'), mode='w+', dtype=np.int32,
+                                  shape=(number_of_rows, 4)).flush()
+        np.lib.format.open_memmap(os.path.join(output_dir, 'valid.npy'), mode='w+', dtype=np.bool_,
+                                  shape=(number_of_rows,)).flush()
+        with open(index_path + '.tmp', 'w') as file:
+            json.dump(index, file)
+        os.replace(index_path + '.tmp', index_path)
+
+    def open_arrays(self):
+        # Opened lazily, so every process that writes maps the files itself.
+        if self.arrays is None:
+            self.arrays = {name: np.load(os.path.join(self.output_dir, name + '.npy'), mmap_mode='r+')
+                           for name in ['crops', 'letterbox_boxes', 'valid']}
+        return self.arrays
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['arrays'] = None
+        return state
+
+    def write(self, filename, cropped_img, record=None):
+        arrays = self.open_arrays()
+        row = self.rows[filename]
+        arrays['crops'][row], arrays['letterbox_boxes'][row] = letterbox(cropped_img, self.width, self.height,
+                                                                         self.background_color)
+        arrays['valid'][row] = True
+        return self.height * self.width * 3
+
+    def close(self):
+        if self.arrays is not None:
+            for array in self.arrays.values():
+                array.flush()
+
+
+class MemmapCropDataset(Dataset):
+    def __init__(self, sink_dir, transform=None, only_valid=True):
+        """
+        :param sink_dir: output_dir of a MemmapCropSink.
+        :param transform: Optional function applied to the uint8 tensor of shape (height, width, 3).
+        :param only_valid: Skip the rows of images that failed or are not cropped yet.
+        """
+        self.sink_dir = sink_dir
+        self.transform = transform
+        with open(os.path.join(sink_dir, 'index.json')) as file:
+            self.filenames = json.load(file)['filenames']
+        valid = np.load(os.path.join(sink_dir, 'valid.npy'))
+        self.rows = np.flatnonzero(valid) if only_valid else np.arange(len(valid))
+        self.letterbox_boxes = np.load(os.path.join(sink_dir, 'letterbox_boxes.npy'))
+        self.crops = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if self.crops is None:
+            # Opened in each loader worker, copy-on-write so the tensors are writable without copying the pages.
+            self.crops = np.load(os.path.join(self.sink_dir, 'crops.npy'), mmap_mode='c')
+        row = self.rows[idx]
+        image = torch.from_numpy(self.crops[row])
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, self.filenames[row]
+
+
+def resize_shorter_edge(image, size):
+    width, height = image.size
+    if width < height:
+        return image.resize((size, round(size * height / width)))
+    return image.resize((round(size * width / height), size))
+
+
+def get_sample_key(filename):
+    # WebDataset splits the member names at the first dot of the basename.
+    return os.path.splitext(filename)[0].replace('.', '_')
+
+
+class TarShardSink:
+    # A shard is a single stream, so the workers only encode the samples and the parent process writes them.
+    writes_in_workers = False
+
+    def __init__(self, output_dir, max_shard_bytes=1 << 30, resized_shorter_edge=256, jpeg_quality=DEFAULT_JPEG_QUALITY,
+                 shard_prefix='shard', codec=None):
+        """
+        :param max_shard_bytes: A new shard is started before a sample would make the shard larger than this.
+        :param resized_shorter_edge: Shorter edge of the resized crop in each sample, or None to not store it.
+        :param codec: Codec from util/image_codecs.py that encodes the crops, PIL by default.
+        """
+        self.output_dir = output_dir
+        self.max_shard_bytes = max_shard_bytes
+        self.resized_shorter_edge = resized_shorter_edge
+        self.jpeg_quality = jpeg_quality
+        self.shard_prefix = shard_prefix
+        self.codec = codec if codec is not None else get_codec('pil')
+        os.makedirs(output_dir, exist_ok=True)
+        # Shards of a previous run are kept, their samples are already in the index.
+        self.shard_number = len([name for name in os.listdir(output_dir)
+                                 if name.startswith(shard_prefix + '-') and name.endswith('.tar')])
+        self.tar = None
+        self.shard_name = None
+        self.shard_index_entries = []
+
+    def encode(self, filename, cropped_img, record=None):
+        """
+        :return: Dictionary from the member extension to its bytes, the part that can run in the worker processes.
+        """
+        members = {'jpg': self.codec.encode(cropped_img, self.jpeg_quality)}
+        if self.resized_shorter_edge is not None:
+            members['resized.jpg'] = self.codec.encode(resize_shorter_edge(cropped_img, self.resized_shorter_edge),
+                                                       self.jpeg_quality)
+        metadata = {'filename': filename}
+        if record is not None:
+            metadata.update({key: record[key] for key in ['original_size', 'bbox', 'score', 'crop_box', 'rotated']
+                             if key in record})
+        members['json'] = json.dumps(metadata).encode()
+        return members
+
+    def open_shard(self):
+        self.shard_name = f"{self.shard_prefix}-{self.shard_number:06d}.tar"
+        self.shard_number += 1
+        # Written under a temporary name, so a shard that exists is complete.
+        self.tar = tarfile.open(os.path.join(self.output_dir, self.shard_name + '.tmp'), 'w',
+                                format=tarfile.USTAR_FORMAT)
+
+    def close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        os.replace(os.path.join(self.output_dir, self.shard_name + '.tmp'),
+                   os.path.join(self.output_dir, self.shard_name))
+        with open(os.path.join(self.output_dir, SHARD_INDEX_FILE_NAME), 'a') as file:
+            for entry in self.shard_index_entries:
+                file.write(json.dumps(entry) + '\n')
+        self.tar = None
+        self.shard_index_entries = []
+
+    def write_encoded(self, filename, members):
+        """
+        :return: The number of bytes written.
+        """
+        # Each member takes a 512 bytes header and is padded to 512 bytes.
+        sample_bytes = sum(512 + (len(data) + 511) // 512 * 512 for data in members.values())
+        if self.tar is not None and self.tar.offset + sample_bytes > self.max_shard_bytes and \
+                len(self.shard_index_entries) > 0:
+            self.close_shard()
+        if self.tar is None:
+            self.open_shard()
+        key = get_sample_key(filename)
+        entry = {'filename': filename, 'key': key, 'shard': self.shard_name, 'members': {}}
+        for extension, data in members.items():
+            tar_info = tarfile.TarInfo(f"{key}.{extension}")
+            tar_info.size = len(data)
+            tar_info.mtime = int(time.time())
+            header_size = len(tar_info.tobuf(self.tar.format, self.tar.encoding, self.tar.errors))
+            entry['members'][extension] = [self.tar.offset + header_size, tar_info.size]
+            self.tar.addfile(tar_info, io.BytesIO(data))
+        self.shard_index_entries.append(entry)
+        return sample_bytes
+
+    def write(self, filename, cropped_img, record=None):
+        return self.write_encoded(filename, self.encode(filename, cropped_img, record))
+
+    def close(self):
+        self.close_shard()
+
+
+def load_shard_index(shard_dir):
+    """
+    :return: Dictionary from the filename of the original image to its entry in the shard index, the last one wins.
+    """
+    shard_index = {}
+    with open(os.path.join(shard_dir, SHARD_INDEX_FILE_NAME)) as file:
+        for line in file:
+            entry = json.loads(line)
+            shard_index[entry['filename']] = entry
+    return shard_index
+
+
+class TarShardDataset(Dataset):
+    def __init__(self, shard_dir, member='resized.jpg', transform=None, codec=None):
+        """
+        Random access to the samples of a TarShardSink through its index. For purely sequential reads, the shards can
+        also be streamed with tarfile or webdataset.
+        :param member: jpg for the crop, resized.jpg for the resized crop.
+        :param codec: Codec from util/image_codecs.py that decodes the images, PIL by default.
+        """
+        self.shard_dir = shard_dir
+        self.codec = codec if codec is not None else get_codec('pil')
+        self.member = member
+        self.transform = transform
+        self.entries = sorted(load_shard_index(shard_dir).values(), key=lambda entry: (entry['shard'],
+                                                                                      entry['members'][member][0]))
+        self.files = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def read_member(self, entry, extension):
+        if entry['shard'] not in self.files:
+            # Opened lazily, so each loader worker has its own file handles.
+            self.files[entry['shard']] = open(os.path.join(self.shard_dir, entry['shard']), 'rb')
+        file = self.files[entry['shard']]
+        offset, size = entry['members'][extension]
+        file.seek(offset)
+        return file.read(size)
+
+    def __getitem__(self, idx):
+        entry = self.entries[idx]
+        image = self.codec.decode(self.read_member(entry, self.member))
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, json.loads(self.read_member(entry, 'json'))
+
+
+def add_output_sink_arguments(parser):
+    parser.add_argument('--output_format', type=str, default='files', choices=['files', 'memmap', 'tar'],
+                        help="files saves one image per crop in output_dir, memmap writes letterboxed fixed-size "
+                             "crops into output_dir/crops.npy for training, tar writes the crops, the resized crops "
+                             "and their metadata sequentially into tar shards in output_dir.")
+    parser.add_argument('--memmap_height', type=int, default=256,
+                        help="Height of the letterboxed crops of --output_format memmap.")
+    parser.add_argument('--memmap_width', type=int, default=341,
+                        help="Width of the letterboxed crops of --output_format memmap.")
+    parser.add_argument('--shard_max_mb', type=int, default=1024,
+                        help="Maximum size of a tar shard of --output_format tar.")
+    parser.add_argument('--shard_resized_edge', type=int, default=256,
+                        help="Shorter edge of the resized crops stored in the tar shards.")
+    register_crop_parameters(parser, ['output_format', 'memmap_height', 'memmap_width', 'shard_resized_edge'])
+
+
+def init_output_sink(args, output_dir, list_of_file_name):
+    if getattr(args, 'output_format', 'files') == 'memmap':
+        return MemmapCropSink(output_dir, list_of_file_name, args.memmap_height, args.memmap_width,
+                              (args.background_color_R, args.background_color_G, args.background_color_B))
+    codec = get_codec(getattr(args, 'codec', 'pil'))
+    if getattr(args, 'output_format', 'files') == 'tar':
+        return TarShardSink(output_dir, args.shard_max_mb * 1024 * 1024, args.shard_resized_edge,
+                            getattr(args, 'jpeg_quality', DEFAULT_JPEG_QUALITY), codec=codec)
+    return FolderCropSink(output_dir, codec, getattr(args, 'jpeg_quality', DEFAULT_JPEG_QUALITY))
@@ -0,0 +1,256 @@
+"""
+Data-parallel crop inference on CPU. K worker processes each run the same model with a fixed number of torch threads
+pinned to their own set of cores. The model is loaded once in the parent process and shared with the workers
+(copy-on-write under fork, shared memory otherwise). Batches of images are handed out dynamically, so a slow worker
+does not hold back the others.
+
+Note that the parent process should not run inference before the pool is created, forking a process after the
+OpenMP thread pool has started may hang the workers.
+"""
+import collections
+import multiprocessing
+import os
+import tempfile
+import time
+from util.background_detector import init_background_detector_from_args
+from util.batch_autotuner import init_batch_autotuner_from_args
+from util.bbox_store import hash_bytes
+from util.bbox_metadata_store import STATUS_FAILED
+from util.crop_engine import predict_bboxes_and_scores, crop_image_with_bbox, make_crop_record
+from util.early_exit import init_early_exit_from_args
+from util.image_codecs import get_codec
+from util.output_sinks import FolderCropSink
+from util.topology import get_core_sets, pin_current_process
+
+# State of the current worker process, set by init_inference_worker.
+_worker_state = {}
+
+
+def init_inference_worker(args, model, feature_extractor, device, core_sets, threads_per_worker, worker_counter,
+                          sink, num_workers, topology):
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    if topology is not None:
+        topology.apply(worker_index)
+    else:
+        pin_current_process(core_sets[worker_index % len(core_sets)], threads_per_worker)
+    _worker_state['args'] = args
+    _worker_state['model'] = model
+    _worker_state['feature_extractor'] = feature_extractor
+    _worker_state['device'] = device
+    _worker_state['worker_index'] = worker_index
+    _worker_state['early_exit'] = init_early_exit_from_args(args)
+    _worker_state['background_detector'] = init_background_detector_from_args(args)
+    _worker_state['sink'] = sink
+    # Each worker tunes the batch size for itself, under its share of the memory ceiling.
+    _worker_state['autotuner'] = init_batch_autotuner_from_args(args, num_workers)
+
+
+def crop_batch_in_worker(list_of_file_name):
+    """
+    Crop and save one task of images inside a worker process, in batches of the size chosen by the autotuner of the
+    worker if --auto_batch_size is set.
+    :return: Dictionary of crop_images_in_worker.
+    """
+    autotuner = _worker_state['autotuner']
+    if autotuner is None:
+        return crop_images_in_worker(list_of_file_name)
+    list_of_results = []
+    start = 0
+    while start < len(list_of_file_name):
+        batch = list_of_file_name[start: start + autotuner.batch_size]
+        batch_start = time.perf_counter()
+        list_of_results.append(crop_images_in_worker(batch))
+        autotuner.record_batch(len(batch), time.perf_counter() - batch_start)
+        start += len(batch)
+    return merge_worker_results(list_of_results)
+
+
+def merge_worker_results(list_of_results):
+    merged = {'records': [], 'stage_seconds': collections.Counter(), 'bytes_read': 0, 'bytes_written': 0,
+              'failures': [], 'exit_layer_counts': collections.Counter(),
+              'background_detector_counts': collections.Counter(), 'encoded_samples': []}
+    for result in list_of_results:
+        for key in ['records', 'failures', 'encoded_samples']:
+            merged[key] += result[key]
+        for key in ['stage_seconds', 'exit_layer_counts', 'background_detector_counts']:
+            merged[key].update(result[key])
+        for key in ['bytes_read', 'bytes_written']:
+            merged[key] += result[key]
+    merged['stage_seconds'] = dict(merged['stage_seconds'])
+    merged['exit_layer_counts'] = dict(merged['exit_layer_counts'])
+    merged['background_detector_counts'] = dict(merged['background_detector_counts'])
+    return merged
+
+
+def crop_images_in_worker(list_of_file_name):
+    """
+    Crop and save one batch of images inside a worker process.
+    :return: Dictionary with the list of records from make_crop_record, the seconds spent in each stage, the bytes
+    read and written, the reasons of the failures, the number of images that exited at each decoder layer, the number
+    of boxes taken from the background detector and from the model, and the encoded samples that the parent process
+    writes, for sinks that do not write in the workers.
+    """
+    args = _worker_state['args']
+    early_exit = _worker_state['early_exit']
+    background_detector = _worker_state['background_detector']
+    sink = _worker_state['sink']
+    encoded_samples = []
+    exit_layer_counts_before = collections.Counter(early_exit.exit_layer_counts) if early_exit is not None else None
+    background_detector_counts_before = collections.Counter(background_detector.counts) \
+        if background_detector is not None else None
+    stage_seconds = {}
+    failures = []
+    bytes_written = 0
+
+    start = time.perf_counter()
+    codec = get_codec(getattr(args, 'codec', 'pil'))
+    list_of_images, list_of_content_hash = [], []
+    bytes_read = 0
+    for filename in list_of_file_name:
+        with open(os.path.join(args.input_dir, filename), 'rb') as file:
+            data = file.read()
+        list_of_images.append(codec.decode(data))
+        # Hashed from the bytes that are decoded, the file is only read once.
+        list_of_content_hash.append(hash_bytes(data))
+        bytes_read += len(data)
+    stage_seconds['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bboxes, scores = predict_bboxes_and_scores(_worker_state['model'], _worker_state['feature_extractor'],
+                                          list_of_images, _worker_state['device'],
+                                          precision=getattr(args, 'precision', 'fp32'), early_exit=early_exit,
+                                          background_detector=background_detector)
+    stage_seconds['inference'] = time.perf_counter() - start
+    exit_layer_counts = dict(early_exit.exit_layer_counts - exit_layer_counts_before) if early_exit is not None \
+        else {}
+    background_detector_counts = dict(background_detector.counts - background_detector_counts_before) \
+        if background_detector is not None else {}
+
+    start = time.perf_counter()
+    list_of_original_image_size_and_bbox = []
+    for filename, image, bbox, score, content_hash in zip(list_of_file_name, list_of_images, bboxes, scores,
+                                                          list_of_content_hash):
+        record = make_crop_record(args, filename, image.size, bbox, score, content_hash,
+                                  getattr(args, 'checkpoint_hash', None))
+        try:
+            cropped_img = crop_image_with_bbox(args, image, bbox)
+            if sink.writes_in_workers:
+                bytes_written += sink.write(filename, cropped_img, record)
+            else:
+                encoded_samples.append((filename, sink.encode(filename, cropped_img, record)))
+        except Exception as e:
+            print(f"Failed to crop {filename}: {e}")
+            failures.append(type(e).__name__)
+            record['status'] = STATUS_FAILED
+        list_of_original_image_size_and_bbox.append(record)
+    stage_seconds['crop_and_save'] = time.perf_counter() - start
+
+    return {'records': list_of_original_image_size_and_bbox, 'stage_seconds': stage_seconds,
+            'bytes_read': bytes_read, 'bytes_written': bytes_written, 'failures': failures,
+            'exit_layer_counts': exit_layer_counts, 'background_detector_counts': background_detector_counts,
+            'encoded_samples': encoded_samples}
+
+
+def split_into_batches(list_of_file_name, batch_size):
+    return [list_of_file_name[i: i + batch_size] for i in range(0, len(list_of_file_name), batch_size)]
+
+
+def crop_images_in_parallel(args, model, feature_extractor, device, list_of_file_name, num_workers,
+                            threads_per_worker, metrics=None, metadata_writer=None, progress_bar=None, early_exit=None,
+                            sink=None, topology=None, background_detector=None):
+    """
+    Crop and save the images with num_workers processes, each using threads_per_worker torch threads.
+    :param early_exit: Optional EarlyExitDecoder that collects the exit layers of the workers, which enable early
+    exit from args themselves.
+    :param metrics: Optional CropMetrics that collects the stage timings reported by the workers.
+    :param metadata_writer: Optional writer from util/bbox_metadata_store.py that stores the record of each image.
+    :param sink: Sink from util/output_sinks.py that the workers write the crops to, default to the files of
+    args.output_dir.
+    :param topology: Optional Topology from util/topology.py that sets the cores and threads of the workers instead of
+    threads_per_worker.
+    :param background_detector: Optional BackgroundDetector that collects the counts of the workers, which enable the
+    background detector from args themselves.
+    """
+    if sink is None:
+        sink = FolderCropSink(args.output_dir)
+    model.share_memory()
+    core_sets = get_core_sets(num_workers, threads_per_worker)
+    context = multiprocessing.get_context(args.start_method)
+    worker_counter = context.Value('i', 0)
+    # With --auto_batch_size, the workers split each task into batches of their own size.
+    batches = split_into_batches(list_of_file_name,
+                                 args.max_batch_size if getattr(args, 'auto_batch_size', False) else args.batch_size)
+    number_of_finished_batches = 0
+    with context.Pool(num_workers, initializer=init_inference_worker,
+                      initargs=(args, model, feature_extractor, device, core_sets, threads_per_worker,
+                                worker_counter, sink, num_workers, topology)) as pool:
+        # chunksize=1 lets idle workers pick up the next batch as soon as they are done.
+        for result in pool.imap_unordered(crop_batch_in_worker, batches, chunksize=1):
+            records = result['records']
+            for filename, members in result['encoded_samples']:
+                result['bytes_written'] += sink.write_encoded(filename, members)
+            if metadata_writer is not None:
+                for record in records:
+                    metadata_writer.append(record)
+            number_of_finished_batches += 1
+            if early_exit is not None:
+                early_exit.exit_layer_counts.update(result['exit_layer_counts'])
+            if background_detector is not None:
+                background_detector.counts.update(result['background_detector_counts'])
+            if metrics is not None:
+                for stage, seconds in result['stage_seconds'].items():
+                    metrics.observe_stage(stage, seconds)
+                metrics.add_bytes_read(result['bytes_read'])
+                metrics.add_bytes_written(result['bytes_written'])
+                for reason in result['failures']:
+                    metrics.record_failure(reason)
+                for layer, count in result['exit_layer_counts'].items():
+                    metrics.increment_counter(f'early_exit_layer_{layer}', count)
+                if 'background' in result['background_detector_counts']:
+                    metrics.increment_counter('background_detector_boxes',
+                                              result['background_detector_counts']['background'])
+                metrics.add_images(len(records))
+                metrics.set_queue_depth('pending_batches', len(batches) - number_of_finished_batches)
+                metrics.maybe_write_snapshot()
+            if progress_bar is not None:
+                progress_bar.update(len(records))
+
+
+def get_candidate_configurations(number_of_cores):
+    """
+    :return: List of (num_workers, threads_per_worker) that use all cores, from one big worker to one worker per core.
+    """
+    configurations = []
+    threads_per_worker = number_of_cores
+    while threads_per_worker >= 1:
+        configurations.append((number_of_cores // threads_per_worker, threads_per_worker))
+        threads_per_worker //= 2
+    if configurations[-1] != (number_of_cores, 1):
+        configurations.append((number_of_cores, 1))
+    return configurations
+
+
+def benchmark_configurations(args, model, feature_extractor, device, list_of_file_name, configurations):
+    """
+    Crop the same images with every (num_workers, threads_per_worker) configuration and measure the throughput.
+    The cropped images are written to a temporary folder, so the real output folder is not touched.
+    :return: List of dictionary with the configuration and its images per second, the fastest first.
+    """
+    output_dir = args.output_dir
+    results = []
+    with tempfile.TemporaryDirectory() as temporary_output_dir:
+        args.output_dir = temporary_output_dir
+        for num_workers, threads_per_worker in configurations:
+            start = time.perf_counter()
+            crop_images_in_parallel(args, model, feature_extractor, device, list_of_file_name, num_workers,
+                                    threads_per_worker)
+            elapsed = time.perf_counter() - start
+            results.append({'num_workers': num_workers, 'threads_per_worker': threads_per_worker,
+                            'seconds': elapsed, 'images_per_second': len(list_of_file_name) / elapsed})
+            print(f"{num_workers} workers x {threads_per_worker} threads: "
+                  f"{results[-1]['images_per_second']:.2f} images/s")
+    args.output_dir = output_dir
+    results.sort(key=lambda result: result['images_per_second'], reverse=True)
+    return results
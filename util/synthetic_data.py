@@ -0,0 +1,87 @@
+"""
+Synthetic BIOSCAN-like images, an insect-like blob on the plain background of the robotic imager, so the crop
+pipeline can be benchmarked without the real data.
+"""
+import math
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from transformers import DetrConfig, DetrForObjectDetection, DetrFeatureExtractor
+
+# Background colors used by the BIOSCAN crop scripts.
+BIOSCAN_BACKGROUND_COLORS = [(204, 218, 243), (234, 242, 245)]
+
+
+def generate_synthetic_image(rng, width, height, background_color=None):
+    """
+    Draw an insect-like blob (body, head and legs) on a noisy plain background.
+    :param rng: numpy random Generator.
+    :return: The PIL image and the bbox of the blob in (left, top, right, bottom).
+    """
+    if background_color is None:
+        background_color = BIOSCAN_BACKGROUND_COLORS[rng.integers(len(BIOSCAN_BACKGROUND_COLORS))]
+    background = np.empty((height, width, 3), dtype=np.float32)
+    background[:] = background_color
+    background += rng.normal(0, 2.0, size=background.shape)
+    # Slight vignetting as in the real images.
+    y, x = np.ogrid[:height, :width]
+    distance = np.sqrt(((x - width / 2) / width) ** 2 + ((y - height / 2) / height) ** 2)
+    background -= (distance * 12)[:, :, None]
+    image = Image.fromarray(np.clip(background, 0, 255).astype(np.uint8))
+
+    draw = ImageDraw.Draw(image)
+    body_length = rng.uniform(0.2, 0.6) * min(width, height)
+    body_width = body_length * rng.uniform(0.25, 0.5)
+    center_x = rng.uniform(0.35, 0.65) * width
+    center_y = rng.uniform(0.35, 0.65) * height
+    angle = rng.uniform(0, math.pi)
+    body_color = tuple(int(c) for c in rng.integers(20, 120, size=3))
+
+    points = []
+    for t in np.linspace(0, 2 * math.pi, 48, endpoint=False):
+        local_x = body_length / 2 * math.cos(t)
+        local_y = body_width / 2 * math.sin(t) * (1 + 0.15 * math.cos(3 * t))
+        points.append((center_x + local_x * math.cos(angle) - local_y * math.sin(angle),
+                       center_y + local_x * math.sin(angle) + local_y * math.cos(angle)))
+    draw.polygon(points, fill=body_color)
+
+    head_x = center_x + body_length / 2 * math.cos(angle)
+    head_y = center_y + body_length / 2 * math.sin(angle)
+    head_radius = body_width * 0.35
+    draw.ellipse((head_x - head_radius, head_y - head_radius, head_x + head_radius, head_y + head_radius),
+                 fill=body_color)
+    points.extend([(head_x - head_radius, head_y - head_radius), (head_x + head_radius, head_y + head_radius)])
+
+    leg_width = max(int(body_width / 20), 1)
+    for side in [-1, 1]:
+        for position in [-0.3, 0, 0.3]:
+            start_x = center_x + body_length * position * math.cos(angle)
+            start_y = center_y + body_length * position * math.sin(angle)
+            leg_angle = angle + side * rng.uniform(1.0, 2.0)
+            leg_length = body_width * rng.uniform(0.8, 1.4)
+            end_x = start_x + leg_length * math.cos(leg_angle)
+            end_y = start_y + leg_length * math.sin(leg_angle)
+            draw.line((start_x, start_y, end_x, end_y), fill=body_color, width=leg_width)
+            points.append((end_x, end_y))
+
+    image = image.filter(ImageFilter.GaussianBlur(radius=1))
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    bbox = (max(min(xs), 0), max(min(ys), 0), min(max(xs), width - 1), min(max(ys), height - 1))
+    return image, bbox
+
+
+def init_random_detr_model(num_queries=100):
+    """
+    A randomly initialized DetrForObjectDetection with one label, created without downloading any weights.
+    """
+    config = DetrConfig(num_labels=1, num_queries=num_queries, use_pretrained_backbone=False)
+    model = DetrForObjectDetection(config)
+    model.eval()
+    return model
+
+
+def init_offline_feature_extractor():
+    """
+    A DetrFeatureExtractor with the default configuration of facebook/detr-resnet-50, created without network.
+    """
+    return DetrFeatureExtractor(format="coco_detection")
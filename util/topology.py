@@ -0,0 +1,231 @@
+"""
+Threads and cores of the processes of a job. Every process gets its own set of cores, split along the NUMA nodes, and
+inside a process the cores are shared out between the stages: torch intra-op threads for the model, data loader
+workers that decode the images, and threads that crop and encode the outputs. The sum never goes above the cores of
+the process, so adding loader workers does not oversubscribe the cores of the model.
+
+The auto mode derives everything from the available cores and NUMA nodes, the manual mode takes the numbers from the
+command line, and without --topology the scripts keep the torch defaults.
+"""
+import functools
+import glob
+import os
+import torch
+
+TOPOLOGY_MODES = ['default', 'auto', 'manual']
+
+# Read by the OpenMP, MKL and OpenBLAS pools of the processes started after the topology is applied.
+THREAD_ENVIRONMENT_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+# The cores the job started with, inherited by the processes it starts.
+AVAILABLE_CORES_VARIABLE = 'CROPTOOL_AVAILABLE_CORES'
+
+
+def parse_cpu_list(cpu_list):
+    """
+    :param cpu_list: CPU list in the format of /sys, e.g. 0-3,8-11.
+    :return: List of the CPU indices.
+    """
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if part == '':
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def get_available_cores():
+    """
+    :return: The cores the job started with. The first call records them in AVAILABLE_CORES_VARIABLE, so a process
+    started by a process that is already pinned, like the other local ranks of Lightning, still plans its cores from
+    all of them rather than from the cores of its parent.
+    """
+    if AVAILABLE_CORES_VARIABLE in os.environ:
+        return parse_cpu_list(os.environ[AVAILABLE_CORES_VARIABLE])
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    os.environ[AVAILABLE_CORES_VARIABLE] = ','.join(str(core) for core in cores)
+    return cores
+
+
+def get_numa_nodes(available_cores=None):
+    """
+    :return: List of the available cores of each NUMA node, a single node with all the cores if it is unknown.
+    """
+    if available_cores is None:
+        available_cores = get_available_cores()
+    available = set(available_cores)
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda path: int(os.path.basename(os.path.dirname(path))[len('node'):])):
+        with open(path) as file:
+            cores = [core for core in parse_cpu_list(file.read()) if core in available]
+        if len(cores) > 0:
+            nodes.append(cores)
+    # Cores that no node lists, or all of them if the NUMA nodes are unknown.
+    unlisted_cores = sorted(available - {core for node in nodes for core in node})
+    if len(unlisted_cores) > 0:
+        nodes.append(unlisted_cores)
+    return nodes
+
+
+def get_core_sets(num_workers, threads_per_worker, available_cores=None):
+    """
+    Split the available cores into one contiguous core set per worker.
+    If there are not enough cores, the core sets wrap around and share cores.
+    """
+    if available_cores is None:
+        available_cores = get_available_cores()
+    core_sets = []
+    for worker_index in range(num_workers):
+        start = worker_index * threads_per_worker
+        core_sets.append([available_cores[(start + i) % len(available_cores)] for i in range(threads_per_worker)])
+    return core_sets
+
+
+def pin_current_process(core_set, threads):
+    """
+    Pin the current process to the given cores and set the number of torch threads.
+    """
+    if hasattr(os, 'sched_setaffinity') and core_set:
+        os.sched_setaffinity(0, core_set)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # The inter-op pool can only be configured once per process.
+        pass
+
+
+def pin_loader_worker(cores, worker_id):
+    # Torch already runs the loader workers with one thread.
+    if hasattr(os, 'sched_setaffinity') and cores:
+        os.sched_setaffinity(0, cores)
+
+
+class Topology:
+    def __init__(self, core_sets, intra_op_threads, inter_op_threads=1, loader_workers=None, encode_threads=1,
+                 pin=False):
+        """
+        :param core_sets: Cores of each process, the last loader_workers cores of a set are left to its loader workers.
+        :param loader_workers: Number of data loader workers of each process, None to keep the option of the script.
+        :param encode_threads: Number of threads that crop and encode the outputs in each process.
+        :param pin: Pin the processes and their loader workers to their cores.
+        """
+        self.core_sets = core_sets
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.loader_workers = loader_workers
+        self.encode_threads = encode_threads
+        self.pin = pin
+
+    def split_core_set(self, process_index):
+        """
+        :return: The cores of the model and encode threads and the cores of the loader workers of the process.
+        """
+        core_set = self.core_sets[process_index % len(self.core_sets)]
+        loader_workers = self.loader_workers or 0
+        if loader_workers == 0 or loader_workers >= len(core_set):
+            return core_set, core_set
+        return core_set[:len(core_set) - loader_workers], core_set[len(core_set) - loader_workers:]
+
+    def apply(self, process_index=0):
+        """
+        Set the threads and the affinity of the current process, call it before the model runs.
+        """
+        model_cores, _ = self.split_core_set(process_index)
+        if self.pin and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, model_cores)
+        torch.set_num_threads(self.intra_op_threads)
+        try:
+            torch.set_num_interop_threads(self.inter_op_threads)
+        except RuntimeError:
+            # The inter-op pool can only be configured once per process.
+            pass
+        for variable in THREAD_ENVIRONMENT_VARIABLES:
+            os.environ[variable] = str(self.intra_op_threads)
+
+    def get_loader_worker_init_fn(self, process_index=0):
+        """
+        :return: worker_init_fn for the DataLoader of the process, None if the loader workers are not pinned.
+        """
+        if not self.pin:
+            return None
+        _, loader_cores = self.split_core_set(process_index)
+        return functools.partial(pin_loader_worker, loader_cores)
+
+    def describe(self):
+        return (f"{len(self.core_sets)} processes x {len(self.core_sets[0])} cores: "
+                f"{self.intra_op_threads} intra-op threads, {self.inter_op_threads} inter-op threads, "
+                f"{self.loader_workers} loader workers, {self.encode_threads} encode threads, "
+                f"{'pinned' if self.pin else 'not pinned'}")
+
+
+def plan_topology(mode, num_processes=1, threads_per_process=None, intra_op_threads=None, inter_op_threads=None,
+                  loader_workers=None, encode_threads=None, pin=False, has_loader=True, available_cores=None):
+    """
+    :param mode: auto or manual, the numbers that are not None override the ones of the auto mode.
+    :param threads_per_process: Number of cores of each process, the available cores divided by num_processes by
+    default.
+    :param has_loader: Whether the processes have loader workers and encode threads, the auto mode gives them none
+    otherwise.
+    :return: Topology.
+    """
+    if available_cores is None:
+        available_cores = get_available_cores()
+    # The cores ordered by NUMA node, so that contiguous core sets stay inside a node when they fit in one.
+    ordered_cores = [core for node in get_numa_nodes(available_cores) for core in node]
+    if threads_per_process is None:
+        threads_per_process = max(len(ordered_cores) // num_processes, 1)
+    core_sets = get_core_sets(num_processes, threads_per_process, ordered_cores)
+
+    if mode == 'auto':
+        if loader_workers is None:
+            loader_workers = min(max(threads_per_process // 8, 1), 8) if has_loader and threads_per_process >= 4 \
+                else 0
+        if encode_threads is None:
+            encode_threads = 2 if has_loader and threads_per_process >= 8 else 1
+        pin = True
+    if encode_threads is None:
+        encode_threads = 1
+    if intra_op_threads is None:
+        intra_op_threads = max(threads_per_process - (loader_workers or 0) - (encode_threads - 1), 1)
+    if inter_op_threads is None:
+        inter_op_threads = 1
+    return Topology(core_sets, intra_op_threads, inter_op_threads, loader_workers, encode_threads, pin)
+
+
+def add_topology_arguments(parser):
+    parser.add_argument('--topology', type=str, default='default', choices=TOPOLOGY_MODES,
+                        help="default keeps the torch thread settings, auto sets the threads and pins the cores from "
+                             "the available cores and NUMA nodes, manual uses the options below.")
+    parser.add_argument('--intra_op_threads', type=int, default=None,
+                        help="Torch threads of each process, the cores of the process minus the other stages by "
+                             "default.")
+    parser.add_argument('--inter_op_threads', type=int, default=None,
+                        help="Torch inter-op threads of each process, 1 by default.")
+    parser.add_argument('--loader_workers', type=int, default=None,
+                        help="Data loader workers that decode the images for each process.")
+    parser.add_argument('--encode_threads', type=int, default=None,
+                        help="Threads that crop and encode the outputs in each process.")
+    parser.add_argument('--pin_cores', default=False, action='store_true',
+                        help="Pin the processes and their loader workers to their cores in manual mode.")
+
+
+def init_topology_from_args(args, num_processes=1, threads_per_process=None, has_loader=True):
+    """
+    :return: A Topology, or None with --topology default.
+    """
+    if args.topology == 'default':
+        return None
+    topology = plan_topology(args.topology, num_processes, threads_per_process, args.intra_op_threads,
+                             args.inter_op_threads, args.loader_workers, args.encode_threads, args.pin_cores,
+                             has_loader)
+    print("Topology:", topology.describe())
+    return topology
@@ -1,5 +1,4 @@
 import torch
-import matplotlib.pyplot as plt
 import torch.nn.functional as F
 
 # global color for the bbox.
@@ -38,6 +37,8 @@ def box_cxcywh_to_xyxy(x):
 
 
 def plot_results(pil_img, prob, boxes, id2label):
+    # Imported here so that the crop scripts, which only use the box functions of this file, run without matplotlib.
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(16, 10))
     plt.imshow(pil_img)
     ax = plt.gca()
@@ -82,6 +83,22 @@ def get_bbox_from_output_for_batch_version(pred_logits, pred_pred_boxes, image_s
     return bboxes_scaled[0]
 
 
+def get_top_bbox_and_score_for_batch(pred_logits, pred_boxes, image_sizes):
+    """
+    Vectorized version of get_bbox_from_output for a whole batch.
+    :param pred_logits: Logits of the model in shape (batch, queries, classes + 1).
+    :param pred_boxes: Predicted boxes of the model in shape (batch, queries, 4), normalized cx, cy, w, h.
+    :param image_sizes: List of (width, height) of the images.
+    :return: Bounding boxes in (left, top, right, bottom) of shape (batch, 4) and their scores of shape (batch,).
+    """
+    probas = pred_logits.softmax(-1)[:, :, :-1].max(-1).values
+    scores, arg_max = probas.max(-1)
+    top_boxes = pred_boxes[torch.arange(len(arg_max), device=pred_boxes.device), arg_max]
+    scale = torch.tensor([[w, h, w, h] for w, h in image_sizes], dtype=torch.float32)
+    bboxes_scaled = box_cxcywh_to_xyxy(top_boxes.float().cpu()) * scale
+    return bboxes_scaled, scores.float().cpu()
+
+
 def scale_bbox(args, left, top, right, bottom):
     """
     Scale the bounding box based on args.crop_ratio.